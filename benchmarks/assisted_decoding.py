@@ -0,0 +1,111 @@
+"""
+Compares assisted (speculative) decoding with plain decoding of the target
+model alone.
+
+For every prompt it generates greedily with and without the draft model and
+reports tokens/sec of both, the speedup, the draft acceptance rate and the
+share of generated tokens equal to plain decoding (1.0 up to numerical
+noise, since greedy assisted decoding keeps only the target's choices).
+
+The defaults are two small Llama models that share a tokenizer, so the
+benchmark runs on a CPU in about a minute.
+
+Usage:
+    python -m benchmarks.assisted_decoding
+    python -m benchmarks.assisted_decoding --model gpt2-large --draft-model gpt2
+"""
+
+import argparse
+import json
+import time
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from inference.assisted import AssistedDecoder
+
+PROMPTS = [
+    "def print_prime(n):\n    ",
+    "The capital of France is",
+    "Explain what a neural network is in one paragraph.",
+    "Alice has 3 apples and buys 5 more. How many apples does she have?",
+]
+
+
+def load(model_name, trust_remote_code):
+    return AutoModelForCausalLM.from_pretrained(
+        model_name, trust_remote_code=trust_remote_code, low_cpu_mem_usage=True
+    ).eval()
+
+
+def run(generator, tokenizer, prompts, max_new_tokens):
+    generated = []
+    num_tokens = 0
+    elapsed = 0.0
+    with torch.inference_mode():
+        for prompt in prompts:
+            inputs = tokenizer(prompt, return_tensors="pt")
+            prompt_len = inputs["input_ids"].shape[1]
+            start = time.perf_counter()
+            outputs = generator.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                pad_token_id=tokenizer.eos_token_id,
+            )
+            elapsed += time.perf_counter() - start
+            tokens = outputs[0, prompt_len:].tolist()
+            num_tokens += len(tokens)
+            generated.append(tokens)
+    return generated, num_tokens / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--model", default="JackFram/llama-160m")
+    parser.add_argument("--draft-model", default="JackFram/llama-68m")
+    parser.add_argument("--trust-remote-code", action="store_true")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(
+        args.model, trust_remote_code=args.trust_remote_code
+    )
+    model = load(args.model, args.trust_remote_code)
+    draft_model = load(args.draft_model, args.trust_remote_code)
+    assisted = AssistedDecoder(model, draft_model, draft_name=args.draft_model)
+
+    # One untimed round each, so that neither side pays for the first call.
+    run(model, tokenizer, PROMPTS[:1], 4)
+    run(assisted, tokenizer, PROMPTS[:1], 4)
+    assisted.calibrate(
+        tokenizer(PROMPTS[0], return_tensors="pt"),
+        4,
+        pad_token_id=tokenizer.eos_token_id,
+    )
+
+    baseline, baseline_tokens_per_sec = run(
+        model, tokenizer, PROMPTS, args.max_new_tokens
+    )
+    generated, tokens_per_sec = run(assisted, tokenizer, PROMPTS, args.max_new_tokens)
+
+    matches = sum(
+        a == b for base, other in zip(baseline, generated) for a, b in zip(base, other)
+    )
+    stats = assisted.stats()
+    report = {
+        "model": args.model,
+        "draft_model": args.draft_model,
+        "max_new_tokens": args.max_new_tokens,
+        "baseline_tokens_per_sec": baseline_tokens_per_sec,
+        "assisted_tokens_per_sec": tokens_per_sec,
+        "speedup": tokens_per_sec / baseline_tokens_per_sec,
+        "acceptance_rate": stats["acceptance_rate"],
+        "tokens_per_target_pass": stats["tokens_per_target_pass"],
+        "token_match_rate": matches / sum(len(base) for base in baseline),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
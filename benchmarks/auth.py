@@ -0,0 +1,146 @@
+"""
+Measures requests/sec of `/users/me` and `/token` in-process, before and
+after the auth hot-path changes of user_auth.py.
+
+- `/users/me` is run with the verified-token cache disabled (every request
+  decodes the JWT and rebuilds the user, as before) and enabled.
+- `/token` is run with bcrypt verified on the event loop (as before) and in
+  the password executor, while `/users/me` requests run alongside, which
+  shows how much logins stall other requests.
+
+Requires SECRET_KEY and API_SECRET_KEY in the environment or .env file.
+
+Usage:
+    python -m benchmarks.auth --requests 2000 --logins 16
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+import user_auth
+from main import app
+
+USERNAME = "johndoe"
+PASSWORD = "secret"
+
+
+async def hammer(client, n, concurrency, method, url, until=None, **kwargs):
+    # Sends n requests, or keeps sending until `until` is set if given.
+    latencies = []
+    remaining = [n]
+
+    def more():
+        if until is not None:
+            return not until.is_set()
+        remaining[0] -= 1
+        return remaining[0] >= 0
+
+    async def worker():
+        while more():
+            start = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+            # In-process requests may complete without ever suspending.
+            await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests_per_sec": len(latencies) / elapsed,
+        "p50_ms": 1000 * latencies[len(latencies) // 2],
+        "p99_ms": 1000 * latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))],
+    }
+
+
+async def users_me(client, headers, args):
+    return await hammer(
+        client, args.requests, args.concurrency, "GET", "/users/me", headers=headers
+    )
+
+
+async def logins_with_traffic(client, headers, args):
+    done = asyncio.Event()
+
+    async def logins():
+        try:
+            return await hammer(
+                client,
+                args.logins,
+                args.concurrency,
+                "POST",
+                "/token",
+                data={"username": USERNAME, "password": PASSWORD},
+            )
+        finally:
+            done.set()
+
+    login, traffic = await asyncio.gather(
+        logins(),
+        hammer(client, 0, 1, "GET", "/users/me", until=done, headers=headers),
+    )
+    return {"token": login, "users_me_during_logins": traffic}
+
+
+async def dependency_time(token, n=10000):
+    # Microseconds per get_current_user call, without the HTTP stack.
+    start = time.perf_counter()
+    for _ in range(n):
+        await user_auth.get_current_user(token)
+    return 1e6 * (time.perf_counter() - start) / n
+
+
+async def verify_on_loop(plain_password, hashed_password):
+    # How /token verified passwords before: directly on the event loop.
+    return user_auth.verify_password(plain_password, hashed_password)
+
+
+async def run(args):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.post(
+            "/token", data={"username": USERNAME, "password": PASSWORD}
+        )
+        response.raise_for_status()
+        token = response.json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+
+        report = {}
+        cache_size = user_auth.token_cache.max_entries
+        verify = user_auth.verify_password_async
+
+        user_auth.token_cache.max_entries = 0
+        user_auth.verify_password_async = verify_on_loop
+        report["before"] = {
+            "get_current_user_us": await dependency_time(token),
+            "users_me": await users_me(client, headers, args),
+            **await logins_with_traffic(client, headers, args),
+        }
+
+        user_auth.token_cache.max_entries = cache_size
+        user_auth.verify_password_async = verify
+        report["after"] = {
+            "get_current_user_us": await dependency_time(token),
+            "users_me": await users_me(client, headers, args),
+            **await logins_with_traffic(client, headers, args),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--logins", type=int, default=16)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Measures bulk generation throughput for several batch sizes against one
+request at a time.
+
+Prompts of varying length are generated greedily with the tiny random model
+of the load test. They are sent one at a time with GenerationSession.generate,
+and as length-sorted padded batches with generate_batch. The report includes
+prompts/sec, generated tokens/sec and the share of padding tokens in the
+batches.
+
+Usage:
+    python -m benchmarks.bulk_chat --prompts 128 --batch-sizes 1 4 16 32
+"""
+
+import argparse
+import json
+import random
+import time
+
+from benchmarks.load_test import WORDS, build_tiny_model
+from inference.bulk import plan_batches
+from inference.session import GenerationSession
+
+
+def run_batched(session, token_ids, batch_size):
+    batches = plan_batches([len(ids) for ids in token_ids], batch_size)
+    generated = 0
+    padding = 0
+    start = time.perf_counter()
+    for batch in batches:
+        usage = {}
+        session.generate_batch([token_ids[i] for i in batch], usage=usage)
+        generated += usage["generated_tokens"]
+        longest = max(len(token_ids[i]) for i in batch)
+        padding += sum(longest - len(token_ids[i]) for i in batch)
+    elapsed = time.perf_counter() - start
+    total = sum(len(ids) for ids in token_ids) + padding
+    return {
+        "batches": len(batches),
+        "prompts_per_sec": len(token_ids) / elapsed,
+        "tokens_per_sec": generated / elapsed,
+        "padding_share": padding / total,
+    }
+
+
+def run_sequential(session, prompts):
+    generated = 0
+    start = time.perf_counter()
+    for prompt in prompts:
+        usage = {}
+        session.generate(prompt, usage=usage)
+        generated += usage["generated_tokens"]
+    elapsed = time.perf_counter() - start
+    return {
+        "prompts_per_sec": len(prompts) / elapsed,
+        "tokens_per_sec": generated / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--prompts", type=int, default=128)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 16, 32])
+    parser.add_argument("--min-words", type=int, default=8)
+    parser.add_argument("--max-words", type=int, default=256)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    model, tokenizer = build_tiny_model(args.hidden_size, args.layers, args.seed)
+    # min_new_tokens keeps every answer the same length, so that only the
+    # batching differs between runs
+    session = GenerationSession(
+        model,
+        tokenizer,
+        {
+            "max_new_tokens": args.max_new_tokens,
+            "min_new_tokens": args.max_new_tokens,
+            "do_sample": False,
+        },
+    )
+    rng = random.Random(args.seed)
+    prompts = [
+        " ".join(
+            rng.choice(WORDS)
+            for _ in range(rng.randint(args.min_words, args.max_words))
+        )
+        for _ in range(args.prompts)
+    ]
+    token_ids = tokenizer(prompts)["input_ids"]
+
+    report = {"sequential": run_sequential(session, prompts), "batched": {}}
+    for batch_size in args.batch_sizes:
+        report["batched"][batch_size] = run_batched(session, token_ids, batch_size)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Compares the streaming validator of finetuning/validation.py with loading a
+whole fine-tuning dataset into memory before validating it.
+
+A synthetic JSONL dataset is written to a temporary file. Both approaches
+are timed, then run again under tracemalloc to report their peak Python
+memory.
+
+Usage:
+    python -m benchmarks.finetuning_validation --examples 200000
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from finetuning.validation import validate_data_format, validate_file, validate_messages
+
+SYSTEM_PROMPT = "You are a helpful assistant that answers questions about cooking."
+WORDS = "the a salt pan oven heat stir minutes until golden add water flour".split()
+
+
+def sentence(rng, length):
+    return " ".join(rng.choice(WORDS) for _ in range(length)).capitalize() + "."
+
+
+def write_dataset(path, num_examples, seed=0):
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        for _ in range(num_examples):
+            messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+            for _ in range(rng.randint(1, 3)):
+                messages.append(
+                    {"role": "user", "content": sentence(rng, rng.randint(5, 30))}
+                )
+                messages.append(
+                    {"role": "assistant", "content": sentence(rng, rng.randint(10, 80))}
+                )
+            f.write(json.dumps({"messages": messages}) + "\n")
+
+
+def validate_in_memory(path):
+    # What the upload handler used to do with the whole file.
+    with open(path, "rb") as f:
+        file_content = f.read()
+    file_str = file_content.decode("utf-8")
+    file_list = [json.loads(line) for line in file_str.splitlines() if line]
+    return validate_data_format(file_list), validate_messages(file_list)
+
+
+def validate_streaming(path):
+    with open(path, "rb") as f:
+        return validate_file(f)
+
+
+def measure(fn, path):
+    start = time.perf_counter()
+    fn(path)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    fn(path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": elapsed, "peak_memory_mb": peak / 2**20}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--examples", type=int, default=200000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "dataset.jsonl")
+        write_dataset(path, args.examples)
+        report = {
+            "examples": args.examples,
+            "file_size_mb": os.path.getsize(path) / 2**20,
+            "in_memory": measure(validate_in_memory, path),
+            "streaming": measure(validate_streaming, path),
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+"""
+Load test of `/api/chat_cpu` and `/api/chat_gpu`, offline and on CPU.
+
+The app is served by uvicorn on a local port, with a tiny randomly
+initialized Llama model standing in for every model of
+`load_models/model_list.py`, so the numbers measure the serving stack
+(queueing, batching, prompt building, streaming) rather than model quality.
+Requests are `ChatMessages` payloads with a varying chat history length and
+`fetchedText` size, drawn from a seeded generator so that runs are
+comparable. Every (endpoint, concurrency) pair reports p50/p95/p99 latency,
+time to first token and tokens/sec of streamed requests, the overall
+generated tokens/sec (from `/metrics`) and requests/sec, as JSON.
+
+With `--baseline`, the results are compared with an earlier report and the
+command exits with status 1 if latency, requests/sec or tokens/sec regressed
+by more than `--tolerance`, so it can gate a release.
+
+The tiktoken encoding used by fine-tuning validation must be in the local
+tiktoken cache, since the app imports it at startup.
+
+Usage:
+    python -m benchmarks.load_test --requests 64 --concurrency 1 4 8
+    python -m benchmarks.load_test --output new.json --baseline old.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import sys
+import threading
+import time
+
+os.environ.setdefault("SECRET_KEY", "load-test")
+os.environ.setdefault("API_SECRET_KEY", "load-test")
+
+import httpx  # noqa: E402
+import torch  # noqa: E402
+import uvicorn  # noqa: E402
+from tokenizers import Tokenizer, models as tokenizer_models  # noqa: E402
+from tokenizers import pre_tokenizers  # noqa: E402
+from transformers import (  # noqa: E402
+    LlamaConfig,
+    LlamaForCausalLM,
+    PreTrainedTokenizerFast,
+)
+
+import load_models.registry  # noqa: E402
+from config import API_SECRET_KEY  # noqa: E402
+from load_models.model_list import models  # noqa: E402
+
+WORDS = (
+    "the a an of to in and or for with on at by from about as into like through "
+    "after over between out against during without before under around among "
+    "model data user answer question request server token memory cache batch "
+    "time value result system file network error test level price market "
+    "report team project design code language history science energy health "
+    "is are was were be been has have had do does did can could will would "
+    "should may might must make made take took give gave find found think "
+    "new old good great small large long short high low early late first last "
+    "what which who when where why how this that these those it they we you"
+).split()
+
+ENDPOINT_MODELS = {
+    "chat_cpu": "microsoft/phi-1_5",
+    "chat_gpu": "meta-llama/Llama-2-7b-chat-hf",
+}
+
+BASE_PROMPT = (
+    "You are a helpful assistant. Answer the question using the conversation "
+    "and the provided context."
+)
+
+
+def build_tiny_model(hidden_size, num_layers, seed):
+    """
+    Returns a randomly initialized Llama model and a word-level tokenizer
+    over WORDS; text outside WORDS is encoded as <unk>.
+    """
+
+    vocab = {"<unk>": 0, "<s>": 1, "</s>": 2}
+    for word in WORDS:
+        vocab.setdefault(word, len(vocab))
+    tokenizer_object = Tokenizer(tokenizer_models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer_object.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer_object,
+        unk_token="<unk>",
+        bos_token="<s>",
+        eos_token="</s>",
+        pad_token="</s>",
+        model_input_names=["input_ids", "attention_mask"],
+    )
+
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=len(vocab),
+        hidden_size=hidden_size,
+        intermediate_size=4 * hidden_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=max(1, hidden_size // 32),
+        max_position_embeddings=2048,
+        pad_token_id=vocab["</s>"],
+        bos_token_id=vocab["<s>"],
+        eos_token_id=vocab["</s>"],
+    )
+    return LlamaForCausalLM(config).eval(), tokenizer
+
+
+def use_tiny_model(args):
+    # Every model in model_list.py is served by the tiny model, with the same
+    # generation length, so that both endpoints do comparable work.
+    model, tokenizer = build_tiny_model(args.hidden_size, args.layers, args.seed)
+
+    def load_model(*_, **__):
+        return model, tokenizer
+
+    load_models.registry.load_model = load_model
+    for config in models.values():
+        config["quantization"] = "none"
+        config["draft_model"] = None
+        generation_config = dict(config["generation_config"])
+        generation_config.pop("max_length", None)
+        generation_config["max_new_tokens"] = args.max_new_tokens
+        config["generation_config"] = generation_config
+
+
+def sentence(rng, low, high):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def make_payloads(args, endpoint, n, rng):
+    payloads = []
+    for _ in range(n):
+        history = [
+            {"question": sentence(rng, 5, 20), "answer": sentence(rng, 10, 60)}
+            for _ in range(rng.randint(0, args.max_history))
+        ]
+        fetched_chars = rng.choice(args.fetched_text_sizes)
+        fetched_text = ""
+        while len(fetched_text) < fetched_chars:
+            fetched_text += sentence(rng, 10, 30) + ". "
+        payloads.append(
+            {
+                "question": sentence(rng, 5, 20) + "?",
+                "basePrompt": BASE_PROMPT,
+                "chatHistory": history,
+                "selectedModel": ENDPOINT_MODELS[endpoint],
+                "fetchedText": fetched_text[:fetched_chars],
+                "stream": rng.random() < args.stream_ratio,
+                "useCache": False,
+            }
+        )
+    return payloads
+
+
+def start_server():
+    """Serves the app on a free local port; returns the server and its URL."""
+
+    from main import app
+
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning"))
+    thread = threading.Thread(
+        target=server.run, kwargs={"sockets": [sock]}, daemon=True
+    )
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread, f"http://127.0.0.1:{port}"
+
+
+async def send(client, endpoint, payload):
+    # Returns a sample: success, latency, and for streamed requests the time
+    # to first token and tokens/sec of the generation.
+    sample = {"ok": False, "ttft": None, "tokens_per_sec": None}
+    start = time.perf_counter()
+    url = f"/api/{endpoint}"
+    if not payload["stream"]:
+        response = await client.post(url, json=payload)
+        sample["ok"] = response.status_code == 200 and response.json()["success"]
+    else:
+        async with client.stream("POST", url, json=payload) as response:
+            event = None
+            async for line in response.aiter_lines():
+                if line.startswith("event: "):
+                    event = line[len("event: ") :]
+                elif line.startswith("data: "):
+                    if event == "token" and sample["ttft"] is None:
+                        sample["ttft"] = time.perf_counter() - start
+                    elif event == "done":
+                        done = json.loads(line[len("data: ") :])
+                        sample["ok"] = response.status_code == 200
+                        if done["total_time"]:
+                            sample["tokens_per_sec"] = (
+                                done["num_tokens"] / done["total_time"]
+                            )
+    sample["latency"] = time.perf_counter() - start
+    return sample
+
+
+async def generated_tokens(client, endpoint):
+    # Total generated tokens of an endpoint so far, from /metrics.
+    response = await client.get("/metrics")
+    response.raise_for_status()
+    prefix = f'smartchat_generated_tokens_sum{{endpoint="{endpoint}",'
+    return sum(
+        float(line.rsplit(" ", 1)[1])
+        for line in response.text.splitlines()
+        if line.startswith(prefix)
+    )
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    n = len(values)
+    return {
+        "p50": values[int(0.50 * (n - 1))],
+        "p95": values[int(0.95 * (n - 1))],
+        "p99": values[int(0.99 * (n - 1))],
+        "mean": sum(values) / n,
+    }
+
+
+async def run_load(client, endpoint, payloads, concurrency):
+    queue = list(reversed(payloads))
+    samples = []
+
+    async def worker():
+        while queue:
+            samples.append(await send(client, endpoint, queue.pop()))
+
+    tokens_before = await generated_tokens(client, endpoint)
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    duration = time.perf_counter() - start
+    tokens = await generated_tokens(client, endpoint) - tokens_before
+
+    ok = [sample for sample in samples if sample["ok"]]
+    return {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "streamed": sum(payload["stream"] for payload in payloads),
+        "duration": duration,
+        "requests_per_sec": len(ok) / duration,
+        "latency": percentiles([sample["latency"] for sample in ok]),
+        "time_to_first_token": percentiles(
+            [sample["ttft"] for sample in ok if sample["ttft"] is not None]
+        ),
+        "tokens_per_sec": {
+            "overall": tokens / duration,
+            "per_stream": percentiles(
+                [
+                    sample["tokens_per_sec"]
+                    for sample in ok
+                    if sample["tokens_per_sec"] is not None
+                ]
+            ),
+        },
+    }
+
+
+async def run(args, url):
+    headers = {"Authorization": f"Bearer {API_SECRET_KEY}"}
+    limits = httpx.Limits(max_connections=max(args.concurrency))
+    rng = random.Random(args.seed)
+    results = []
+    async with httpx.AsyncClient(
+        base_url=url, headers=headers, timeout=None, limits=limits
+    ) as client:
+        for endpoint in args.endpoints:
+            for payload in make_payloads(args, endpoint, args.warmup, rng):
+                await send(client, endpoint, payload)
+            for concurrency in args.concurrency:
+                payloads = make_payloads(args, endpoint, args.requests, rng)
+                result = await run_load(client, endpoint, payloads, concurrency)
+                print(
+                    f"{endpoint} x{concurrency}: "
+                    f"{result['requests_per_sec']:.2f} req/s, "
+                    f"p95 {result['latency']['p95']:.3f}s",
+                    file=sys.stderr,
+                )
+                results.append(result)
+    return results
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Compares results with a baseline report.
+
+    Returns:
+    - list: One message per metric that got worse than the baseline by more
+      than `tolerance` (a fraction).
+    """
+
+    previous = {
+        (result["endpoint"], result["concurrency"]): result
+        for result in baseline["results"]
+    }
+    checks = [
+        ("latency p95", lambda r: r["latency"] and r["latency"]["p95"], True),
+        ("requests/sec", lambda r: r["requests_per_sec"], False),
+        ("tokens/sec", lambda r: r["tokens_per_sec"]["overall"], False),
+    ]
+    regressions = []
+    for result in results:
+        before = previous.get((result["endpoint"], result["concurrency"]))
+        if before is None:
+            continue
+        if result["errors"] > before["errors"]:
+            regressions.append(
+                f"{result['endpoint']} x{result['concurrency']} errors: "
+                f"{before['errors']} -> {result['errors']}"
+            )
+        for name, get, lower_is_better in checks:
+            old, new = get(before), get(result)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (change if lower_is_better else -change) > tolerance:
+                regressions.append(
+                    f"{result['endpoint']} x{result['concurrency']} {name}: "
+                    f"{old:.4g} -> {new:.4g} ({change:+.1%})"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--endpoints",
+        nargs="+",
+        choices=list(ENDPOINT_MODELS),
+        default=["chat_cpu", "chat_gpu"],
+    )
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--stream-ratio", type=float, default=0.5)
+    parser.add_argument("--max-history", type=int, default=6)
+    parser.add_argument(
+        "--fetched-text-sizes", type=int, nargs="+", default=[0, 500, 2000, 8000]
+    )
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--hidden-size", type=int, default=64)
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report to this file.")
+    parser.add_argument("--baseline", help="Earlier JSON report to compare with.")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    use_tiny_model(args)
+    server, thread, url = start_server()
+    try:
+        results = asyncio.run(run(args, url))
+    finally:
+        server.should_exit = True
+        thread.join()
+
+    report = {
+        "config": vars(args),
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "cpus": os.cpu_count(),
+            "torch_threads": torch.get_num_threads(),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Measures local LoRA fine-tuning (/api/finetuning/peft) on CPU with and
+without sequence packing and gradient checkpointing.
+
+A random Llama model is written to a temporary local cache under the name of
+the configured Llama model, so that its prompt template and LoRA target
+layers apply, and a training file of random conversations of varied length
+is generated. Each configuration then trains in its own process, as jobs do,
+and reports its throughput, peak memory and final loss.
+
+Usage:
+    python -m benchmarks.lora_training --examples 64 --hidden-size 256 --layers 4
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+
+from benchmarks.load_test import WORDS
+
+MODEL_KEY = "Llama-2-7b-chat-hf"
+
+
+def write_cache(cache_dir, model_name, hidden_size, num_layers):
+    from benchmarks.load_test import build_tiny_model
+    from load_models.local_cache import write_cache_info
+
+    model, tokenizer = build_tiny_model(hidden_size, num_layers, seed=0)
+    model_path = os.path.join(cache_dir, model_name)
+    tokenizer.save_pretrained(model_path)
+    model.save_pretrained(model_path, safe_serialization=True)
+    write_cache_info(model_path, dtype="torch.float32")
+
+
+def write_training_file(path, num_examples, max_words, seed):
+    rng = random.Random(seed)
+
+    def text():
+        return " ".join(rng.choices(WORDS, k=rng.randint(4, max_words)))
+
+    with open(path, "w") as f:
+        for _ in range(num_examples):
+            messages = [
+                {"role": "system", "content": "answer the question"},
+                {"role": "user", "content": text()},
+                {"role": "assistant", "content": text()},
+            ]
+            f.write(json.dumps({"messages": messages}) + "\n")
+
+
+def worker(job_dir, cache_dir, num_threads, results):
+    import torch
+
+    from finetuning.job_files import read_status
+    from finetuning.lora_trainer import train
+    from load_models.local_cache import peak_rss
+
+    torch.set_num_threads(num_threads)
+    train(job_dir, cache_dir=cache_dir)
+    results.put({**read_status(job_dir), "peak_rss": peak_rss()})
+
+
+def run(work_dir, cache_dir, spec, num_threads, packing, gradient_checkpointing):
+    from finetuning.job_files import write_json
+
+    name = f"packing={packing},checkpointing={gradient_checkpointing}"
+    job_dir = os.path.join(work_dir, name)
+    os.makedirs(job_dir)
+    os.link(os.path.join(work_dir, "train.jsonl"), os.path.join(job_dir, "train.jsonl"))
+    write_json(
+        os.path.join(job_dir, "spec.json"),
+        {**spec, "packing": packing, "gradient_checkpointing": gradient_checkpointing},
+    )
+    write_json(os.path.join(job_dir, "status.json"), {"status": "queued"})
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(
+        target=worker, args=(job_dir, cache_dir, num_threads, results)
+    )
+    process.start()
+    status = results.get()
+    process.join()
+    return {
+        "config": name,
+        "sequences": status["sequences"],
+        "steps": status["step"],
+        "packing_efficiency": status["packing_efficiency"],
+        "trained_tokens": status["trained_tokens"],
+        "tokens_per_second": status["tokens_per_second"],
+        "elapsed": status["elapsed"],
+        "peak_rss_mb": status["peak_rss"] / 1024**2,
+        "loss": status["loss"],
+    }
+
+
+def main():
+    from load_models.model_list import models
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--examples", type=int, default=64)
+    parser.add_argument("--max-words", type=int, default=96)
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--micro-batch-size", type=int, default=2)
+    parser.add_argument("--max-seq-length", type=int, default=512)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    model_config = models[MODEL_KEY]
+    spec = {
+        "id": "benchmark",
+        "model": model_config["name"],
+        "target_modules": model_config["lora_target_modules"],
+        "epochs": args.epochs,
+        "batch_size": args.batch_size,
+        "learning_rate": 2e-4,
+        "prompt_loss_weight": 0.01,
+        "lora_rank": 8,
+        "lora_alpha": 16,
+        "max_seq_length": args.max_seq_length,
+        "micro_batch_size": args.micro_batch_size,
+        "checkpoint_steps": 10**9,
+    }
+    with tempfile.TemporaryDirectory() as work_dir:
+        cache_dir = os.path.join(work_dir, "models")
+        write_cache(cache_dir, model_config["name"], args.hidden_size, args.layers)
+        write_training_file(
+            os.path.join(work_dir, "train.jsonl"), args.examples, args.max_words, 0
+        )
+        report = [
+            run(work_dir, cache_dir, spec, args.threads, packing, checkpointing)
+            for packing in (False, True)
+            for checkpointing in (False, True)
+        ]
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Compares the CPU quantization modes of load_models/quantization.py with the
+float32 baseline.
+
+For every mode it reports greedy-decoding tokens/sec, the RSS the loaded
+model adds to the process, and how far the output drifts from float32: the
+share of generated tokens equal to the float32 tokens at the same position
+and the mean KL divergence of the next-token distribution after each prompt.
+
+Usage:
+    python -m benchmarks.quantization --model microsoft/phi-1_5 --trust-remote-code
+"""
+
+import argparse
+import gc
+import json
+import time
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from load_models.local_cache import current_rss
+from load_models.quantization import QUANTIZATION_MODES, apply_quantization, cpu_dtype
+
+PROMPTS = [
+    "def print_prime(n):\n    ",
+    "The capital of France is",
+    "Explain what a neural network is in one paragraph.",
+    "Alice has 3 apples and buys 5 more. How many apples does she have?",
+]
+
+
+def load(model_name, quantization, trust_remote_code):
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        torch_dtype=cpu_dtype(quantization),
+        trust_remote_code=trust_remote_code,
+        low_cpu_mem_usage=True,
+    )
+    return apply_quantization(model, quantization).eval()
+
+
+def run(model, tokenizer, prompts, max_new_tokens):
+    generated = []
+    last_logits = []
+    num_tokens = 0
+    elapsed = 0.0
+    with torch.inference_mode():
+        for prompt in prompts:
+            inputs = tokenizer(prompt, return_tensors="pt")
+            prompt_len = inputs["input_ids"].shape[1]
+            last_logits.append(model(**inputs).logits[0, -1].float())
+
+            start = time.perf_counter()
+            outputs = model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                min_new_tokens=max_new_tokens,
+                do_sample=False,
+                pad_token_id=tokenizer.eos_token_id,
+            )
+            elapsed += time.perf_counter() - start
+            tokens = outputs[0, prompt_len:].tolist()
+            num_tokens += len(tokens)
+            generated.append(tokens)
+    return generated, last_logits, num_tokens / elapsed
+
+
+def drift(baseline, result):
+    base_tokens, base_logits = baseline
+    tokens, logits = result
+    matches = sum(
+        a == b for base, other in zip(base_tokens, tokens) for a, b in zip(base, other)
+    )
+    total = sum(len(base) for base in base_tokens)
+    kl = [
+        torch.nn.functional.kl_div(
+            torch.log_softmax(other, -1),
+            torch.log_softmax(base, -1),
+            log_target=True,
+            reduction="sum",
+        ).item()
+        for base, other in zip(base_logits, logits)
+    ]
+    return {"token_match_rate": matches / total, "mean_kl": sum(kl) / len(kl)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--model", default="microsoft/phi-1_5")
+    parser.add_argument("--trust-remote-code", action="store_true")
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--modes", nargs="+", default=list(QUANTIZATION_MODES))
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(
+        args.model, trust_remote_code=args.trust_remote_code
+    )
+    modes = ["none"] + [mode for mode in args.modes if mode != "none"]
+
+    report = {"model": args.model, "max_new_tokens": args.max_new_tokens}
+    baseline = None
+    for mode in modes:
+        gc.collect()
+        rss_before = current_rss()
+        model = load(args.model, mode, args.trust_remote_code)
+        rss_added = current_rss() - rss_before
+
+        tokens, logits, tokens_per_sec = run(
+            model, tokenizer, PROMPTS, args.max_new_tokens
+        )
+        result = {"tokens_per_sec": tokens_per_sec, "rss_added_mb": rss_added / 2**20}
+        if baseline is None:
+            baseline = (tokens, logits)
+        else:
+            result.update(drift(baseline, (tokens, logits)))
+        report[mode] = result
+
+        del model
+        gc.collect()
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Compares the memory of several worker processes serving the same model with
+private weights and with weights mapped from the shared safetensors cache
+(SHARED_WEIGHTS=true).
+
+A random Llama model is written to a temporary local cache. Each worker then
+loads it with load_model, runs a short generation and reports its memory:
+resident (RSS), private anonymous, file-backed (shared) and proportional
+(PSS) memory, while all workers are alive.
+
+Usage:
+    python -m benchmarks.shared_weights --workers 4 --hidden-size 1024 --layers 8
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+
+MODEL_NAME = "random/llama"
+
+
+def write_cache(cache_dir, hidden_size, num_layers):
+    from benchmarks.load_test import build_tiny_model
+    from load_models.local_cache import write_cache_info
+
+    model, tokenizer = build_tiny_model(hidden_size, num_layers, seed=0)
+    model_path = os.path.join(cache_dir, MODEL_NAME)
+    tokenizer.save_pretrained(model_path)
+    model.save_pretrained(model_path, safe_serialization=True)
+    write_cache_info(model_path, dtype="torch.float32")
+    return sum(p.numel() * p.element_size() for p in model.parameters())
+
+
+def worker(cache_dir, barrier, results):
+    import torch
+
+    from load_models.local_cache import memory_usage
+    from load_models.model_loader import load_model
+
+    torch.set_num_threads(1)
+    model, tokenizer = load_model(MODEL_NAME, cache_dir=cache_dir)
+    inputs = tokenizer("what is the answer", return_tensors="pt")
+    with torch.inference_mode():
+        model.generate(**inputs, max_new_tokens=8, pad_token_id=0)
+    barrier.wait()
+    results.put(memory_usage())
+    barrier.wait()
+
+
+def run_workers(cache_dir, num_workers, shared):
+    os.environ["SHARED_WEIGHTS"] = "true" if shared else "false"
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(num_workers)
+    results = context.Queue()
+    processes = [
+        context.Process(target=worker, args=(cache_dir, barrier, results))
+        for _ in range(num_workers)
+    ]
+    for process in processes:
+        process.start()
+    usages = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    mb = 1024**2
+    return {
+        "per_worker_mb": [
+            {kind: size / mb for kind, size in usage.items() if size is not None}
+            for usage in usages
+        ],
+        "total_rss_mb": sum(usage["rss"] for usage in usages) / mb,
+        "total_pss_mb": (
+            sum(usage["pss"] for usage in usages) / mb
+            if all(usage["pss"] is not None for usage in usages)
+            else None
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--hidden-size", type=int, default=1024)
+    parser.add_argument("--layers", type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        weights = write_cache(cache_dir, args.hidden_size, args.layers)
+        report = {
+            "weights_mb": weights / 1024**2,
+            "private": run_workers(cache_dir, args.workers, shared=False),
+            "shared": run_workers(cache_dir, args.workers, shared=True),
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
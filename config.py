@@ -5,21 +5,178 @@ load_dotenv()  # Load environment variables from .env file
 
 CACHE_DIR = "./load_models/models"
 
+# local model cache: safetensors shard size and how many shards are read in
+# parallel when a cached model is loaded
+MODEL_SHARD_SIZE = os.getenv("MODEL_SHARD_SIZE", "2GB")
+MODEL_LOAD_WORKERS = int(os.getenv("MODEL_LOAD_WORKERS", "4"))
+
 # environment
 DEVICE_TYPE = os.getenv("DEVICE")
 
+# serve CPU models from a memory map of their local safetensors cache, so that
+# uvicorn workers on one machine share a single copy of the weights in RAM
+SHARED_WEIGHTS = os.getenv("SHARED_WEIGHTS", "false").lower() == "true"
+
+# warm-up generation run after each model loads, before it serves requests;
+# WARMUP_MAX_NEW_TOKENS=0 disables it
+WARMUP_PROMPT = os.getenv("WARMUP_PROMPT", "Hello, how are you?")
+WARMUP_MAX_NEW_TOKENS = int(os.getenv("WARMUP_MAX_NEW_TOKENS", "8"))
+
+# memory the loaded models may use, in GB; 0 means no limit. Least recently
+# used models that are not pinned are unloaded to stay within the budget.
+MODEL_RAM_BUDGET_GB = float(os.getenv("MODEL_RAM_BUDGET_GB", "0"))
+MODEL_VRAM_BUDGET_GB = float(os.getenv("MODEL_VRAM_BUDGET_GB", "0"))
+
+# continuous batching: largest batch per model and how long an idle scheduler
+# waits for more requests before starting a batch
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "10"))
+
+# LoRA adapters resident per base model; the least recently used adapter that
+# no request is using is unloaded beyond this
+LORA_MAX_ADAPTERS = int(os.getenv("LORA_MAX_ADAPTERS", "8"))
+
+# number of distinct prompt prefixes whose attention state is cached per model
+PREFIX_CACHE_MAX_ENTRIES = int(os.getenv("PREFIX_CACHE_MAX_ENTRIES", "8"))
+
+# number of prompt segments (history turns, fetched texts) whose token ids are
+# cached per model
+PROMPT_TOKEN_CACHE_SIZE = int(os.getenv("PROMPT_TOKEN_CACHE_SIZE", "4096"))
+
+# response cache for repeated chat requests: entries kept in memory, seconds
+# an answer stays valid, and an optional directory for a disk tier that
+# survives restarts ("" disables it)
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", "")
+RESPONSE_CACHE_DISK_MAX_ENTRIES = int(
+    os.getenv("RESPONSE_CACHE_DISK_MAX_ENTRIES", "10000")
+)
+
+# inference executor: worker threads for blocking generation calls and the
+# number of requests that may be running or waiting before new ones get a 503
+INFERENCE_MAX_WORKERS = int(os.getenv("INFERENCE_MAX_WORKERS", "4"))
+INFERENCE_MAX_QUEUE_SIZE = int(os.getenv("INFERENCE_MAX_QUEUE_SIZE", "32"))
+
+# a generation stops when its client disconnects, which is checked every
+# DISCONNECT_POLL_INTERVAL_SECONDS, or GENERATION_TIMEOUT_SECONDS after its
+# request arrived (0 disables the deadline)
+GENERATION_TIMEOUT_SECONDS = float(os.getenv("GENERATION_TIMEOUT_SECONDS", "300"))
+DISCONNECT_POLL_INTERVAL_SECONDS = float(
+    os.getenv("DISCONNECT_POLL_INTERVAL_SECONDS", "0.25")
+)
+
+# bulk chat requests: maximum items per request, and the most prompts and
+# padded prompt tokens generated together in one batch
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "10000"))
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "16"))
+BULK_MAX_BATCH_TOKENS = int(os.getenv("BULK_MAX_BATCH_TOKENS", "16384"))
+
+# logs are written by a background thread: the application log, and the trace
+# log with one JSON record per traced chat request. A share of requests is
+# traced at random, and every request slower than TRACE_SLOW_REQUEST_SECONDS
+# (0 disables this). PROFILING_ENABLED lets a request ask to be profiled with
+# the X-Profile header.
+LOG_FILE = os.getenv("LOG_FILE", "application.log")
+TRACE_LOG_FILE = os.getenv("TRACE_LOG_FILE", "trace.log")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_SLOW_REQUEST_SECONDS = float(os.getenv("TRACE_SLOW_REQUEST_SECONDS", "30"))
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+
+# fine-tuning uploads are validated in chunks of this many bytes; at most
+# this many per-line error locations are reported
+FINETUNING_VALIDATION_CHUNK_SIZE = int(
+    os.getenv("FINETUNING_VALIDATION_CHUNK_SIZE", str(1024 * 1024))
+)
+FINETUNING_MAX_LINE_ERRORS = int(os.getenv("FINETUNING_MAX_LINE_ERRORS", "100"))
+
+# token counting of fine-tuning data: examples encoded per batch, encoder
+# threads, number of distinct strings whose token count is memoized, and the
+# training price used to estimate the cost of a job
+FINETUNING_TOKEN_BATCH_SIZE = int(os.getenv("FINETUNING_TOKEN_BATCH_SIZE", "1024"))
+FINETUNING_TOKEN_THREADS = int(os.getenv("FINETUNING_TOKEN_THREADS", "8"))
+FINETUNING_TOKEN_CACHE_SIZE = int(os.getenv("FINETUNING_TOKEN_CACHE_SIZE", "10000"))
+FINETUNING_PRICE_PER_1K_TOKENS = float(
+    os.getenv("FINETUNING_PRICE_PER_1K_TOKENS", "0.008")
+)
+
+# local LoRA fine-tuning (/api/finetuning/peft) runs in a separate process,
+# one job at a time: job directory, LoRA rank and alpha, tokens per packed
+# training sequence, sequences per forward pass (larger batch sizes are
+# reached by gradient accumulation), base learning rate, optimizer steps
+# between checkpoints, CPU threads of the training process, whether
+# examples are packed into full sequences and activations are recomputed in
+# the backward pass (gradient checkpointing) to save memory, and seconds
+# between scans for adapters trained by another worker process
+PEFT_JOBS_DIR = os.getenv("PEFT_JOBS_DIR", "peft_jobs")
+PEFT_LORA_RANK = int(os.getenv("PEFT_LORA_RANK", "8"))
+PEFT_LORA_ALPHA = float(os.getenv("PEFT_LORA_ALPHA", "16"))
+PEFT_MAX_SEQ_LENGTH = int(os.getenv("PEFT_MAX_SEQ_LENGTH", "1024"))
+PEFT_MICRO_BATCH_SIZE = int(os.getenv("PEFT_MICRO_BATCH_SIZE", "1"))
+PEFT_LEARNING_RATE = float(os.getenv("PEFT_LEARNING_RATE", "2e-4"))
+PEFT_CHECKPOINT_STEPS = int(os.getenv("PEFT_CHECKPOINT_STEPS", "50"))
+PEFT_TRAINING_THREADS = int(os.getenv("PEFT_TRAINING_THREADS", "2"))
+PEFT_SEQUENCE_PACKING = os.getenv("PEFT_SEQUENCE_PACKING", "true").lower() == "true"
+PEFT_GRADIENT_CHECKPOINTING = (
+    os.getenv("PEFT_GRADIENT_CHECKPOINTING", "true").lower() == "true"
+)
+PEFT_ADAPTER_DISCOVERY_SECONDS = float(
+    os.getenv("PEFT_ADAPTER_DISCOVERY_SECONDS", "10")
+)
+
 # key for user auth
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# threads that verify passwords (bcrypt) off the event loop, and number of
+# verified access tokens cached (0 disables the cache)
+AUTH_HASH_WORKERS = int(os.getenv("AUTH_HASH_WORKERS", "2"))
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "1024"))
+
 # key used for send data to the API end points
 API_SECRET_KEY = os.getenv("API_SECRET_KEY")
 
+# keys of other clients of the API: "name:key" entries separated by commas,
+# each optionally followed by ":<tokens per minute>" to set its own budget
+API_KEYS = os.getenv("API_KEYS", "")
+
+# admission control: a chat request costs its prompt tokens, estimated at
+# ADMISSION_CHARS_PER_TOKEN characters per token, plus the model's
+# max_new_tokens. Each API key, and each user a client sends requests for
+# (X-User-ID header), may spend a budget of tokens per minute, and running
+# requests may hold at most MAX_INFLIGHT_TOKENS; 0 disables each limit.
+ADMISSION_CHARS_PER_TOKEN = float(os.getenv("ADMISSION_CHARS_PER_TOKEN", "4"))
+KEY_TOKENS_PER_MINUTE = int(os.getenv("KEY_TOKENS_PER_MINUTE", "0"))
+USER_TOKENS_PER_MINUTE = int(os.getenv("USER_TOKENS_PER_MINUTE", "0"))
+MAX_INFLIGHT_TOKENS = int(os.getenv("MAX_INFLIGHT_TOKENS", "0"))
+
 # IP address that host the Client site or site url:
 YOUR_CLIENT_SITE_ADDRESS = os.getenv("YOUR_CLIENT_SITE_ADDRESS")
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+# OpenAI API used for fine-tuning: base URL (point it at a local stub server
+# to test), connections kept open, retries of a failed request and seconds a
+# request, including a file upload, may take
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "10"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "5"))
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "600"))
+
+# fine-tuning jobs run in the background and are kept in FINETUNING_JOBS_DIR:
+# uploads wait on disk in FINETUNING_UPLOAD_DIR ("" uses the system temporary
+# directory) until they are moved into their job's directory, and a job's
+# status is polled every FINETUNING_POLL_INTERVAL_SECONDS after it changes,
+# backing off up to FINETUNING_POLL_MAX_INTERVAL_SECONDS while it does not
+FINETUNING_JOBS_DIR = os.getenv("FINETUNING_JOBS_DIR", "finetuning_jobs")
+FINETUNING_UPLOAD_DIR = os.getenv("FINETUNING_UPLOAD_DIR", "")
+FINETUNING_POLL_INTERVAL_SECONDS = float(
+    os.getenv("FINETUNING_POLL_INTERVAL_SECONDS", "10")
+)
+FINETUNING_POLL_MAX_INTERVAL_SECONDS = float(
+    os.getenv("FINETUNING_POLL_MAX_INTERVAL_SECONDS", "300")
+)
+
 
 HUGGINGFACE_ACCESS_TOKEN = os.getenv("HUGGINGFACE_ACCESS_TOKEN")
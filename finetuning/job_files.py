@@ -0,0 +1,71 @@
+"""
+Files of the fine-tuning jobs kept on disk. Each job has its own directory,
+named by the job's id, holding its status (status.json), which every worker
+process of the server can read, and a lock held by the process running it.
+"""
+
+import json
+import os
+import re
+import time
+
+try:
+    import fcntl
+except ImportError:  # not POSIX: jobs cannot be shared between processes
+    fcntl = None
+
+JOB_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+
+def is_job_id(job_id):
+    # Ids name directories, so anything else could point outside of the jobs
+    # directory.
+    return JOB_ID_PATTERN.fullmatch(job_id) is not None
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_json(path, data):
+    # Written to a temporary file first, so readers never see a partial file.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def read_status(job_dir):
+    return read_json(os.path.join(job_dir, "status.json"))
+
+
+def update_status(job_dir, **fields):
+    status = read_status(job_dir)
+    status.update(fields, updated_at=time.time())
+    write_json(os.path.join(job_dir, "status.json"), status)
+    return status
+
+
+def claim(path):
+    """
+    Takes the lock file at `path`, unless another process holds it. The lock
+    is held until it is released or its process exits, so that the jobs of a
+    process that died can be claimed again.
+
+    Returns:
+    - int: The lock, to pass to `release`, or None if it is held elsewhere.
+    """
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    if fcntl is not None:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+    return fd
+
+
+def release(lock):
+    os.close(lock)
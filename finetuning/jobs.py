@@ -0,0 +1,257 @@
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+from config import (
+    FINETUNING_JOBS_DIR,
+    FINETUNING_POLL_INTERVAL_SECONDS,
+    FINETUNING_POLL_MAX_INTERVAL_SECONDS,
+    FINETUNING_UPLOAD_DIR,
+)
+from finetuning.job_files import (
+    claim,
+    is_job_id,
+    read_status,
+    release,
+    update_status,
+    write_json,
+)
+from finetuning.openai import OpenAIClient, OpenAIError
+
+# OpenAI job statuses after which a job no longer changes
+TERMINAL_STATUSES = {"succeeded", "failed", "cancelled"}
+# factor by which the poll interval grows while a job's status is unchanged
+POLL_BACKOFF = 2.0
+
+
+async def save_upload(file):
+    """
+    Copies an uploaded training file to its own file on disk, where it waits
+    until the background job sends it. The copy runs in a worker thread.
+
+    Parameters:
+    - file: The uploaded file object, read from its start.
+
+    Returns:
+    - str: The path of the copy.
+    """
+
+    def copy():
+        fd, path = tempfile.mkstemp(
+            suffix=".jsonl", prefix="finetuning-", dir=FINETUNING_UPLOAD_DIR or None
+        )
+        try:
+            with os.fdopen(fd, "wb") as out:
+                file.seek(0)
+                shutil.copyfileobj(file, out)
+        except Exception:
+            os.remove(path)
+            raise
+        return path
+
+    return await asyncio.get_running_loop().run_in_executor(None, copy)
+
+
+class FineTuningJobManager:
+    """
+    Runs OpenAI fine-tuning jobs in the background: uploads the training
+    file, starts the job and polls it until it finishes, backing off while
+    its status does not change.
+
+    Jobs live in directories under `jobs_dir`, so that every worker process
+    of the server sees them and jobs interrupted by a restart are resumed.
+    A job is run by the one process that holds its lock.
+
+    Job states, in order: "uploading", "creating", then the OpenAI job status
+    ("validating_files", "queued", "running", "succeeded", "failed" or
+    "cancelled"). A job that fails before OpenAI accepts it is "failed" too.
+
+    Parameters:
+    - client (OpenAIClient): The client used to reach OpenAI.
+    - jobs_dir (str): Directory of the job directories.
+    - poll_interval (float): Seconds between the first status polls.
+    - max_poll_interval (float): Longest interval between polls.
+    """
+
+    def __init__(
+        self,
+        client=None,
+        jobs_dir=FINETUNING_JOBS_DIR,
+        poll_interval=FINETUNING_POLL_INTERVAL_SECONDS,
+        max_poll_interval=FINETUNING_POLL_MAX_INTERVAL_SECONDS,
+    ):
+        self.client = client or OpenAIClient()
+        self.jobs_dir = jobs_dir
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self._tasks = {}
+
+    def _job_dir(self, job_id):
+        return os.path.join(self.jobs_dir, job_id)
+
+    def start(self):
+        """
+        Resumes the jobs left unfinished by the last run that no other
+        process is running.
+        """
+
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        for job in self.list():
+            if job["status"] in TERMINAL_STATUSES:
+                continue
+            lock = claim(os.path.join(self._job_dir(job["id"]), "lock"))
+            if lock is not None:
+                logging.info(f"Resuming fine-tuning job {job['id']}")
+                self._start_task(job["id"], lock)
+
+    def _start_task(self, job_id, lock):
+        self._tasks[job_id] = asyncio.create_task(self._run(job_id, lock))
+        self._tasks[job_id].add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    def submit(self, path, model, suffix="", n_epochs="", tokens=None, filename=None):
+        """
+        Starts a fine-tuning job in the background.
+
+        Parameters:
+        - path (str): The training file; it is moved into the job directory
+          and deleted once it is uploaded.
+        - model (str): The model to fine-tune.
+        - suffix (str): Suffix of the fine-tuned model name, if any.
+        - n_epochs (int): Number of training epochs, if set.
+        - tokens (dict): Token counts of the training file, for reference.
+        - filename (str): The name the training file was uploaded with.
+
+        Returns:
+        - dict: The new job's state.
+        """
+
+        job_id = uuid.uuid4().hex
+        job_dir = self._job_dir(job_id)
+        os.makedirs(job_dir)
+        shutil.move(path, os.path.join(job_dir, "train.jsonl"))
+        now = time.time()
+        job = {
+            "id": job_id,
+            "status": "uploading",
+            "model": model,
+            "filename": filename,
+            "suffix": suffix,
+            "n_epochs": n_epochs,
+            "file_id": None,
+            "openai_job_id": None,
+            "fine_tuned_model": None,
+            "trained_tokens": None,
+            "error": None,
+            "tokens": tokens,
+            "created_at": now,
+            "updated_at": now,
+        }
+        write_json(os.path.join(job_dir, "status.json"), job)
+        self._start_task(job_id, claim(os.path.join(job_dir, "lock")))
+        return job
+
+    def get(self, job_id):
+        if not is_job_id(job_id):
+            return None
+        job_dir = self._job_dir(job_id)
+        if not os.path.exists(os.path.join(job_dir, "status.json")):
+            return None
+        return read_status(job_dir)
+
+    def list(self):
+        if not os.path.isdir(self.jobs_dir):
+            return []
+        jobs = [self.get(job_id) for job_id in os.listdir(self.jobs_dir)]
+        return sorted(
+            (job for job in jobs if job is not None),
+            key=lambda job: job["created_at"],
+            reverse=True,
+        )
+
+    def _update(self, job_id, **changes):
+        return update_status(self._job_dir(job_id), **changes)
+
+    async def _run(self, job_id, lock):
+        job_dir = self._job_dir(job_id)
+        path = os.path.join(job_dir, "train.jsonl")
+        try:
+            job = read_status(job_dir)
+            res = None
+            if job["file_id"] is None:
+                logging.info(f"Uploading training file of fine-tuning job {job_id}")
+                file_id = await self.client.upload_file(path, filename=job["filename"])
+                job = self._update(job_id, status="creating", file_id=file_id)
+                os.remove(path)
+            elif job["openai_job_id"] is None:
+                # The last run may have created the job before it stopped.
+                res = await self.client.find_fine_tuning_job(job["file_id"])
+
+            if job["openai_job_id"] is None:
+                if res is None:
+                    res = await self.client.create_fine_tuning_job(
+                        job["file_id"], job["model"], job["suffix"], job["n_epochs"]
+                    )
+                job = self._update(job_id, openai_job_id=res["id"])
+                logging.info(
+                    f"Fine-tuning job {job_id} started as OpenAI job {res['id']}"
+                )
+            else:
+                # Polled again, from its last known status.
+                res = {"status": job["status"]}
+            await self._poll(job, res)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Fine-tuning job {job_id} failed: {str(e)}")
+            self._update(job_id, status="failed", error=str(e))
+            if os.path.exists(path):
+                os.remove(path)
+        finally:
+            release(lock)
+
+    async def _poll(self, job, res):
+        interval = self.poll_interval
+        while True:
+            status = res["status"]
+            changed = status != job["status"]
+            error = res.get("error")
+            job = self._update(
+                job["id"],
+                status=status,
+                fine_tuned_model=res.get("fine_tuned_model"),
+                trained_tokens=res.get("trained_tokens"),
+                error=error.get("message") if isinstance(error, dict) else error,
+            )
+            if status in TERMINAL_STATUSES:
+                logging.info(f"Fine-tuning job {job['id']} {status}")
+                return
+            # Poll quickly again after a change, slower while nothing happens.
+            if changed:
+                interval = self.poll_interval
+            else:
+                interval = min(interval * POLL_BACKOFF, self.max_poll_interval)
+            await asyncio.sleep(interval)
+            try:
+                res = await self.client.retrieve_fine_tuning_job(job["openai_job_id"])
+            except OpenAIError as e:
+                # The job keeps running at OpenAI when the API is unreachable
+                # for a while, so it is polled again later.
+                if e.status is not None and e.status < 500:
+                    raise
+                logging.warning(f"Unable to poll fine-tuning job {job['id']}: {str(e)}")
+                res = {**res, "status": job["status"]}
+
+    async def shutdown(self):
+        """
+        Stops polling, leaving the jobs to resume on the next start, and
+        closes the client's connections.
+        """
+
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        await self.client.close()
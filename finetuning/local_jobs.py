@@ -0,0 +1,277 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+import uuid
+
+from config import (
+    PEFT_ADAPTER_DISCOVERY_SECONDS,
+    PEFT_CHECKPOINT_STEPS,
+    PEFT_GRADIENT_CHECKPOINTING,
+    PEFT_JOBS_DIR,
+    PEFT_LEARNING_RATE,
+    PEFT_LORA_ALPHA,
+    PEFT_LORA_RANK,
+    PEFT_MAX_SEQ_LENGTH,
+    PEFT_MICRO_BATCH_SIZE,
+    PEFT_SEQUENCE_PACKING,
+    PEFT_TRAINING_THREADS,
+)
+from finetuning.job_files import (
+    claim,
+    is_job_id,
+    read_json,
+    read_status,
+    release,
+    update_status,
+    write_json,
+)
+from finetuning.lora_trainer import TERMINAL_STATUSES, run_job
+
+# defaults of the optional training settings of a request
+DEFAULT_BATCH_SIZE = 8
+DEFAULT_PROMPT_LOSS_WEIGHT = 0.01
+# seconds between checks of whether the training process has ended
+PROCESS_POLL_SECONDS = 1.0
+
+
+class LocalFineTuningJobManager:
+    """
+    Runs local LoRA fine-tuning jobs, one at a time, each in its own process
+    so that training cannot starve the serving threads of CPU or the GIL.
+
+    Jobs live in directories under `jobs_dir`; the training process writes
+    its progress there, and its checkpoints, so that jobs interrupted by a
+    restart resume where their last checkpoint left them.
+
+    Every worker process of the server runs a manager on the same directory.
+    A job is run by the worker that holds its lock, one job at a time across
+    all workers, and each worker finds the jobs that succeeded elsewhere by
+    scanning the directory every `discovery_interval` seconds.
+
+    Job states: "queued", "loading", "running", then "succeeded" or "failed".
+    """
+
+    def __init__(
+        self,
+        jobs_dir=PEFT_JOBS_DIR,
+        on_success=None,
+        discovery_interval=PEFT_ADAPTER_DISCOVERY_SECONDS,
+    ):
+        """
+        Parameters:
+        - jobs_dir (str): Directory of the job directories.
+        - on_success (callable): Called once with the status of each succeeded
+          job, including those that succeeded before a restart or in another
+          worker.
+        - discovery_interval (float): Seconds between scans for jobs that
+          succeeded in another worker.
+        """
+
+        self.jobs_dir = jobs_dir
+        self.on_success = on_success
+        self.discovery_interval = discovery_interval
+        self._queue = None
+        self._worker = None
+        self._watcher = None
+        self._process = None
+        self._reported = set()
+
+    def _job_dir(self, job_id):
+        return os.path.join(self.jobs_dir, job_id)
+
+    def _claim(self, job_id):
+        return claim(os.path.join(self._job_dir(job_id), "lock"))
+
+    def start(self):
+        """
+        Starts running jobs, first those left unfinished by the last run.
+        """
+
+        self._queue = asyncio.Queue()
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        for job in sorted(self.list(), key=lambda job: job["created_at"]):
+            if job["status"] == "succeeded":
+                self._succeeded(job)
+            elif job["status"] not in TERMINAL_STATUSES:
+                # A job that another worker runs is left to it.
+                lock = self._claim(job["id"])
+                if lock is None:
+                    continue
+                try:
+                    logging.info(f"Resuming fine-tuning job {job['id']}")
+                    update_status(self._job_dir(job["id"]), status="queued")
+                finally:
+                    release(lock)
+                self._queue.put_nowait(job["id"])
+        self._worker = asyncio.create_task(self._run_jobs())
+        self._watcher = asyncio.create_task(self._discover())
+
+    def submit(self, path, model_name, target_modules, specs, tokens=None):
+        """
+        Queues a fine-tuning job.
+
+        Parameters:
+        - path (str): The training file; it is moved into the job directory.
+        - model_name (str): Full name of the model to fine-tune.
+        - target_modules (list): The layers LoRA adapts.
+        - specs (FineTuningSpecs): The training settings of the request.
+        - tokens (dict): Token counts of the training file, for reference.
+
+        Returns:
+        - dict: The new job's status.
+        """
+
+        job_id = uuid.uuid4().hex
+        job_dir = self._job_dir(job_id)
+        os.makedirs(job_dir)
+        shutil.move(path, os.path.join(job_dir, "train.jsonl"))
+        now = time.time()
+        write_json(
+            os.path.join(job_dir, "spec.json"),
+            {
+                "id": job_id,
+                "model": model_name,
+                "target_modules": target_modules,
+                "epochs": specs.epochs,
+                "batch_size": specs.batch_size or DEFAULT_BATCH_SIZE,
+                "learning_rate": PEFT_LEARNING_RATE
+                * (specs.learning_rate_multiplier or 1.0),
+                "prompt_loss_weight": (
+                    specs.prompt_loss_weight
+                    if specs.prompt_loss_weight is not None
+                    else DEFAULT_PROMPT_LOSS_WEIGHT
+                ),
+                "lora_rank": PEFT_LORA_RANK,
+                "lora_alpha": PEFT_LORA_ALPHA,
+                "max_seq_length": PEFT_MAX_SEQ_LENGTH,
+                "micro_batch_size": PEFT_MICRO_BATCH_SIZE,
+                "packing": PEFT_SEQUENCE_PACKING,
+                "gradient_checkpointing": PEFT_GRADIENT_CHECKPOINTING,
+                "checkpoint_steps": PEFT_CHECKPOINT_STEPS,
+            },
+        )
+        write_json(
+            os.path.join(job_dir, "status.json"),
+            {
+                "id": job_id,
+                "model": model_name,
+                "adapter_name": f"ft-{job_id[:8]}",
+                "status": "queued",
+                "tokens": tokens,
+                "created_at": now,
+                "updated_at": now,
+            },
+        )
+        self._queue.put_nowait(job_id)
+        return read_status(job_dir)
+
+    def get(self, job_id):
+        if not is_job_id(job_id):
+            return None
+        job_dir = self._job_dir(job_id)
+        if not os.path.exists(os.path.join(job_dir, "status.json")):
+            return None
+        return {**read_json(os.path.join(job_dir, "spec.json")), **read_status(job_dir)}
+
+    def list(self):
+        if not os.path.isdir(self.jobs_dir):
+            return []
+        jobs = [self.get(job_id) for job_id in os.listdir(self.jobs_dir)]
+        return sorted(
+            (job for job in jobs if job is not None),
+            key=lambda job: job["created_at"],
+            reverse=True,
+        )
+
+    async def _run_jobs(self):
+        while True:
+            job_id = await self._queue.get()
+            lock = self._claim(job_id)
+            if lock is None:
+                # Another worker queued the job too and runs it.
+                continue
+            try:
+                if read_status(self._job_dir(job_id))["status"] in TERMINAL_STATUSES:
+                    continue
+                runner = await self._claim_runner()
+                try:
+                    await self._run(job_id)
+                finally:
+                    release(runner)
+            except Exception as e:
+                logging.error(f"Fine-tuning job {job_id} failed: {str(e)}")
+                update_status(self._job_dir(job_id), status="failed", error=str(e))
+            finally:
+                release(lock)
+
+    async def _claim_runner(self):
+        # One job trains at a time across the workers.
+        while True:
+            runner = claim(os.path.join(self.jobs_dir, "runner.lock"))
+            if runner is not None:
+                return runner
+            await asyncio.sleep(PROCESS_POLL_SECONDS)
+
+    async def _discover(self):
+        while True:
+            await asyncio.sleep(self.discovery_interval)
+            try:
+                jobs = await asyncio.to_thread(self.list)
+            except OSError as e:
+                logging.warning(f"Unable to scan fine-tuning jobs: {str(e)}")
+                continue
+            for job in jobs:
+                if job["status"] == "succeeded" and job["id"] not in self._reported:
+                    self._succeeded(job)
+
+    async def _run(self, job_id):
+        job_dir = self._job_dir(job_id)
+        context = multiprocessing.get_context("spawn")
+        process = context.Process(
+            target=run_job, args=(job_dir, PEFT_TRAINING_THREADS), daemon=True
+        )
+        logging.info(f"Starting fine-tuning job {job_id}")
+        process.start()
+        # On shutdown this task is cancelled while waiting and the process is
+        # terminated, leaving the job to resume on the next start.
+        self._process = process
+        while process.is_alive():
+            await asyncio.sleep(PROCESS_POLL_SECONDS)
+        self._process = None
+        process.join()
+
+        job = read_status(job_dir)
+        if job["status"] not in TERMINAL_STATUSES:
+            job = update_status(
+                job_dir,
+                status="failed",
+                error=f"Training process exited with code {process.exitcode}",
+            )
+        logging.info(f"Fine-tuning job {job_id} {job['status']}")
+        if job["status"] == "succeeded":
+            self._succeeded(job)
+
+    def _succeeded(self, job):
+        self._reported.add(job["id"])
+        if self.on_success is not None:
+            try:
+                self.on_success(job)
+            except Exception as e:
+                logging.error(f"Unable to register adapter of job {job['id']}: {e}")
+
+    async def shutdown(self):
+        """
+        Stops the running job; it resumes from its last checkpoint on the
+        next start.
+        """
+
+        if self._worker is not None:
+            self._worker.cancel()
+        if self._watcher is not None:
+            self._watcher.cancel()
+        if self._process is not None and self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
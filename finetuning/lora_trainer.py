@@ -0,0 +1,530 @@
+"""
+Local LoRA fine-tuning of a served model, run in its own process by
+LocalFineTuningJobManager.
+
+Training examples are the chat conversations of the uploaded file, rendered
+with the model's prompt template exactly as /api/chat_gpu renders requests,
+so the adapter learns the format it is served with. The last assistant
+message of each conversation is the answer; prompt tokens count towards the
+loss with `prompt_loss_weight`.
+
+To fit the batch size in limited memory:
+- examples are packed into sequences of up to `max_seq_length` tokens, so
+  that little compute is spent on padding, with a block-diagonal causal
+  attention mask that keeps each example from attending to the others;
+- with gradient checkpointing, activations are recomputed in the backward
+  pass instead of being kept;
+- the batch is split into micro-batches whose gradients are accumulated;
+- the vocabulary projection is only computed for tokens in the loss.
+
+The job directory holds the job's settings (spec.json), its training data,
+its progress (status.json), its latest checkpoint and, once done, the
+trained adapter in the PEFT format.
+"""
+
+import bisect
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import time
+
+import torch
+import torch.nn.functional as F
+from safetensors.torch import save_file
+
+from config import CACHE_DIR
+from finetuning.job_files import read_json, update_status, write_json
+from inference.lora import inject_lora
+from inference.prompt_builder import create_prompt_builder
+from load_models.model_list import models
+from load_models.model_loader import load_model
+from models import ChatMessage
+
+TERMINAL_STATUSES = {"succeeded", "failed"}
+ADAPTER_NAME = "default"
+MAX_GRAD_NORM = 1.0
+
+
+def conversation_parts(messages):
+    """
+    Splits a chat conversation into the arguments of PromptBuilder.build and
+    the answer to train on: the last assistant message.
+
+    Returns:
+    - tuple: (base_prompt, chat_history, question, answer), or None if the
+      conversation has no assistant message.
+    """
+
+    last = max(
+        (i for i, message in enumerate(messages) if message["role"] == "assistant"),
+        default=None,
+    )
+    if last is None:
+        return None
+
+    system = []
+    turns = []
+    question = []
+    for message in messages[:last]:
+        if message["role"] == "system":
+            system.append(message["content"])
+        elif message["role"] == "user":
+            question.append(message["content"])
+        elif question:
+            turns.append(
+                ChatMessage(question="\n".join(question), answer=message["content"])
+            )
+            question = []
+    return "\n".join(system), turns, "\n".join(question), messages[last]["content"]
+
+
+def build_examples(path, tokenizer, prompt_builder, prompt_loss_weight):
+    """
+    Tokenizes the conversations of a training file.
+
+    Returns:
+    - list: (token ids, loss weight of each token) of every example.
+    """
+
+    examples = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            parts = conversation_parts(json.loads(line)["messages"])
+            if parts is None:
+                continue
+            base_prompt, chat_history, question, answer = parts
+            if prompt_builder is not None:
+                prompt, _ = prompt_builder.build(
+                    base_prompt, question, chat_history, ""
+                )
+            else:
+                prompt = question
+            prompt_ids = tokenizer(prompt)["input_ids"]
+            answer_ids = tokenizer(answer, add_special_tokens=False)["input_ids"]
+            answer_ids.append(tokenizer.eos_token_id)
+            examples.append(
+                (
+                    prompt_ids + answer_ids,
+                    [prompt_loss_weight] * len(prompt_ids) + [1.0] * len(answer_ids),
+                )
+            )
+    return examples
+
+
+def pack_examples(lengths, max_seq_length):
+    """
+    Packs examples into sequences of at most `max_seq_length` tokens, longest
+    first, each into the fullest sequence it still fits in (best fit
+    decreasing). Longer examples get a sequence of their own.
+
+    Returns:
+    - list: The example indices of each sequence.
+    """
+
+    sequences = []
+    # (free tokens, sequence index), sorted
+    free = []
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        length = min(lengths[i], max_seq_length)
+        position = bisect.bisect_left(free, (length, -1))
+        if position < len(free):
+            space, sequence = free.pop(position)
+        else:
+            space, sequence = max_seq_length, len(sequences)
+            sequences.append([])
+        sequences[sequence].append(i)
+        if space - length > 0:
+            bisect.insort(free, (space - length, sequence))
+    return sequences
+
+
+def collate(sequences, examples, max_seq_length, pad_token_id):
+    """
+    Builds a right-padded batch of packed sequences. Positions restart at 0
+    for each example of a sequence, and the first token of an example is not
+    predicted from the example before it.
+
+    Returns:
+    - dict: input_ids, attention_mask, position_ids, loss weights and the
+      example of each token within its sequence (-1 for padding).
+    """
+
+    rows = []
+    for sequence in sequences:
+        input_ids, positions, weights, segments = [], [], [], []
+        for segment, i in enumerate(sequence):
+            ids, example_weights = examples[i]
+            ids = ids[:max_seq_length]
+            input_ids += ids
+            positions += range(len(ids))
+            weights += [0.0] + example_weights[1 : len(ids)]
+            segments += [segment] * len(ids)
+        rows.append((input_ids, positions, weights, segments))
+
+    length = max(len(input_ids) for input_ids, _, _, _ in rows)
+    batch = {
+        "input_ids": torch.full((len(rows), length), pad_token_id),
+        "attention_mask": torch.zeros((len(rows), length), dtype=torch.long),
+        "position_ids": torch.zeros((len(rows), length), dtype=torch.long),
+        "weights": torch.zeros((len(rows), length)),
+        "segments": torch.full((len(rows), length), -1),
+    }
+    for row, (input_ids, positions, weights, segments) in enumerate(rows):
+        batch["input_ids"][row, : len(input_ids)] = torch.tensor(input_ids)
+        batch["attention_mask"][row, : len(input_ids)] = 1
+        batch["position_ids"][row, : len(input_ids)] = torch.tensor(positions)
+        batch["weights"][row, : len(input_ids)] = torch.tensor(weights)
+        batch["segments"][row, : len(input_ids)] = torch.tensor(segments)
+    return batch
+
+
+def block_causal_mask(segments, dtype):
+    """
+    Builds the additive 4D attention mask of packed sequences: a token attends
+    to the tokens before it of its own example only.
+
+    Parameters:
+    - segments (torch.Tensor): The example of each token, -1 for padding.
+    - dtype (torch.dtype): The dtype of the attention scores.
+
+    Returns:
+    - torch.Tensor: The [batch, 1, length, length] mask.
+    """
+
+    length = segments.shape[1]
+    causal = torch.ones(length, length, dtype=torch.bool, device=segments.device)
+    allowed = (
+        (segments[:, :, None] == segments[:, None, :])
+        & (segments[:, None, :] >= 0)
+        & causal.tril()
+    )
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=segments.device)
+    mask.masked_fill_(~allowed, torch.finfo(dtype).min)
+    return mask[:, None]
+
+
+def allow_block_masks(model):
+    """
+    Lets the model take the 4D masks of `block_causal_mask`. transformers 4.34
+    builds the causal mask of its decoders from a 2D padding mask, so a 4D
+    mask is passed through instead.
+
+    Returns:
+    - bool: False if the model's decoder does not build its mask this way.
+    """
+
+    decoder = model.base_model
+    prepare = getattr(decoder, "_prepare_decoder_attention_mask", None)
+    if prepare is None:
+        return False
+
+    def prepare_mask(attention_mask, *args, **kwargs):
+        if attention_mask.dim() == 4:
+            return attention_mask
+        return prepare(attention_mask, *args, **kwargs)
+
+    decoder._prepare_decoder_attention_mask = prepare_mask
+    return True
+
+
+def batch_loss(model, batch, packed=False):
+    """
+    Weighted sum of the next-token losses of a batch. Logits are only
+    computed for the tokens in the loss, which saves the memory of a full
+    [batch, length, vocabulary] tensor.
+    """
+
+    device = model.device
+    attention_mask = batch["attention_mask"].to(device)
+    if packed:
+        attention_mask = block_causal_mask(batch["segments"].to(device), model.dtype)
+    hidden = model.base_model(
+        input_ids=batch["input_ids"].to(device),
+        attention_mask=attention_mask,
+        position_ids=batch["position_ids"].to(device),
+    )[0]
+    # the token at position t + 1 is predicted at position t
+    weights = batch["weights"][:, 1:].to(device)
+    targets = batch["input_ids"][:, 1:].to(device)
+    selected = weights > 0
+    logits = model.get_output_embeddings()(hidden[:, :-1][selected])
+    losses = F.cross_entropy(logits.float(), targets[selected], reduction="none")
+    return (losses * weights[selected]).sum()
+
+
+def save_adapter(directory, layers, spec):
+    """
+    Saves the trained LoRA weights in the PEFT format, which AdapterManager
+    serves.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    weights = {}
+    for path, layer in layers.items():
+        lora_a, lora_b, _ = layer.adapters[ADAPTER_NAME]
+        weights[f"base_model.model.{path}.lora_A.weight"] = lora_a.detach().cpu()
+        weights[f"base_model.model.{path}.lora_B.weight"] = lora_b.detach().cpu()
+    save_file(weights, os.path.join(directory, "adapter_model.safetensors"))
+    write_json(
+        os.path.join(directory, "adapter_config.json"),
+        {
+            "peft_type": "LORA",
+            "task_type": "CAUSAL_LM",
+            "base_model_name_or_path": spec["model"],
+            "r": spec["lora_rank"],
+            "lora_alpha": spec["lora_alpha"],
+            "lora_dropout": 0.0,
+            "target_modules": spec["target_modules"],
+            "fan_in_fan_out": False,
+            "bias": "none",
+        },
+    )
+
+
+def save_checkpoint(job_dir, layers, spec, state):
+    # Replaces the previous checkpoint only once the new one is complete.
+    tmp_dir = os.path.join(job_dir, "checkpoint.tmp")
+    checkpoint_dir = os.path.join(job_dir, "checkpoint")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    save_adapter(tmp_dir, layers, spec)
+    torch.save(state, os.path.join(tmp_dir, "trainer_state.pt"))
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    os.replace(tmp_dir, checkpoint_dir)
+
+
+def add_lora(model, spec):
+    # Wraps the target layers and gives them one trainable adapter, with
+    # lora_B zero so that training starts from the base model.
+    layers = inject_lora(model, spec["target_modules"])
+    if not layers:
+        raise ValueError("The model has none of the LoRA target layers")
+    torch.manual_seed(0)
+    scaling = spec["lora_alpha"] / spec["lora_rank"]
+    parameters = []
+    for layer in layers.values():
+        lora_a = torch.empty(
+            spec["lora_rank"], layer.in_features, device=layer.weight_device
+        )
+        torch.nn.init.kaiming_uniform_(lora_a, a=math.sqrt(5))
+        lora_b = torch.zeros(
+            layer.out_features, spec["lora_rank"], device=layer.weight_device
+        )
+        lora_a = torch.nn.Parameter(lora_a)
+        lora_b = torch.nn.Parameter(lora_b)
+        layer.adapters[ADAPTER_NAME] = (lora_a, lora_b, scaling)
+        layer.default_adapter = ADAPTER_NAME
+        parameters += [lora_a, lora_b]
+    return layers, parameters
+
+
+def train(job_dir, cache_dir=CACHE_DIR):
+    """
+    Trains a LoRA adapter for the job in `job_dir`, resuming from its latest
+    checkpoint if there is one. Progress is written to status.json.
+
+    Parameters:
+    - job_dir (str): The job directory.
+    - cache_dir (str): Directory of the cached models.
+    """
+
+    spec = read_json(os.path.join(job_dir, "spec.json"))
+    model_config = next(
+        config for config in models.values() if config["name"] == spec["model"]
+    )
+    update_status(job_dir, status="loading")
+
+    model, tokenizer = load_model(
+        spec["model"],
+        model_config["require_auth"],
+        model_config["trust_remote_code"],
+        cache_dir=cache_dir,
+        quantization="none",
+    )
+    if model is None:
+        raise RuntimeError(f"Unable to load model {spec['model']}")
+    for parameter in model.parameters():
+        parameter.requires_grad_(False)
+    layers, parameters = add_lora(model, spec)
+    model.config.use_cache = False
+    if spec["gradient_checkpointing"]:
+        model.gradient_checkpointing_enable()
+        # the frozen embeddings would otherwise cut the gradient path through
+        # the recomputed layers
+        model.enable_input_require_grads()
+    model.train()
+
+    prompt_builder = create_prompt_builder(
+        tokenizer,
+        model,
+        model_config,
+        model_config["generation_config"].get("max_new_tokens"),
+    )
+    examples = build_examples(
+        os.path.join(job_dir, "train.jsonl"),
+        tokenizer,
+        prompt_builder,
+        spec["prompt_loss_weight"],
+    )
+    if not examples:
+        raise ValueError("The training file has no conversation to train on")
+    lengths = [len(ids) for ids, _ in examples]
+    packing = spec["packing"]
+    if packing and not allow_block_masks(model):
+        # Packed examples would attend to each other.
+        logging.warning(
+            f"Sequence packing is not supported for {spec['model']}, "
+            "training on one example per sequence"
+        )
+        packing = False
+    if packing:
+        sequences = pack_examples(lengths, spec["max_seq_length"])
+    else:
+        sequences = [[i] for i in range(len(examples))]
+    real_tokens = sum(min(length, spec["max_seq_length"]) for length in lengths)
+
+    batch_size = spec["batch_size"]
+    steps_per_epoch = math.ceil(len(sequences) / batch_size)
+    total_steps = steps_per_epoch * spec["epochs"]
+    optimizer = torch.optim.AdamW(parameters, lr=spec["learning_rate"])
+    scheduler = torch.optim.lr_scheduler.LambdaLR(
+        optimizer, lambda step: 1 - step / total_steps
+    )
+    pad_token_id = (
+        tokenizer.pad_token_id
+        if tokenizer.pad_token_id is not None
+        else tokenizer.eos_token_id
+    )
+
+    step = 0
+    trained_tokens = 0
+    checkpoint_path = os.path.join(job_dir, "checkpoint", "trainer_state.pt")
+    if os.path.exists(checkpoint_path):
+        state = torch.load(checkpoint_path)
+        with torch.no_grad():
+            for parameter, value in zip(parameters, state["parameters"]):
+                parameter.copy_(value)
+        optimizer.load_state_dict(state["optimizer"])
+        scheduler.load_state_dict(state["scheduler"])
+        step = state["step"]
+        trained_tokens = state["trained_tokens"]
+        logging.info(f"Resumed from the checkpoint at step {step}")
+
+    def checkpoint():
+        save_checkpoint(
+            job_dir,
+            layers,
+            spec,
+            {
+                "parameters": [parameter.detach() for parameter in parameters],
+                "optimizer": optimizer.state_dict(),
+                "scheduler": scheduler.state_dict(),
+                "step": step,
+                "trained_tokens": trained_tokens,
+            },
+        )
+        update_status(job_dir, checkpoint_step=step)
+
+    update_status(
+        job_dir,
+        status="running",
+        examples=len(examples),
+        sequences=len(sequences),
+        packing_efficiency=real_tokens / (len(sequences) * spec["max_seq_length"])
+        if packing
+        else None,
+        step=step,
+        total_steps=total_steps,
+        resumed_from=step or None,
+    )
+    start = time.perf_counter()
+    run_tokens = 0
+    while step < total_steps:
+        epoch, epoch_step = divmod(step, steps_per_epoch)
+        # The same order in every run of an epoch, so a resumed job continues
+        # where it stopped.
+        order = list(range(len(sequences)))
+        random.Random(epoch).shuffle(order)
+        step_sequences = order[epoch_step * batch_size : (epoch_step + 1) * batch_size]
+
+        micro_batches = [
+            collate(
+                [
+                    sequences[i]
+                    for i in step_sequences[j : j + spec["micro_batch_size"]]
+                ],
+                examples,
+                spec["max_seq_length"],
+                pad_token_id,
+            )
+            for j in range(0, len(step_sequences), spec["micro_batch_size"])
+        ]
+        # The loss is normalized over the whole step, so accumulating the
+        # micro-batch gradients gives the gradient of the full batch.
+        total_weight = sum(
+            float(batch["weights"][:, 1:].sum()) for batch in micro_batches
+        )
+        optimizer.zero_grad()
+        step_loss = 0.0
+        for batch in micro_batches:
+            loss = batch_loss(model, batch, packing) / max(total_weight, 1e-8)
+            loss.backward()
+            step_loss += loss.item()
+            run_tokens += int(batch["attention_mask"].sum())
+        torch.nn.utils.clip_grad_norm_(parameters, MAX_GRAD_NORM)
+        optimizer.step()
+        scheduler.step()
+        step += 1
+        trained_tokens += sum(
+            int(batch["attention_mask"].sum()) for batch in micro_batches
+        )
+
+        elapsed = time.perf_counter() - start
+        update_status(
+            job_dir,
+            step=step,
+            epoch=step / steps_per_epoch,
+            progress=step / total_steps,
+            loss=step_loss,
+            learning_rate=scheduler.get_last_lr()[0],
+            trained_tokens=trained_tokens,
+            tokens_per_second=run_tokens / elapsed,
+            elapsed=elapsed,
+        )
+        if step % spec["checkpoint_steps"] == 0 and step < total_steps:
+            checkpoint()
+
+    adapter_dir = os.path.join(job_dir, "adapter")
+    save_adapter(adapter_dir, layers, spec)
+    shutil.rmtree(os.path.join(job_dir, "checkpoint"), ignore_errors=True)
+    update_status(
+        job_dir,
+        status="succeeded",
+        adapter_path=os.path.abspath(adapter_dir),
+        finished_at=time.time(),
+    )
+
+
+def run_job(job_dir, num_threads):
+    """
+    Entry point of the training process.
+    """
+
+    logging.basicConfig(
+        filename=os.path.join(job_dir, "train.log"),
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+    )
+    # Training yields the CPU to the serving process.
+    if hasattr(os, "nice"):
+        os.nice(10)
+    torch.set_num_threads(num_threads)
+    try:
+        train(job_dir)
+    except Exception as e:
+        logging.exception("Training failed")
+        update_status(job_dir, status="failed", error=str(e), finished_at=time.time())
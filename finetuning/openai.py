@@ -1,28 +1,261 @@
+import asyncio
 import logging
-from openai import File, FineTuningJob
+import os
+import random
 
+import aiohttp
 
-async def upload_training_file(file_content):
-    try:
-        logging.info("sending data to OpenAI...")
-        res = File.create(file=file_content, purpose="fine-tune")
+from config import (
+    OPENAI_API_BASE,
+    OPENAI_API_KEY,
+    OPENAI_MAX_CONNECTIONS,
+    OPENAI_MAX_RETRIES,
+    OPENAI_TIMEOUT_SECONDS,
+)
+
+# HTTP statuses worth retrying: rate limits and server errors
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+# statuses of requests the API turned away without acting on them, which are
+# safe to send again even when they are not idempotent
+REJECTED_STATUSES = {429}
+# methods whose requests may be sent twice with the effect of one
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE"}
+# fine-tuning jobs listed when looking for one whose creation may have failed
+JOB_LOOKUP_LIMIT = 100
+# seconds before the first retry; doubled on each further retry
+RETRY_BASE_SECONDS = 1.0
+RETRY_MAX_SECONDS = 60.0
+
+
+class OpenAIError(Exception):
+    """
+    A request to the OpenAI API failed, after any retries. It is `ambiguous`
+    when the request was not idempotent and may have been carried out anyway,
+    e.g. when the response timed out.
+    """
+
+    def __init__(self, message, status=None, ambiguous=False):
+        super().__init__(message)
+        self.status = status
+        self.ambiguous = ambiguous
+
+
+class OpenAIClient:
+    """
+    Async client for the OpenAI files and fine-tuning API. Requests share one
+    pool of keep-alive connections and are retried with exponential backoff on
+    connection errors, rate limits and server errors. Requests that are not
+    idempotent are only retried when they cannot have been carried out: when
+    the connection failed or the API rate limited them.
+
+    Parameters:
+    - api_key (str): The OpenAI API key.
+    - base_url (str): The API base URL; point it at a local stub to test.
+    - max_connections (int): Connections kept open to the API.
+    - max_retries (int): Retries of a failed request before giving up.
+    - timeout (float): Seconds a request, including an upload, may take.
+    """
+
+    def __init__(
+        self,
+        api_key=OPENAI_API_KEY,
+        base_url=OPENAI_API_BASE,
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_retries=OPENAI_MAX_RETRIES,
+        timeout=OPENAI_TIMEOUT_SECONDS,
+    ):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self._session = None
+
+    def _get_session(self):
+        # Created on first use, inside the running event loop.
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"Authorization": f"Bearer {self.api_key}"},
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def request(self, method, path, json=None, data=None, idempotent=None):
+        """
+        Sends a request to the API and returns its JSON body.
+
+        Parameters:
+        - method (str): The HTTP method.
+        - path (str): The path below the base URL, e.g. "/files".
+        - json (dict): The JSON body, if any.
+        - data (callable): Returns the request body, if any. It is called once
+          per attempt, since a streamed body can only be sent once.
+        - idempotent (bool): Whether the request may be sent again after a
+          timeout or server error; defaults to whether its method is.
+
+        Returns:
+        - dict: The response body.
+
+        Raises:
+        - OpenAIError: If the request failed and cannot be retried, or its
+          retries ran out.
+        """
+
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        url = f"{self.base_url}{path}"
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                async with self._get_session().request(
+                    method,
+                    url,
+                    json=json,
+                    data=data() if data is not None else None,
+                ) as response:
+                    if response.status < 400:
+                        return await response.json()
+                    message = await response.text()
+                    rejected = response.status in REJECTED_STATUSES
+                    error = OpenAIError(
+                        f"{method} {path} failed with status "
+                        f"{response.status}: {message}",
+                        status=response.status,
+                        ambiguous=not idempotent
+                        and not rejected
+                        and response.status in RETRY_STATUSES,
+                    )
+                    retry = response.status in RETRY_STATUSES and (
+                        idempotent or rejected
+                    )
+                    retry_after = response.headers.get("Retry-After")
+            except aiohttp.ClientConnectorError as e:
+                # The connection could not be opened, so nothing was sent.
+                error = OpenAIError(f"{method} {path} failed: {str(e)}")
+                retry = True
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = OpenAIError(
+                    f"{method} {path} failed: {str(e)}", ambiguous=not idempotent
+                )
+                retry = idempotent
+            if not retry or attempt == self.max_retries:
+                raise error
+            logging.warning(f"{error}, retrying ({attempt + 1}/{self.max_retries})")
+            await asyncio.sleep(self._retry_delay(attempt, retry_after))
+
+    def _retry_delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), RETRY_MAX_SECONDS)
+            except ValueError:
+                pass
+        delay = min(RETRY_BASE_SECONDS * 2**attempt, RETRY_MAX_SECONDS)
+        # jitter keeps retries of concurrent jobs apart
+        return delay * random.uniform(0.5, 1.0)
+
+    async def upload_file(self, path, purpose="fine-tune", filename=None):
+        """
+        Uploads a file, streaming it from disk. An upload that fails after it
+        may have reached the API is not sent again, so that the file is not
+        stored twice.
+
+        Parameters:
+        - path (str): The path of the file.
+        - purpose (str): The purpose of the file for OpenAI.
+        - filename (str): The name sent for the file; defaults to its own.
+
+        Returns:
+        - str: The id of the uploaded file.
+        """
+
+        files = []
+
+        def form():
+            # The file is opened again on each attempt and read in chunks
+            # while it is sent.
+            for opened in files:
+                opened.close()
+            files.append(open(path, "rb"))
+            data = aiohttp.FormData()
+            data.add_field("purpose", purpose)
+            data.add_field(
+                "file",
+                files[-1],
+                filename=filename or os.path.basename(path),
+                content_type="application/jsonl",
+            )
+            return data
+
+        try:
+            res = await self.request("POST", "/files", data=form)
+        finally:
+            for opened in files:
+                opened.close()
         return res["id"]
-    except Exception as e:
-        raise ValueError(f"An error occurred: {str(e)}")
 
+    async def create_fine_tuning_job(self, file_id, model, suffix="", n_epochs=""):
+        """
+        Starts a fine-tuning job.
+
+        Parameters:
+        - file_id (str): The id of the uploaded training file.
+        - model (str): The model to fine-tune.
+        - suffix (str): Suffix of the fine-tuned model name, if any.
+        - n_epochs (int): Number of training epochs, if set.
+
+        Returns:
+        - dict: The fine-tuning job.
+        """
 
-async def fine_tune_openai_model(file_id, fine_tuning_model, suffix, n_epochs):
-    try:
         parameters = {
             "training_file": file_id,
-            "model": fine_tuning_model,
+            "model": model,
         }
-        if suffix != "":
+        if suffix:
             parameters["suffix"] = suffix
-        if n_epochs != "":
+        if n_epochs != "" and n_epochs is not None:
             parameters["hyperparameters"] = {"n_epochs": n_epochs}
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self.request("POST", "/fine_tuning/jobs", json=parameters)
+            except OpenAIError as e:
+                if not e.ambiguous or attempt == self.max_retries:
+                    raise
+                logging.warning(f"{str(e)}, looking for the job before retrying")
+            await asyncio.sleep(self._retry_delay(attempt))
+            # The job may have been created although its response was lost.
+            job = await self.find_fine_tuning_job(file_id)
+            if job is not None:
+                return job
+
+    async def list_fine_tuning_jobs(self, limit=JOB_LOOKUP_LIMIT):
+        """
+        Returns the most recent fine-tuning jobs, newest first.
+        """
+
+        res = await self.request("GET", f"/fine_tuning/jobs?limit={limit}")
+        return res["data"]
+
+    async def find_fine_tuning_job(self, file_id):
+        """
+        Looks for a recent fine-tuning job of a training file. Each file is
+        uploaded for one job, so a job found is that job.
+
+        Parameters:
+        - file_id (str): The id of the training file.
+
+        Returns:
+        - dict: The fine-tuning job, or None if there is none.
+        """
+
+        jobs = await self.list_fine_tuning_jobs()
+        return next((job for job in jobs if job["training_file"] == file_id), None)
 
-        res = FineTuningJob.create(**parameters)
-        return res["fine_tuned_model"]
-    except Exception as e:
-        raise ValueError(f"An error occurred: {str(e)}")
+    async def retrieve_fine_tuning_job(self, job_id):
+        return await self.request("GET", f"/fine_tuning/jobs/{job_id}")
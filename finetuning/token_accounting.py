@@ -0,0 +1,211 @@
+import os
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from config import (
+    FINETUNING_PRICE_PER_1K_TOKENS,
+    FINETUNING_TOKEN_CACHE_SIZE,
+    FINETUNING_TOKEN_THREADS,
+)
+
+MAX_TOKENS_PER_EXAMPLE = 4096
+
+# OpenAI's defaults for choosing the number of epochs from the dataset size
+TARGET_EPOCHS = 3
+MIN_TARGET_EXAMPLES = 100
+MAX_TARGET_EXAMPLES = 25000
+MIN_DEFAULT_EPOCHS = 1
+MAX_DEFAULT_EPOCHS = 25
+
+
+class TokenCounter:
+    """
+    Counts the tokens of many strings at once.
+
+    Strings whose count is not memoized are deduplicated and split into one
+    slice per thread; tiktoken releases the GIL while encoding, so the slices
+    are encoded in parallel. Counts are kept in an LRU, so strings that
+    repeat across examples, like system prompts, are encoded once.
+
+    Text is encoded as ordinary text: special tokens such as "<|endoftext|>"
+    written in the data are counted like any other text instead of raising.
+    """
+
+    def __init__(
+        self,
+        encoding,
+        cache_size=FINETUNING_TOKEN_CACHE_SIZE,
+        num_threads=FINETUNING_TOKEN_THREADS,
+    ):
+        """
+        Parameters:
+        - encoding (tiktoken.Encoding): The encoding to count tokens with.
+        - cache_size (int): Number of distinct strings whose count is kept.
+        - num_threads (int): Encoder threads, at most one per CPU.
+        """
+
+        self.encoding = encoding
+        self.cache_size = cache_size
+        self.num_threads = max(1, min(num_threads, os.cpu_count() or 1))
+        self._pool = (
+            ThreadPoolExecutor(max_workers=self.num_threads)
+            if self.num_threads > 1
+            else None
+        )
+        self._counts = OrderedDict()
+        self._lock = Lock()
+
+    def _encode_lengths(self, texts):
+        encode = self.encoding.encode_ordinary
+
+        def lengths(part):
+            return [len(encode(text)) for text in part]
+
+        if self._pool is None or len(texts) < 2 * self.num_threads:
+            return lengths(texts)
+        size = -(-len(texts) // self.num_threads)
+        parts = [texts[i : i + size] for i in range(0, len(texts), size)]
+        return [n for part in self._pool.map(lengths, parts) for n in part]
+
+    def count_many(self, texts):
+        """
+        Parameters:
+        - texts (list): The strings to count.
+
+        Returns:
+        - list: The number of tokens of each string.
+        """
+
+        counts = [0] * len(texts)
+        missing = {}
+        with self._lock:
+            for i, text in enumerate(texts):
+                count = self._counts.get(text)
+                if count is None:
+                    missing.setdefault(text, []).append(i)
+                else:
+                    self._counts.move_to_end(text)
+                    counts[i] = count
+        if not missing:
+            return counts
+
+        unique = list(missing)
+        lengths = self._encode_lengths(unique)
+        with self._lock:
+            for text, count in zip(unique, lengths):
+                for i in missing[text]:
+                    counts[i] = count
+                self._counts[text] = count
+            while len(self._counts) > self.cache_size:
+                self._counts.popitem(last=False)
+        return counts
+
+    def count_examples(self, examples, tokens_per_message=3, tokens_per_name=1):
+        """
+        Counts the tokens of chat examples the way OpenAI bills them.
+
+        Parameters:
+        - examples (list): The `messages` list of each example.
+
+        Returns:
+        - list: (num_tokens, num_assistant_tokens) for each example.
+        """
+
+        texts = [
+            value
+            for messages in examples
+            for message in messages
+            for value in message.values()
+        ]
+        counts = iter(self.count_many(texts))
+
+        results = []
+        for messages in examples:
+            num_tokens = 3
+            num_assistant_tokens = 0
+            for message in messages:
+                num_tokens += tokens_per_message
+                for key in message:
+                    count = next(counts)
+                    num_tokens += count
+                    if key == "name":
+                        num_tokens += tokens_per_name
+                    elif key == "content" and message["role"] == "assistant":
+                        num_assistant_tokens += count
+            results.append((num_tokens, num_assistant_tokens))
+        return results
+
+
+def estimate_epochs(num_examples):
+    """Returns the number of epochs OpenAI picks by default for a dataset."""
+
+    n_epochs = TARGET_EPOCHS
+    if num_examples and num_examples * TARGET_EPOCHS < MIN_TARGET_EXAMPLES:
+        n_epochs = min(MAX_DEFAULT_EPOCHS, MIN_TARGET_EXAMPLES // num_examples)
+    elif num_examples * TARGET_EPOCHS > MAX_TARGET_EXAMPLES:
+        n_epochs = max(MIN_DEFAULT_EPOCHS, MAX_TARGET_EXAMPLES // num_examples)
+    return n_epochs
+
+
+def _distribution(values):
+    if not values:
+        return None
+    values = sorted(values)
+    n = len(values)
+    return {
+        "min": values[0],
+        "max": values[-1],
+        "mean": sum(values) / n,
+        "median": values[n // 2],
+        "p5": values[int(0.05 * n)],
+        "p95": values[min(n - 1, int(0.95 * n))],
+    }
+
+
+class DatasetTokenStats:
+    """
+    Collects the token counts of a fine-tuning dataset, one example at a time,
+    and reports their distribution and the expected training cost.
+    """
+
+    def __init__(self, price_per_1k_tokens=FINETUNING_PRICE_PER_1K_TOKENS):
+        self.price_per_1k_tokens = price_per_1k_tokens
+        self.num_tokens = array("l")
+        self.num_assistant_tokens = array("l")
+        self.num_messages = array("l")
+
+    def add(self, num_tokens, num_assistant_tokens, num_messages):
+        self.num_tokens.append(num_tokens)
+        self.num_assistant_tokens.append(num_assistant_tokens)
+        self.num_messages.append(num_messages)
+
+    def report(self, n_epochs=None):
+        """
+        Parameters:
+        - n_epochs (int): Epochs requested for training; None uses OpenAI's
+          default for the dataset size.
+
+        Returns:
+        - dict: Distributions of tokens, assistant tokens and messages per
+          example, the number of examples over MAX_TOKENS_PER_EXAMPLE (which
+          are truncated in training), the billable tokens per epoch and the
+          estimated tokens and cost of the whole job.
+        """
+
+        num_examples = len(self.num_tokens)
+        n_epochs = n_epochs or estimate_epochs(num_examples)
+        billable_tokens = sum(min(MAX_TOKENS_PER_EXAMPLE, n) for n in self.num_tokens)
+        trained_tokens = n_epochs * billable_tokens
+        return {
+            "examples": num_examples,
+            "tokens_per_example": _distribution(self.num_tokens),
+            "assistant_tokens_per_example": _distribution(self.num_assistant_tokens),
+            "messages_per_example": _distribution(self.num_messages),
+            "too_long": sum(n > MAX_TOKENS_PER_EXAMPLE for n in self.num_tokens),
+            "billable_tokens": billable_tokens,
+            "n_epochs": n_epochs,
+            "estimated_trained_tokens": trained_tokens,
+            "estimated_cost": trained_tokens / 1000 * self.price_per_1k_tokens,
+        }
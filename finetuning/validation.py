@@ -1,74 +1,313 @@
+import asyncio
+import json
 from collections import defaultdict
 import tiktoken
 
+from config import (
+    FINETUNING_MAX_LINE_ERRORS,
+    FINETUNING_TOKEN_BATCH_SIZE,
+    FINETUNING_VALIDATION_CHUNK_SIZE,
+)
+from finetuning.token_accounting import (
+    MAX_TOKENS_PER_EXAMPLE,
+    DatasetTokenStats,
+    TokenCounter,
+)
+
 encoding = tiktoken.get_encoding("cl100k_base")
+token_counter = TokenCounter(encoding)
 
 
-def validate_data_format(file_content):
-    format_errors = defaultdict(int)
+def example_format_errors(ex):
+    """
+    Checks the format of one training example.
 
-    for ex in file_content:
-        if not isinstance(ex, dict):
-            format_errors["data_type"] += 1
-            continue
+    Parameters:
+    - ex: The parsed JSON value of one line of the dataset.
+
+    Returns:
+    - list: The format error keys found, once per offending message.
+    """
+
+    if not isinstance(ex, dict):
+        return ["data_type"]
 
-        messages = ex.get("messages", None)
-        if not messages:
-            format_errors["missing_messages_list"] += 1
+    messages = ex.get("messages", None)
+    if not messages or not isinstance(messages, list):
+        return ["missing_messages_list"]
+
+    errors = []
+    for message in messages:
+        if not isinstance(message, dict):
+            errors.append("data_type")
             continue
 
-        for message in messages:
-            if "role" not in message or "content" not in message:
-                format_errors["message_missing_key"] += 1
+        if "role" not in message or "content" not in message:
+            errors.append("message_missing_key")
+
+        if any(k not in ("role", "content", "name") for k in message):
+            errors.append("message_unrecognized_key")
+
+        # Token counting encodes every value of a message.
+        if any(not isinstance(value, str) for value in message.values()):
+            errors.append("message_value_type")
+
+        if message.get("role", None) not in ("system", "user", "assistant"):
+            errors.append("unrecognized_role")
+
+        content = message.get("content", None)
+        if not content or not isinstance(content, str):
+            errors.append("missing_content")
 
-            if any(k not in ("role", "content", "name") for k in message):
-                format_errors["message_unrecognized_key"] += 1
+    if not any(
+        isinstance(message, dict) and message.get("role", None) == "assistant"
+        for message in messages
+    ):
+        errors.append("example_missing_assistant_message")
 
-            if message.get("role", None) not in ("system", "user", "assistant"):
-                format_errors["unrecognized_role"] += 1
+    return errors
 
-            content = message.get("content", None)
-            if not content or not isinstance(content, str):
-                format_errors["missing_content"] += 1
 
-        if not any(message.get("role", None) == "assistant" for message in messages):
-            format_errors["example_missing_assistant_message"] += 1
+def example_message_errors(messages):
+    """
+    Checks the roles in the messages of one well-formed training example.
+    The length is checked separately, once its tokens are counted.
+
+    Parameters:
+    - messages (list): The example's messages.
+
+    Returns:
+    - list: The message error keys found.
+    """
+
+    errors = []
+    if not any(message["role"] == "system" for message in messages):
+        errors.append("n_missing_system")
+    if not any(message["role"] == "user" for message in messages):
+        errors.append("n_missing_user")
+    return errors
+
+
+def validate_data_format(file_content):
+    format_errors = defaultdict(int)
+
+    for ex in file_content:
+        for error in example_format_errors(ex):
+            format_errors[error] += 1
 
     return format_errors
 
 
 def num_tokens_from_messages(messages, tokens_per_message=3, tokens_per_name=1):
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
-    num_tokens += 3
+    [(num_tokens, _)] = token_counter.count_examples(
+        [messages], tokens_per_message, tokens_per_name
+    )
     return num_tokens
 
 
 def num_assistant_tokens_from_messages(messages):
-    num_tokens = 0
-    for message in messages:
-        if message["role"] == "assistant":
-            num_tokens += len(encoding.encode(message["content"]))
-    return num_tokens
+    [(_, num_assistant_tokens)] = token_counter.count_examples([messages])
+    return num_assistant_tokens
 
 
 def validate_messages(dataset):
-    convo_lens = []
     messages_errors = defaultdict(int)
 
     for ex in dataset:
-        messages = ex["messages"]
-        if not any(message["role"] == "system" for message in messages):
-            messages_errors["n_missing_system"] += 1
-        if not any(message["role"] == "user" for message in messages):
-            messages_errors["n_missing_user"] += 1
-        convo_lens.append(num_tokens_from_messages(messages))
-    too_long = sum(len > 4096 for len in convo_lens)
-    if too_long > 0:
-        messages_errors["too_long"]
+        for error in example_message_errors(ex["messages"]):
+            messages_errors[error] += 1
+    for i in range(0, len(dataset), FINETUNING_TOKEN_BATCH_SIZE):
+        batch = [ex["messages"] for ex in dataset[i : i + FINETUNING_TOKEN_BATCH_SIZE]]
+        for num_tokens, _ in token_counter.count_examples(batch):
+            if num_tokens > MAX_TOKENS_PER_EXAMPLE:
+                messages_errors["too_long"] += 1
     return messages_errors
+
+
+class StreamingValidator:
+    """
+    Validates a JSONL fine-tuning dataset in a single pass while it arrives
+    in chunks of bytes.
+
+    Every line goes through the format checks and, if it is well-formed, the
+    message checks. Well-formed examples wait in a batch of `batch_size` for
+    their tokens to be counted together, which also gathers the dataset's
+    token statistics. Only the current line and that batch are held in
+    memory. The result has the same error counts as validate_data_format and
+    validate_messages, plus the line numbers where errors were found.
+    """
+
+    def __init__(
+        self,
+        max_line_errors=FINETUNING_MAX_LINE_ERRORS,
+        batch_size=FINETUNING_TOKEN_BATCH_SIZE,
+    ):
+        """
+        Parameters:
+        - max_line_errors (int): Number of lines with errors whose location
+          is reported; counts cover every line.
+        - batch_size (int): Number of examples whose tokens are counted
+          together.
+        """
+
+        self.max_line_errors = max_line_errors
+        self.batch_size = batch_size
+        self.format_errors = defaultdict(int)
+        self.messages_errors = defaultdict(int)
+        self.line_errors = []
+        self.num_lines = 0
+        self.num_error_lines = 0
+        self.num_examples = 0
+        self.num_valid_examples = 0
+        self.token_stats = DatasetTokenStats()
+        self._pending = []
+        self._buffer = bytearray()
+
+    def feed(self, chunk):
+        """Validates the complete lines of a chunk and keeps the rest."""
+
+        if b"\n" not in chunk:
+            self._buffer += chunk
+            return
+        lines = chunk.split(b"\n")
+        self._buffer += lines[0]
+        self._validate_line(bytes(self._buffer))
+        for line in lines[1:-1]:
+            self._validate_line(line)
+        self._buffer = bytearray(lines[-1])
+
+    def close(self, n_epochs=None):
+        """
+        Validates the last line and returns the result.
+
+        Parameters:
+        - n_epochs (int): Epochs requested for training, for the cost
+          estimate.
+
+        Returns:
+        - dict: Line and example counts, the error counts ("format_errors",
+          "messages_errors"), per-line error locations ("line_errors", each
+          {"line": n, "errors": [...]}, in line order) and the token
+          statistics of the well-formed examples ("tokens").
+        """
+
+        if self._buffer:
+            self._validate_line(bytes(self._buffer))
+            self._buffer = bytearray()
+        self._count_tokens()
+        self.line_errors.sort(key=lambda item: item["line"])
+        if self.num_examples == 0:
+            self.format_errors["no_examples"] += 1
+
+        return {
+            "lines": self.num_lines,
+            "examples": self.num_examples,
+            "valid_examples": self.num_valid_examples,
+            "format_errors": dict(self.format_errors),
+            "messages_errors": dict(self.messages_errors),
+            "line_errors": self.line_errors,
+            "line_errors_truncated": self.num_error_lines > len(self.line_errors),
+            "tokens": self.token_stats.report(n_epochs),
+        }
+
+    def _validate_line(self, line):
+        self.num_lines += 1
+        line = line.strip()
+        if line:
+            self._check_line(self.num_lines, line)
+
+    def _check_line(self, line_number, line):
+        try:
+            ex = json.loads(line.decode("utf-8"))
+        except UnicodeDecodeError:
+            self.format_errors["invalid_utf8"] += 1
+            self._record(line_number, ["invalid_utf8"])
+            return
+        except ValueError:
+            self.format_errors["invalid_json"] += 1
+            self._record(line_number, ["invalid_json"])
+            return
+
+        self.num_examples += 1
+        errors = example_format_errors(ex)
+        for error in errors:
+            self.format_errors[error] += 1
+        if errors:
+            self._record(line_number, errors)
+            return
+
+        errors = example_message_errors(ex["messages"])
+        for error in errors:
+            self.messages_errors[error] += 1
+        self._pending.append((line_number, ex["messages"], errors))
+        if len(self._pending) >= self.batch_size:
+            self._count_tokens()
+
+    def _count_tokens(self):
+        if not self._pending:
+            return
+        counts = token_counter.count_examples(
+            [messages for _, messages, _ in self._pending]
+        )
+        for (line_number, messages, errors), (num_tokens, num_assistant_tokens) in zip(
+            self._pending, counts
+        ):
+            self.token_stats.add(num_tokens, num_assistant_tokens, len(messages))
+            if num_tokens > MAX_TOKENS_PER_EXAMPLE:
+                self.messages_errors["too_long"] += 1
+                errors = errors + ["too_long"]
+            self._record(line_number, errors)
+        self._pending = []
+
+    def _record(self, line_number, errors):
+        if not errors:
+            self.num_valid_examples += 1
+            return
+        self.num_error_lines += 1
+        if len(self.line_errors) < self.max_line_errors:
+            self.line_errors.append(
+                {"line": line_number, "errors": sorted(set(errors))}
+            )
+
+
+def validate_file(file, chunk_size=FINETUNING_VALIDATION_CHUNK_SIZE, n_epochs=None):
+    """
+    Validates a JSONL dataset read from a binary file object.
+
+    Returns:
+    - dict: The result of StreamingValidator.close.
+    """
+
+    validator = StreamingValidator()
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        validator.feed(chunk)
+    return validator.close(n_epochs)
+
+
+async def validate_upload(
+    file, chunk_size=FINETUNING_VALIDATION_CHUNK_SIZE, n_epochs=None
+):
+    """
+    Validates an uploaded JSONL dataset chunk by chunk, checking each chunk in
+    a worker thread so that large uploads do not block the event loop.
+
+    Parameters:
+    - file (UploadFile): The uploaded dataset.
+    - chunk_size (int): Number of bytes read at a time.
+    - n_epochs (int): Epochs requested for training, for the cost estimate.
+
+    Returns:
+    - dict: The result of StreamingValidator.close.
+    """
+
+    validator = StreamingValidator()
+    loop = asyncio.get_running_loop()
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        await loop.run_in_executor(None, validator.feed, chunk)
+    return await loop.run_in_executor(None, validator.close, n_epochs)
@@ -0,0 +1,290 @@
+import math
+import time
+
+from config import (
+    ADMISSION_CHARS_PER_TOKEN,
+    KEY_TOKENS_PER_MINUTE,
+    MAX_INFLIGHT_TOKENS,
+    USER_TOKENS_PER_MINUTE,
+)
+
+REASONS = {
+    "key_budget": "the API key is over its token budget",
+    "user_budget": "the user is over their token budget",
+    "capacity": "the server has too many tokens in flight",
+}
+
+# tokens a request may generate when its model does not set max_new_tokens
+DEFAULT_MAX_NEW_TOKENS = 256
+# seconds between drops of the user buckets that are full again
+PRUNE_INTERVAL_SECONDS = 60.0
+# Retry-After of a request rejected because too many tokens are in flight
+CAPACITY_RETRY_SECONDS = 1
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is over a token budget or the in-flight cap."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Too many tokens requested: {REASONS[reason]}")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def parse_api_keys(api_keys, default_key, tokens_per_minute=KEY_TOKENS_PER_MINUTE):
+    """
+    Parses API_KEYS: comma-separated "name:key" entries, each optionally
+    followed by ":<tokens per minute>".
+
+    Parameters:
+    - api_keys (str): The API_KEYS setting.
+    - default_key (str): API_SECRET_KEY, the key of the client "default".
+    - tokens_per_minute (int): Budget of the keys that do not set their own.
+
+    Returns:
+    - tuple: The client name of each key, and the budget of each client in
+      tokens per minute (0 for none).
+
+    Raises:
+    - ValueError: If an entry is malformed or a name or key is repeated.
+    """
+
+    names = {default_key: "default"}
+    budgets = {"default": tokens_per_minute}
+    for entry in api_keys.split(","):
+        if not entry.strip():
+            continue
+        parts = entry.strip().split(":")
+        if len(parts) not in (2, 3) or not parts[0] or not parts[1]:
+            raise ValueError(f"Invalid API_KEYS entry for {parts[0] or 'a key'}")
+        name, key = parts[0], parts[1]
+        if name in budgets or key in names:
+            raise ValueError(f"API key {name} is configured twice")
+        names[key] = name
+        budgets[name] = int(parts[2]) if len(parts) == 3 else tokens_per_minute
+    return names, budgets
+
+
+def estimate_cost(texts, max_new_tokens, chars_per_token=ADMISSION_CHARS_PER_TOKEN):
+    """
+    Estimates the tokens a request costs before its prompt is tokenized: the
+    prompt from the length of its texts, plus the most tokens it may
+    generate.
+
+    Parameters:
+    - texts (list): The texts that make up the prompt.
+    - max_new_tokens (int): The model's max_new_tokens, None if unset.
+    """
+
+    prompt_tokens = math.ceil(sum(len(text) for text in texts) / chars_per_token)
+    return prompt_tokens + (max_new_tokens or DEFAULT_MAX_NEW_TOKENS)
+
+
+class TokenBucket:
+    """
+    Holds up to `capacity` tokens, one minute of budget, and refills at the
+    budget's rate. A request is let in once the bucket holds its cost, or is
+    full, and then takes its whole cost: a request larger than the bucket
+    still runs and leaves it in debt, which delays the next ones.
+    """
+
+    def __init__(self, tokens_per_minute):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60
+        self.tokens = float(tokens_per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost):
+        # seconds until the bucket can let in a request of `cost` tokens
+        missing = min(cost, self.capacity) - self.tokens
+        return max(missing, 0) / self.rate
+
+    def adjust(self, tokens):
+        # Gives back tokens that were charged but not used, or takes those
+        # that were used beyond the charge when `tokens` is negative.
+        self.refill(time.monotonic())
+        self.tokens = min(self.capacity, self.tokens + tokens)
+
+    @property
+    def is_full(self):
+        return self.tokens >= self.capacity
+
+
+class Admission:
+    """The tokens an admitted request was charged and still holds in flight."""
+
+    def __init__(self, client, user, cost, buckets, inflight):
+        self.client = client
+        self.user = user
+        self.cost = cost
+        self.buckets = buckets
+        self.inflight = inflight
+        self.settled = False
+
+
+class AdmissionController:
+    """
+    Admits requests by their estimated token cost.
+
+    Each API key and each user of a key has a token bucket of its budget per
+    minute, and running requests may hold at most `max_inflight_tokens`.
+    A request over a budget or the cap is rejected at once with
+    AdmissionRejected rather than queued, so one client cannot fill the
+    queue and drive up the latency of everyone else. When a request ends,
+    its buckets are adjusted by the difference between its estimate and the
+    tokens it actually used.
+
+    Used from the event loop only.
+    """
+
+    def __init__(
+        self,
+        key_budgets,
+        user_tokens_per_minute=USER_TOKENS_PER_MINUTE,
+        max_inflight_tokens=MAX_INFLIGHT_TOKENS,
+    ):
+        """
+        Parameters:
+        - key_budgets (dict): Tokens per minute of each client, by name; 0
+          for no budget.
+        - user_tokens_per_minute (int): Budget of each user of a key, 0 for
+          none.
+        - max_inflight_tokens (int): Tokens running requests may hold, 0 for
+          no cap.
+        """
+
+        self.key_budgets = key_budgets
+        self.user_tokens_per_minute = user_tokens_per_minute
+        self.max_inflight_tokens = max_inflight_tokens
+        self.inflight_tokens = 0
+        self._key_buckets = {
+            name: TokenBucket(budget) for name, budget in key_budgets.items() if budget
+        }
+        self._user_buckets = {}
+        self._pruned = time.monotonic()
+        self.admitted = 0
+        self.rejected = {reason: 0 for reason in REASONS}
+
+    def _buckets(self, client, user):
+        buckets = []
+        if client in self._key_buckets:
+            buckets.append(("key_budget", self._key_buckets[client]))
+        if user and self.user_tokens_per_minute:
+            bucket = self._user_buckets.get((client, user))
+            if bucket is None:
+                bucket = TokenBucket(self.user_tokens_per_minute)
+                self._user_buckets[(client, user)] = bucket
+            buckets.append(("user_budget", bucket))
+        return buckets
+
+    def admit(self, client, user, cost, inflight=True):
+        """
+        Charges a request to the budgets of its key and user.
+
+        Parameters:
+        - client (str): The name of the request's API key.
+        - user (str): The user the client sent the request for, if any.
+        - cost (int): The estimated tokens of the request.
+        - inflight (bool): Whether the request counts towards the in-flight
+          cap while it runs.
+
+        Returns:
+        - Admission: Pass it to `settle` when the request ends.
+
+        Raises:
+        - AdmissionRejected: If a budget or the in-flight cap is exceeded,
+          with the seconds after which the request may be let in.
+        """
+
+        now = time.monotonic()
+        self._prune(now)
+        buckets = self._buckets(client, user)
+        for reason, bucket in buckets:
+            bucket.refill(now)
+            wait_time = bucket.wait_time(cost)
+            if wait_time > 0:
+                self.rejected[reason] += 1
+                raise AdmissionRejected(reason, wait_time)
+        # A request larger than the cap may still run alone.
+        if (
+            inflight
+            and self.max_inflight_tokens
+            and self.inflight_tokens
+            and self.inflight_tokens + cost > self.max_inflight_tokens
+        ):
+            self.rejected["capacity"] += 1
+            raise AdmissionRejected("capacity", CAPACITY_RETRY_SECONDS)
+
+        for _, bucket in buckets:
+            bucket.tokens -= cost
+        held = cost if inflight else 0
+        self.inflight_tokens += held
+        self.admitted += 1
+        return Admission(client, user, cost, [bucket for _, bucket in buckets], held)
+
+    def settle(self, admission, used_tokens=None):
+        """
+        Ends a request: frees the tokens it held in flight and adjusts its
+        budgets to the tokens it used. Settling twice has no effect.
+
+        Parameters:
+        - admission (Admission): The request's admission.
+        - used_tokens (int): Prompt and generated tokens the request used;
+          None keeps the estimate.
+        """
+
+        if admission.settled:
+            return
+        admission.settled = True
+        self.inflight_tokens -= admission.inflight
+        admission.inflight = 0
+        if used_tokens is not None and used_tokens != admission.cost:
+            for bucket in admission.buckets:
+                bucket.adjust(admission.cost - used_tokens)
+
+    def _prune(self, now):
+        # A full bucket is the same as a new one, so the buckets of idle
+        # users can be dropped.
+        if now - self._pruned < PRUNE_INTERVAL_SECONDS:
+            return
+        self._pruned = now
+        for key, bucket in list(self._user_buckets.items()):
+            bucket.refill(now)
+            if bucket.is_full:
+                del self._user_buckets[key]
+
+    def available(self):
+        """Returns the tokens left in the budget of each API key that has one."""
+        now = time.monotonic()
+        for bucket in self._key_buckets.values():
+            bucket.refill(now)
+        return {name: bucket.tokens for name, bucket in self._key_buckets.items()}
+
+    def stats(self):
+        now = time.monotonic()
+        for bucket in self._user_buckets.values():
+            bucket.refill(now)
+        available = self.available()
+        return {
+            "max_inflight_tokens": self.max_inflight_tokens,
+            "inflight_tokens": self.inflight_tokens,
+            "user_tokens_per_minute": self.user_tokens_per_minute,
+            "keys": [
+                {
+                    "name": name,
+                    "tokens_per_minute": budget,
+                    "available_tokens": available.get(name),
+                }
+                for name, budget in self.key_budgets.items()
+            ],
+            "users": [
+                {"key": client, "user": user, "available_tokens": bucket.tokens}
+                for (client, user), bucket in self._user_buckets.items()
+            ],
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+        }
@@ -0,0 +1,160 @@
+import logging
+import threading
+import time
+
+import torch
+
+
+class ForwardCounter:
+    """
+    Counts the forward passes of a model, separately for every thread, so
+    that concurrent generations do not mix their counts.
+    """
+
+    def __init__(self, model):
+        self._local = threading.local()
+        self._handle = model.register_forward_pre_hook(self._hook)
+
+    def _hook(self, module, args):
+        self._local.count = self.count + 1
+
+    @property
+    def count(self):
+        return getattr(self._local, "count", 0)
+
+    def remove(self):
+        self._handle.remove()
+
+
+class AssistedDecoder:
+    """
+    Generates with assisted (speculative) decoding: a small draft model that
+    shares the target's tokenizer proposes a few tokens, and the target model
+    checks all of them in a single forward pass, keeping the proposals up to
+    the first one it disagrees with plus one token of its own.
+
+    Every target forward pass yields one token of its own, so the tokens
+    beyond that were draft proposals the target accepted. The acceptance
+    rate is accepted / proposed, where each draft forward pass proposes one
+    token. The speedup compares the time per generated token with the time
+    per token of plain decoding measured by `calibrate`.
+    """
+
+    def __init__(self, model, draft_model, draft_name=None):
+        """
+        Parameters:
+        - model: The target model.
+        - draft_model: The draft model, on the same device as the target.
+        - draft_name (str): Name of the draft model, for reporting.
+        """
+
+        self.model = model
+        self.draft_model = draft_model
+        self.draft_name = draft_name
+        self._target_passes = ForwardCounter(model)
+        self._draft_passes = ForwardCounter(draft_model)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.generated_tokens = 0
+        self.target_passes = 0
+        self.proposed_tokens = 0
+        self.generation_time = 0.0
+        self.baseline_time_per_token = None
+
+    def generate(self, **generate_kwargs):
+        """
+        Calls `model.generate` with the draft model as assistant. Takes the
+        same arguments as `model.generate`, with a batch of one prompt.
+
+        Returns:
+        - torch.LongTensor: The generated sequences.
+        """
+
+        target_before = self._target_passes.count
+        draft_before = self._draft_passes.count
+        start = time.perf_counter()
+        outputs = self.model.generate(
+            assistant_model=self.draft_model, **generate_kwargs
+        )
+        elapsed = time.perf_counter() - start
+
+        num_tokens = outputs.shape[1] - generate_kwargs["input_ids"].shape[1]
+        with self._lock:
+            self.requests += 1
+            self.generated_tokens += num_tokens
+            self.target_passes += self._target_passes.count - target_before
+            self.proposed_tokens += self._draft_passes.count - draft_before
+            self.generation_time += elapsed
+        return outputs
+
+    def calibrate(self, inputs, max_new_tokens, **generate_kwargs):
+        """
+        Measures the time per token of plain greedy decoding with the target
+        model alone, the baseline of the reported speedup, and starts the
+        statistics afresh so that they only cover what follows (e.g. not the
+        warm-up).
+
+        Parameters:
+        - inputs (dict): Tokenized prompt, on the model's device.
+        - max_new_tokens (int): Number of tokens to generate.
+        - generate_kwargs: Extra keyword arguments passed to `model.generate`.
+        """
+
+        with torch.inference_mode():
+            start = time.perf_counter()
+            outputs = self.model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                min_new_tokens=max_new_tokens,
+                do_sample=False,
+                **generate_kwargs,
+            )
+            elapsed = time.perf_counter() - start
+        num_tokens = outputs.shape[1] - inputs["input_ids"].shape[1]
+        if num_tokens > 0:
+            self.baseline_time_per_token = elapsed / num_tokens
+            logging.info(
+                f"Plain decoding baseline: {1000 * elapsed / num_tokens:.1f}ms/token"
+            )
+        with self._lock:
+            self.requests = 0
+            self.generated_tokens = 0
+            self.target_passes = 0
+            self.proposed_tokens = 0
+            self.generation_time = 0.0
+
+    def remove(self):
+        self._target_passes.remove()
+        self._draft_passes.remove()
+
+    def stats(self):
+        with self._lock:
+            accepted = self.generated_tokens - self.target_passes
+            time_per_token = (
+                self.generation_time / self.generated_tokens
+                if self.generated_tokens
+                else None
+            )
+            return {
+                "draft_model": self.draft_name,
+                "requests": self.requests,
+                "generated_tokens": self.generated_tokens,
+                "proposed_tokens": self.proposed_tokens,
+                "accepted_tokens": accepted,
+                "acceptance_rate": (
+                    accepted / self.proposed_tokens if self.proposed_tokens else None
+                ),
+                "tokens_per_target_pass": (
+                    self.generated_tokens / self.target_passes
+                    if self.target_passes
+                    else None
+                ),
+                "time_per_token": time_per_token,
+                "baseline_time_per_token": self.baseline_time_per_token,
+                "speedup": (
+                    self.baseline_time_per_token / time_per_token
+                    if time_per_token and self.baseline_time_per_token
+                    else None
+                ),
+                "draft_tokens": getattr(self.draft_model, "max_assistant_tokens", None),
+            }
@@ -0,0 +1,236 @@
+import asyncio
+import logging
+
+import metrics
+from config import BULK_BATCH_SIZE, BULK_MAX_BATCH_TOKENS
+from inference.cancellation import GenerationCancelled
+from inference.executor import InferenceQueueFull
+from inference.lora import split_adapter
+
+# seconds to wait before retrying a batch the inference queue had no room for
+QUEUE_FULL_RETRY_SECONDS = 0.5
+
+
+def plan_batches(
+    lengths,
+    max_batch_size=BULK_BATCH_SIZE,
+    max_batch_tokens=BULK_MAX_BATCH_TOKENS,
+    allow_padding=True,
+):
+    """
+    Groups prompts into generation batches. Prompts are sorted by length so
+    that each batch holds prompts of similar length and little padding.
+
+    Parameters:
+    - lengths (list): The number of tokens of each prompt.
+    - max_batch_size (int): Maximum number of prompts per batch.
+    - max_batch_tokens (int): Maximum padded prompt tokens per batch.
+    - allow_padding (bool): Whether prompts of different lengths may share a
+      batch; models that take no attention mask only batch equal lengths.
+
+    Returns:
+    - list: The prompt indices of each batch.
+    """
+
+    batches = []
+    batch = []
+    for i in sorted(range(len(lengths)), key=lengths.__getitem__):
+        # sorted ascending, so the newest prompt is the longest of its batch
+        if batch and (
+            len(batch) >= max_batch_size
+            or (len(batch) + 1) * lengths[i] > max_batch_tokens
+            or (not allow_padding and lengths[i] != lengths[batch[0]])
+        ):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _error(index, model_name, error):
+    return {"index": index, "model": model_name, "success": False, "error": error}
+
+
+async def _generate_for_model(
+    model_name, items, registry, executor, results, cancellation=None
+):
+    # Generates the answers of all items for one model, batch after batch,
+    # putting each result on `results` as soon as its batch is done.
+    labels = {"endpoint": "chat_batch", "model": model_name}
+
+    def fail(indices, error):
+        metrics.REQUESTS.inc(value=len(indices), status="500", **labels)
+        for index in indices:
+            results.put_nowait(_error(index, model_name, error))
+
+    entry = await registry.acquire(model_name)
+    if entry is None:
+        fail([index for index, _, _ in items], "Unable to load model")
+        return
+    # The lease keeps the model loaded between batches, when no inference
+    # slot is held.
+    try:
+        session = entry["session"]
+        prompt_builder = entry["prompt_builder"]
+
+        def generate(batch_ids, adapters, usage):
+            # Prompts of different adapters share a batch; the adapters stay
+            # loaded while it generates.
+            if not any(adapters):
+                return session.generate_batch(
+                    batch_ids, usage=usage, cancellation=cancellation
+                )
+            with entry["adapters"].using(adapters):
+                return session.generate_batch(
+                    batch_ids, usage=usage, adapters=adapters, cancellation=cancellation
+                )
+
+        def encode():
+            # Models without a prompt template are sent the bare question, as
+            # /api/chat_cpu does.
+            if prompt_builder is None:
+                prompts = [item.question for _, item, _ in items]
+            else:
+                prompts = [
+                    prompt_builder.build(
+                        item.base_prompt,
+                        item.question,
+                        item.chat_history,
+                        item.fetched_text,
+                    )[0]
+                    for _, item, _ in items
+                ]
+            return session.tokenizer(prompts)["input_ids"]
+
+        loop = asyncio.get_running_loop()
+        try:
+            token_ids = await loop.run_in_executor(None, encode)
+        except Exception as e:
+            logging.error(f"Error building bulk prompts for {model_name}: {str(e)}")
+            fail([index for index, _, _ in items], str(e))
+            return
+        batches = plan_batches(
+            [len(ids) for ids in token_ids],
+            allow_padding=session.return_attention_mask,
+        )
+
+        for position, batch in enumerate(batches):
+            indices = [items[i][0] for i in batch]
+            usage = {}
+            try:
+                while True:
+                    try:
+                        async with executor.slot(model_name, cancellation=cancellation):
+                            texts = await executor.call(
+                                generate,
+                                [token_ids[i] for i in batch],
+                                [items[i][2] for i in batch],
+                                usage,
+                            )
+                        break
+                    except InferenceQueueFull:
+                        # Bulk items wait for room instead of failing.
+                        await asyncio.sleep(QUEUE_FULL_RETRY_SECONDS)
+            except GenerationCancelled as e:
+                # No one is left to receive this batch or the following ones.
+                skipped = sum(len(batch) for batch in batches[position:])
+                wasted_tokens = usage.get("generated_tokens", 0)
+                metrics.CANCELLED_REQUESTS.inc(value=skipped, reason=e.reason, **labels)
+                metrics.CANCELLED_TOKENS.inc(
+                    value=wasted_tokens, reason=e.reason, **labels
+                )
+                logging.info(
+                    f"Bulk generation for {model_name} cancelled ({e.reason}) with "
+                    f"{skipped} items left, after {wasted_tokens} generated tokens"
+                )
+                return
+            except Exception as e:
+                logging.error(f"Error in bulk generation for {model_name}: {str(e)}")
+                fail(indices, str(e))
+                continue
+
+            metrics.REQUESTS.inc(value=len(indices), status="200", **labels)
+            metrics.GENERATED_TOKENS.observe(usage["generated_tokens"], **labels)
+            metrics.TOKENS_PER_SECOND.observe(
+                usage["generated_tokens"] / usage["generation_time"], **labels
+            )
+            for index, text in zip(indices, texts):
+                results.put_nowait(
+                    {
+                        "index": index,
+                        "model": model_name,
+                        "success": True,
+                        "message": text,
+                    }
+                )
+    finally:
+        registry.release(model_name)
+
+
+async def bulk_generate(items, registry, executor, valid_models, cancellation=None):
+    """
+    Answers many independent chat requests, grouped by model and generated in
+    padded batches. Models are worked on concurrently; requests for different
+    LoRA adapters of a model share its batches.
+
+    Parameters:
+    - items (list): ChatMessages, or an error message for items that could
+      not be parsed.
+    - registry (ModelRegistry): The loaded models.
+    - executor (InferenceExecutor): The inference executor.
+    - valid_models (dict): The configured models, by short name.
+    - cancellation (Cancellation): Stops the generation of the remaining
+      items once cancelled.
+
+    Yields:
+    - dict: The result of each item, in completion order, with its "index"
+      in `items` and either "message" or "error".
+    """
+
+    by_model = {}
+    errors = []
+    for index, item in enumerate(items):
+        if isinstance(item, str):
+            errors.append(_error(index, None, item))
+            continue
+        model_name, adapter = split_adapter(item.selected_model)
+        model_key = model_name.split("/").pop()
+        if model_key not in valid_models:
+            errors.append(_error(index, item.selected_model, "Invalid model name"))
+            continue
+        model_name = valid_models[model_key]["name"]
+        if adapter is not None and adapter not in registry.adapter_sources.get(
+            model_name, {}
+        ):
+            errors.append(_error(index, item.selected_model, "Unknown adapter"))
+            continue
+        by_model.setdefault(model_name, []).append((index, item, adapter))
+
+    for error in errors:
+        yield error
+
+    results = asyncio.Queue()
+    tasks = [
+        asyncio.create_task(
+            _generate_for_model(
+                model_name, model_items, registry, executor, results, cancellation
+            )
+        )
+        for model_name, model_items in by_model.items()
+    ]
+    remaining = sum(len(model_items) for model_items in by_model.values())
+    try:
+        while remaining:
+            yield await results.get()
+            remaining -= 1
+    finally:
+        # The client went away or every result was sent. A cancellation
+        # stops the running batches within a token and lets the tasks record
+        # the work that was cancelled.
+        if cancellation is not None:
+            cancellation.cancel("disconnected")
+        else:
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,127 @@
+import asyncio
+import time
+
+from transformers import StoppingCriteria
+
+from config import DISCONNECT_POLL_INTERVAL_SECONDS, GENERATION_TIMEOUT_SECONDS
+
+REASONS = {
+    "disconnected": "the client disconnected",
+    "deadline": "the generation deadline passed",
+}
+
+
+class GenerationCancelled(Exception):
+    """Raised when a request's generation stopped before its answer was done."""
+
+    def __init__(self, reason):
+        super().__init__(f"Generation cancelled: {REASONS[reason]}")
+        self.reason = reason
+
+
+class Cancellation:
+    """
+    Tells whether a request's answer is still wanted. The event loop cancels
+    it when the client disconnects; it cancels itself once its deadline
+    passes. Generation checks it before each decode step, so a cancelled
+    request stops within a token or two and frees its slot.
+    """
+
+    def __init__(self, timeout=GENERATION_TIMEOUT_SECONDS):
+        """
+        Parameters:
+        - timeout (float): Seconds from now until the deadline; 0 or None for
+          no deadline.
+        """
+
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.reason = None
+        self._event = None
+
+    @property
+    def cancelled(self):
+        if (
+            self.reason is None
+            and self.deadline is not None
+            and time.monotonic() >= self.deadline
+        ):
+            self.reason = "deadline"
+        return self.reason is not None
+
+    def cancel(self, reason):
+        """Cancels the request; call it from the event loop."""
+        if self.reason is None:
+            self.reason = reason
+        if self._event is not None:
+            self._event.set()
+
+    def check(self):
+        """
+        Raises:
+        - GenerationCancelled: If the request is cancelled.
+        """
+
+        if self.cancelled:
+            raise GenerationCancelled(self.reason)
+
+    async def guard(self, awaitable):
+        """
+        Awaits `awaitable`, such as a wait for a queue slot, unless the
+        request is cancelled first; the awaitable is then cancelled.
+
+        Raises:
+        - GenerationCancelled: If the request is cancelled first.
+        """
+
+        self.check()
+        task = asyncio.ensure_future(awaitable)
+        if self._event is None:
+            self._event = asyncio.Event()
+        waiter = asyncio.ensure_future(self._event.wait())
+        timeout = None
+        if self.deadline is not None:
+            timeout = max(self.deadline - time.monotonic(), 0)
+        try:
+            await asyncio.wait(
+                {task, waiter}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            waiter.cancel()
+
+        if task.done():
+            return task.result()
+        task.cancel()
+        # Lets the awaitable clean up, e.g. give back a slot it just got.
+        await asyncio.wait({task})
+        if self.reason is None:
+            # the wait timed out at the deadline
+            self.reason = "deadline"
+        raise GenerationCancelled(self.reason)
+
+
+class CancellationCriterion(StoppingCriteria):
+    """Stopping criterion that stops `generate` once a request is cancelled."""
+
+    def __init__(self, cancellation):
+        self.cancellation = cancellation
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.cancellation.cancelled
+
+
+async def watch_disconnect(
+    request, cancellation, interval=DISCONNECT_POLL_INTERVAL_SECONDS
+):
+    """
+    Cancels a request when its client disconnects. Runs until the request
+    is cancelled; cancel the task once the request is done.
+    """
+
+    while not cancellation.cancelled:
+        if await request.is_disconnected():
+            cancellation.cancel("disconnected")
+            return
+        await asyncio.sleep(interval)
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+
+from config import INFERENCE_MAX_QUEUE_SIZE, INFERENCE_MAX_WORKERS
+from tracing import phase
+
+
+class InferenceQueueFull(Exception):
+    """Raised when the inference queue cannot take another request."""
+
+
+class InferenceExecutor:
+    """
+    Runs blocking generation calls on a dedicated thread pool so that the
+    asyncio event loop stays responsive.
+
+    Every request holds a slot from the moment it is admitted until its
+    generation finishes. At most `max_queue_size` requests may hold a slot at
+    once (running or waiting); further requests are rejected immediately with
+    InferenceQueueFull. Each model additionally has its own concurrency limit,
+    so a slow model cannot occupy every worker.
+
+    Slots are acquired and released on the event loop; use
+    `release_threadsafe` to release a slot from a worker thread.
+    """
+
+    def __init__(
+        self,
+        max_workers=INFERENCE_MAX_WORKERS,
+        max_queue_size=INFERENCE_MAX_QUEUE_SIZE,
+        default_limit=1,
+    ):
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.default_limit = default_limit
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="inference"
+        )
+        self._limits = {}
+        self._semaphores = {}
+        self._pending = 0
+        self._pending_per_model = {}
+        self._loop = None
+
+    def set_limit(self, model_name, limit):
+        self._limits[model_name] = limit
+        self._semaphores.pop(model_name, None)
+
+    def _semaphore(self, model_name):
+        if model_name not in self._semaphores:
+            limit = self._limits.get(model_name, self.default_limit)
+            self._semaphores[model_name] = asyncio.Semaphore(limit)
+        return self._semaphores[model_name]
+
+    async def acquire(self, model_name, phases=None, cancellation=None):
+        """
+        Admits a request for the given model and waits for a model slot. The
+        wait is added to `phases["queue"]` if `phases` is given.
+
+        Raises:
+        - InferenceQueueFull: If max_queue_size requests already hold a slot.
+        - GenerationCancelled: If `cancellation` is cancelled while the
+          request waits; it then leaves the queue.
+        """
+
+        if self._pending >= self.max_queue_size:
+            logging.warning(f"Inference queue full, rejecting {model_name} request")
+            raise InferenceQueueFull(
+                f"Inference queue is full ({self.max_queue_size} requests)"
+            )
+
+        self._loop = asyncio.get_running_loop()
+        self._pending += 1
+        self._pending_per_model[model_name] = (
+            self._pending_per_model.get(model_name, 0) + 1
+        )
+        try:
+            with phase(phases, "queue"):
+                semaphore = self._semaphore(model_name)
+                if cancellation is None or not semaphore.locked():
+                    await semaphore.acquire()
+                else:
+                    await cancellation.guard(semaphore.acquire())
+        except BaseException:
+            self._forget(model_name)
+            raise
+
+    def release(self, model_name):
+        self._semaphore(model_name).release()
+        self._forget(model_name)
+
+    def release_threadsafe(self, model_name):
+        self._loop.call_soon_threadsafe(self.release, model_name)
+
+    def _forget(self, model_name):
+        self._pending -= 1
+        self._pending_per_model[model_name] -= 1
+
+    @asynccontextmanager
+    async def slot(self, model_name, phases=None, cancellation=None):
+        await self.acquire(model_name, phases, cancellation)
+        try:
+            yield
+        finally:
+            self.release(model_name)
+
+    async def run(self, model_name, fn, *args, **kwargs):
+        """
+        Runs `fn(*args, **kwargs)` on the inference thread pool once the model
+        has a free slot.
+
+        Parameters:
+        - model_name (str): The model the call runs on.
+        - fn (callable): The blocking function to run.
+
+        Returns:
+        - The return value of `fn`.
+        """
+
+        async with self.slot(model_name):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._pool, partial(fn, *args, **kwargs))
+
+    async def call(self, fn, *args, **kwargs):
+        """
+        Runs `fn(*args, **kwargs)` on the inference thread pool for a caller
+        that already holds a slot.
+        """
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, partial(fn, *args, **kwargs))
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def pending_for(self, model_name):
+        return self._pending_per_model.get(model_name, 0)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
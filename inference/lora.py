@@ -0,0 +1,370 @@
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+import torch.nn.functional as F
+from safetensors.torch import load_file
+from torch import nn
+from transformers.utils import cached_file
+
+from config import HUGGINGFACE_ACCESS_TOKEN, LORA_MAX_ADAPTERS
+
+# "base_model.model.<module>.lora_A.weight", as PEFT saves adapters
+ADAPTER_KEY = re.compile(r"^base_model\.model\.(.+)\.lora_([AB])(?:\.[^.]+)?\.weight$")
+
+_local = threading.local()
+
+
+@contextmanager
+def use_adapters(adapters):
+    """
+    Selects the LoRA adapter of each row of the batches the model runs in
+    this thread within the block.
+
+    Parameters:
+    - adapters (list): The adapter name of each row, None for the base model.
+    """
+
+    previous = getattr(_local, "groups", None)
+    groups = {}
+    for row, name in enumerate(adapters or []):
+        if name is not None:
+            groups.setdefault(name, []).append(row)
+    if len(groups) == 1 and len(next(iter(groups.values()))) == len(adapters):
+        # One adapter for the whole batch needs no row selection.
+        groups = {name: None for name in groups}
+    _local.groups = groups or None
+    try:
+        yield
+    finally:
+        _local.groups = previous
+
+
+class WithAdapter:
+    """
+    Wraps a model, or an AssistedDecoder, so that `generate` runs with one
+    adapter for every row, including in another thread.
+    """
+
+    def __init__(self, generator, adapter):
+        self.generator = generator
+        self.adapter = adapter
+
+    def generate(self, **generate_kwargs):
+        with use_adapters([self.adapter]):
+            return self.generator.generate(**generate_kwargs)
+
+
+class LoRALinear(nn.Module):
+    """
+    A linear layer with any number of LoRA adapters: every row of a batch
+    adds the low-rank update of its own adapter, if any, to the output of
+    the shared base layer.
+    """
+
+    def __init__(self, base):
+        super().__init__()
+        self.base = base
+        self.in_features = base.in_features
+        self.out_features = base.out_features
+        self.adapters = {}
+        # adapter used when no thread selected one, for training
+        self.default_adapter = None
+
+    @property
+    def weight_dtype(self):
+        weight = getattr(self.base, "weight", None)
+        # dynamically quantized layers compute in float32
+        if isinstance(weight, torch.Tensor) and weight.is_floating_point():
+            return weight.dtype
+        return torch.float32
+
+    @property
+    def weight_device(self):
+        return next(self.base.parameters(), torch.empty(0)).device
+
+    def forward(self, x):
+        output = self.base(x)
+        groups = getattr(_local, "groups", None)
+        if groups is None and self.default_adapter is not None:
+            # Set for training, where the backward pass may recompute
+            # activations in another thread.
+            groups = {self.default_adapter: None}
+        if not groups:
+            return output
+        for name, rows in groups.items():
+            adapter = self.adapters.get(name)
+            if adapter is None:
+                continue
+            lora_a, lora_b, scaling = adapter
+            # trained adapters keep float32 weights on a half precision model
+            inputs = x.to(lora_a.dtype)
+            if rows is None:
+                update = F.linear(F.linear(inputs, lora_a), lora_b)
+                output = output + scaling * update.to(output.dtype)
+                continue
+            index = torch.tensor(rows, device=x.device)
+            update = F.linear(F.linear(inputs.index_select(0, index), lora_a), lora_b)
+            output = output.index_add(0, index, update.to(output.dtype), alpha=scaling)
+        return output
+
+
+def inject_lora(model, target_modules):
+    """
+    Replaces the linear layers named in `target_modules` (e.g. "q_proj") with
+    LoRALinear layers that share their weights.
+
+    Returns:
+    - dict: The LoRALinear layers, by module path.
+    """
+
+    layers = {}
+    targets = set(target_modules)
+    for path, module in list(model.named_modules()):
+        for name, child in list(module.named_children()):
+            if (
+                name in targets
+                and not isinstance(child, LoRALinear)
+                and hasattr(child, "in_features")
+                and hasattr(child, "out_features")
+            ):
+                layer = LoRALinear(child)
+                setattr(module, name, layer)
+                layers[f"{path}.{name}" if path else name] = layer
+    return layers
+
+
+def read_adapter_config(path):
+    """
+    Reads the adapter_config.json of a PEFT LoRA adapter, from a local
+    directory or the Hugging Face Hub.
+    """
+
+    config_file = cached_file(
+        path, "adapter_config.json", token=HUGGINGFACE_ACCESS_TOKEN
+    )
+    with open(config_file) as f:
+        config = json.load(f)
+    if config.get("peft_type", "LORA") != "LORA":
+        raise ValueError(f"Adapter {path} is not a LoRA adapter")
+    if config.get("fan_in_fan_out", False):
+        raise ValueError(f"Adapter {path} uses fan_in_fan_out, which is not supported")
+    return config
+
+
+def read_adapter(path):
+    """
+    Reads the weights of a PEFT LoRA adapter.
+
+    Returns:
+    - tuple: The low-rank (lora_A, lora_B) weights by module path, and the
+      scaling of the update (lora_alpha / r).
+    """
+
+    config = read_adapter_config(path)
+    weights_file = cached_file(
+        path,
+        "adapter_model.safetensors",
+        token=HUGGINGFACE_ACCESS_TOKEN,
+        _raise_exceptions_for_missing_entries=False,
+    )
+    if weights_file is not None:
+        state_dict = load_file(weights_file)
+    else:
+        weights_file = cached_file(
+            path, "adapter_model.bin", token=HUGGINGFACE_ACCESS_TOKEN
+        )
+        state_dict = torch.load(weights_file, map_location="cpu")
+
+    weights = {}
+    for key, tensor in state_dict.items():
+        match = ADAPTER_KEY.match(key)
+        if match is None:
+            raise ValueError(f"Unexpected weight {key} in adapter {path}")
+        module, part = match.groups()
+        weights.setdefault(module, [None, None])["AB".index(part)] = tensor
+    return (
+        {module: tuple(pair) for module, pair in weights.items()},
+        config["lora_alpha"] / config["r"],
+    )
+
+
+class AdapterManager:
+    """
+    Serves LoRA adapters on one loaded base model.
+
+    Adapters are registered by name with the path of a PEFT LoRA adapter and
+    loaded on first use. At most `max_adapters` stay resident, in least
+    recently used order; an adapter that is still in use by a request is
+    never unloaded. Loading an adapter only reads its low-rank weights, the
+    base model is shared by all of them.
+    """
+
+    def __init__(self, model, target_modules, sources, max_adapters=LORA_MAX_ADAPTERS):
+        """
+        Parameters:
+        - model: The base model; its target layers are wrapped in place.
+        - target_modules (list): Names of the linear layers adapters may
+          change, e.g. ["q_proj", "v_proj"].
+        - sources (dict): Paths of the registered adapters, by name. The dict
+          is shared with the registry, so adapters registered later are
+          seen too.
+        - max_adapters (int): Maximum number of resident adapters.
+        """
+
+        self.layers = inject_lora(model, target_modules)
+        self.sources = sources
+        self.max_adapters = max_adapters
+        self._resident = OrderedDict()
+        self._in_use = {}
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.evictions = 0
+
+    def __contains__(self, name):
+        return name in self.sources
+
+    def acquire(self, name):
+        """
+        Marks an adapter in use, loading it if needed. Blocking; call it from
+        a worker thread.
+
+        Raises:
+        - KeyError: If no adapter of that name is registered.
+        """
+
+        with self._lock:
+            info = self._resident.get(name)
+            if (
+                info is not None
+                and info["path"] != self.sources[name]
+                and name not in self._in_use
+            ):
+                # registered again with another path
+                self._unload(name)
+            if name not in self._resident:
+                self._load(name)
+            self._resident.move_to_end(name)
+            self._resident[name]["last_used"] = time.time()
+            self._in_use[name] = self._in_use.get(name, 0) + 1
+            self._evict_to_limit()
+
+    def release(self, name):
+        with self._lock:
+            self._in_use[name] -= 1
+            if not self._in_use[name]:
+                del self._in_use[name]
+            self._evict_to_limit()
+
+    @contextmanager
+    def using(self, names):
+        """
+        Keeps the given adapters (None entries are skipped) loaded within the
+        block.
+        """
+
+        names = sorted({name for name in names if name is not None})
+        acquired = []
+        try:
+            for name in names:
+                self.acquire(name)
+                acquired.append(name)
+            yield
+        finally:
+            for name in acquired:
+                self.release(name)
+
+    def _load(self, name):
+        path = self.sources[name]
+        start = time.perf_counter()
+        weights, scaling = read_adapter(path)
+        missing = [module for module in weights if module not in self.layers]
+        if missing:
+            raise ValueError(
+                f"Adapter {name} changes layers that are not LoRA targets: "
+                f"{', '.join(missing[:3])}"
+            )
+        for module, (lora_a, lora_b) in weights.items():
+            layer = self.layers[module]
+            if (
+                lora_a is None
+                or lora_b is None
+                or lora_a.shape[1] != layer.in_features
+                or lora_b.shape[0] != layer.out_features
+            ):
+                raise ValueError(f"Adapter {name} does not fit layer {module}")
+        size = 0
+        for module, (lora_a, lora_b) in weights.items():
+            layer = self.layers[module]
+            lora_a = lora_a.to(layer.weight_device, layer.weight_dtype)
+            lora_b = lora_b.to(layer.weight_device, layer.weight_dtype)
+            layer.adapters[name] = (lora_a, lora_b, scaling)
+            size += lora_a.numel() * lora_a.element_size()
+            size += lora_b.numel() * lora_b.element_size()
+        load_time = time.perf_counter() - start
+        self._resident[name] = {
+            "path": path,
+            "bytes": size,
+            "load_time": load_time,
+            "last_used": time.time(),
+        }
+        self.loads += 1
+        logging.info(f"Adapter {name} loaded in {load_time * 1000:.1f} ms")
+
+    def _evict_to_limit(self):
+        # Adapters that were unregistered while in use go first.
+        for name in list(self._resident):
+            if name not in self.sources and name not in self._in_use:
+                self._unload(name)
+        for name in list(self._resident):
+            if len(self._resident) <= self.max_adapters:
+                break
+            if name not in self._in_use:
+                self._unload(name)
+
+    def _unload(self, name):
+        self._resident.pop(name)
+        for layer in self.layers.values():
+            layer.adapters.pop(name, None)
+        self.evictions += 1
+        logging.info(f"Adapter {name} unloaded")
+
+    def unload(self, name):
+        """
+        Frees a resident adapter, unless a request is using it; it is then
+        freed once it is no longer used, if it was unregistered.
+        """
+
+        with self._lock:
+            if name in self._resident and name not in self._in_use:
+                self._unload(name)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "registered": sorted(self.sources),
+                "resident": [
+                    {"name": name, "in_use": self._in_use.get(name, 0), **info}
+                    for name, info in self._resident.items()
+                ],
+                "max_adapters": self.max_adapters,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
+
+
+def split_adapter(selected_model):
+    """
+    Splits a selectedModel of the form "<model>@<adapter>".
+
+    Returns:
+    - tuple: The model name and the adapter name, None without an adapter.
+    """
+
+    model_name, _, adapter = selected_model.partition("@")
+    return model_name, adapter or None
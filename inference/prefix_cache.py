@@ -0,0 +1,144 @@
+import logging
+import time
+from collections import OrderedDict
+from threading import Lock
+
+import torch
+
+from config import PREFIX_CACHE_MAX_ENTRIES
+
+
+class PrefixHit:
+    def __init__(self, past_key_values, length, prefill_time):
+        self.past_key_values = past_key_values
+        self.length = length
+        self.prefill_time = prefill_time
+
+
+def common_prefix_length(a, b):
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+class PrefixCache:
+    """
+    Bounded LRU cache of `past_key_values` for prompt prefixes of one model.
+
+    Every Llama-2 chat prompt starts with the same system prompt, so its
+    attention keys and values are computed once and reused by later requests,
+    which then only prefill the tokens after the prefix.
+    """
+
+    def __init__(self, model, max_entries=PREFIX_CACHE_MAX_ENTRIES):
+        self.model = model
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+        self.prefill_time_saved = 0.0
+
+    def lookup(self, input_ids, prefix_ids, adapter=None):
+        """
+        Returns the cached state for the part of `prefix_ids` that `input_ids`
+        starts with, computing and caching it on a miss.
+
+        Parameters:
+        - input_ids (list): Token ids of the full prompt.
+        - prefix_ids (list): Token ids of the shared prompt prefix.
+        - adapter (str): The LoRA adapter the state is computed with, if any;
+          it must be selected with `use_adapters` by the caller.
+
+        Returns:
+        - PrefixHit: The cached state, or None if the prompt does not start
+          with the prefix. `prefill_time` is the prefill time this request
+          saved (0 on a miss).
+        """
+
+        # Keep at least one prompt token out of the cache so that generation
+        # has an input to start from.
+        length = min(common_prefix_length(input_ids, prefix_ids), len(input_ids) - 1)
+        if length <= 0:
+            return None
+        key = (adapter, tuple(input_ids[:length]))
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.tokens_saved += length
+                self.prefill_time_saved += entry.prefill_time
+                return entry
+
+        start = time.perf_counter()
+        with torch.inference_mode():
+            outputs = self.model(
+                input_ids=torch.tensor([input_ids[:length]], device=self.model.device),
+                use_cache=True,
+            )
+        entry = PrefixHit(outputs.past_key_values, length, time.perf_counter() - start)
+
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return PrefixHit(entry.past_key_values, length, 0.0)
+
+    def prefill(self, input_ids, prefix_ids, keep_last=False, adapter=None):
+        """
+        Prefills a prompt starting from the cached prefix state.
+
+        Parameters:
+        - input_ids (list): Token ids of the full prompt.
+        - prefix_ids (list): Token ids of the shared prompt prefix.
+        - keep_last (bool): Leave the last prompt token out of the returned
+          state, as `model.generate` expects when given `past_key_values`.
+        - adapter (str): The LoRA adapter selected by the caller, if any.
+
+        Returns:
+        - tuple: (past_key_values, logits, hit) for the prefilled prompt, with
+          logits None if nothing was left to prefill, or None if the prompt
+          does not start with the prefix.
+        """
+
+        hit = self.lookup(input_ids, prefix_ids, adapter)
+        if hit is None:
+            return None
+        if hit.prefill_time:
+            logging.info(
+                f"Prefix cache hit: reused {hit.length} tokens, saved "
+                f"{hit.prefill_time * 1000:.1f} ms of prefill"
+            )
+
+        end = len(input_ids) - 1 if keep_last else len(input_ids)
+        if end == hit.length:
+            return hit.past_key_values, None, hit
+
+        device = self.model.device
+        with torch.inference_mode():
+            outputs = self.model(
+                input_ids=torch.tensor([input_ids[hit.length : end]], device=device),
+                attention_mask=torch.ones((1, end), dtype=torch.long, device=device),
+                position_ids=torch.arange(hit.length, end, device=device).unsqueeze(0),
+                past_key_values=hit.past_key_values,
+                use_cache=True,
+            )
+        return outputs.past_key_values, outputs.logits, hit
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "tokens_saved": self.tokens_saved,
+                "prefill_time_saved": self.prefill_time_saved,
+            }
@@ -0,0 +1,289 @@
+import logging
+import re
+from functools import lru_cache
+
+from jinja2 import Template
+
+from config import PROMPT_TOKEN_CACHE_SIZE
+from inference.text_generator import SYSTEM_PROMPT, format_user_message
+
+# stand-ins for the template variables when splitting a template into segments
+SYSTEM = "\x01"
+TURN_QUESTION = "\x02"
+TURN_ANSWER = "\x03"
+QUESTION = "\x04"
+SENTINELS = re.compile("[\x01-\x04]")
+
+
+@lru_cache(maxsize=None)
+def compile_template(template_str):
+    return Template(template_str)
+
+
+class _Turn:
+    def __init__(self, question, answer):
+        self.question = question
+        self.answer = answer
+
+
+def _fill(segment, values):
+    # Substitutes in one pass, so values are never scanned for sentinels.
+    return SENTINELS.sub(lambda match: values.get(match.group(), ""), segment)
+
+
+def _render(template, system, turns, question):
+    return template.render(system=system, instructions=turns, question=question)
+
+
+def split_template(template):
+    """
+    Splits a chat template into a head (containing the system prompt), a
+    per-turn body (repeated for each item of the chat history) and a tail
+    (containing the question).
+
+    Parameters:
+    - template (jinja2.Template): The compiled prompt template.
+
+    Returns:
+    - tuple: (head, body, tail) strings with the variables left as sentinel
+      characters, or None if the template does not have that shape.
+    """
+
+    turn = _Turn(TURN_QUESTION, TURN_ANSWER)
+    without_turns = _render(template, SYSTEM, [], QUESTION)
+    with_turn = _render(template, SYSTEM, [turn], QUESTION)
+
+    head_len = 0
+    for a, b in zip(without_turns, with_turn):
+        if a != b:
+            break
+        head_len += 1
+    head = without_turns[:head_len]
+    tail = without_turns[head_len:]
+    if not with_turn.endswith(tail):
+        return None
+    body = with_turn[head_len : len(with_turn) - len(tail)]
+
+    # Check the split against a render with two turns and real values.
+    turns = [_Turn("q1", "a1"), _Turn("q2", "a2")]
+    expected = _render(template, "s", turns, "q")
+    assembled = (
+        _fill(head, {SYSTEM: "s"})
+        + "".join(
+            _fill(body, {TURN_QUESTION: t.question, TURN_ANSWER: t.answer})
+            for t in turns
+        )
+        + _fill(tail, {QUESTION: "q"})
+    )
+    if assembled != expected or QUESTION in head or SYSTEM in body + tail:
+        return None
+    return head, body, tail
+
+
+class PromptBuilder:
+    """
+    Assembles chat prompts for one model within a token budget.
+
+    The prompt template is compiled and split into head, per-turn body and
+    tail once. Each segment's token ids are cached, so a new turn of a long
+    conversation only tokenizes the text it has not seen before. When the
+    prompt would exceed the budget, the oldest history turns are dropped and
+    `fetched_text` is trimmed. The budget covers the prompt as the model is
+    given it, special tokens included: segment counts only estimate it, as
+    tokens may merge across segments, so the assembled prompt is tokenized
+    once more and trimmed further if it is still too long.
+    """
+
+    def __init__(self, tokenizer, template_str, token_budget):
+        """
+        Parameters:
+        - tokenizer: The model's tokenizer.
+        - template_str (str): The Jinja prompt template from model_list.py.
+        - token_budget (int): Maximum number of prompt tokens.
+        """
+
+        self.tokenizer = tokenizer
+        self.template = compile_template(template_str)
+        self.token_budget = token_budget
+        self.segments = split_template(self.template)
+        if self.segments is None:
+            logging.warning(
+                "Prompt template could not be split into segments; history "
+                "is truncated by re-rendering the whole prompt"
+            )
+        self.token_ids = lru_cache(maxsize=PROMPT_TOKEN_CACHE_SIZE)(self._token_ids)
+        # tokens the tokenizer adds around every prompt, such as BOS
+        self.special_tokens = tokenizer.num_special_tokens_to_add()
+
+    def _token_ids(self, text):
+        return tuple(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def count(self, text):
+        return len(self.token_ids(text))
+
+    def length(self, prompt):
+        """Returns the number of tokens of a prompt as it is encoded for the model."""
+        return len(self.tokenizer(prompt)["input_ids"])
+
+    def _trim(self, text, max_tokens):
+        if max_tokens <= 0:
+            return ""
+        token_ids = self.token_ids(text)
+        if len(token_ids) <= max_tokens:
+            return text
+        return self.tokenizer.decode(token_ids[:max_tokens])
+
+    def prefix(self, base_prompt):
+        """
+        Returns the part of every prompt that only depends on the base prompt,
+        for the prefix cache.
+        """
+
+        if self.segments is None:
+            return None
+        head, _, _ = self.segments
+        return _fill(head, {SYSTEM: SYSTEM_PROMPT + base_prompt})
+
+    def build(self, base_prompt, question, chat_history, fetched_text):
+        """
+        Creates a text generation prompt that fits the token budget.
+
+        Parameters:
+        - base_prompt (str): The base prompt comes from the user.
+        - question (str): The user's question.
+        - chat_history: Previous chat history, oldest first.
+        - fetched_text (str): Fetched text from a vector database, if any.
+
+        Returns:
+        - tuple: (prompt, prefix), where prefix is the leading part shared by
+          every prompt with the same base prompt (None if unknown).
+        """
+
+        system = SYSTEM_PROMPT + base_prompt
+        if self.segments is None:
+            return self._build_by_rendering(
+                system, question, chat_history, fetched_text
+            )
+
+        head, body, tail = self.segments
+        head_text = _fill(head, {SYSTEM: system})
+        turn_texts = [
+            _fill(body, {TURN_QUESTION: item.question, TURN_ANSWER: item.answer})
+            for item in chat_history
+        ]
+
+        tail_tokens = self.count(
+            _fill(tail, {QUESTION: format_user_message(question, "")})
+        )
+        remaining = (
+            self.token_budget
+            - self.special_tokens
+            - self.count(head_text)
+            - tail_tokens
+        )
+        turn_tokens = [self.count(text) for text in turn_texts]
+        fetched_text = self._trim_fetched(fetched_text, remaining, sum(turn_tokens))
+        if fetched_text:
+            # the fetched text and the markers wrapped around it
+            remaining -= (
+                self.count(
+                    _fill(tail, {QUESTION: format_user_message(question, fetched_text)})
+                )
+                - tail_tokens
+            )
+
+        # Keep the most recent turns that fit.
+        dropped = len(turn_texts)
+        used = 0
+        for tokens in reversed(turn_tokens):
+            if used + tokens > remaining:
+                break
+            used += tokens
+            dropped -= 1
+
+        def assemble(dropped, fetched_text):
+            user_message = format_user_message(question, fetched_text)
+            return (
+                head_text
+                + "".join(turn_texts[dropped:])
+                + _fill(tail, {QUESTION: user_message})
+            )
+
+        prompt, dropped, fetched_text = self._fit(
+            assemble, dropped, len(turn_texts), fetched_text
+        )
+        if dropped:
+            logging.info(f"Dropped {dropped} oldest chat turns to fit the token budget")
+        return prompt, head_text
+
+    def _fit(self, assemble, dropped, num_turns, fetched_text):
+        # Trims the assembled prompt until its encoding fits the budget: the
+        # fetched text first, then the oldest remaining turns.
+        prompt = assemble(dropped, fetched_text)
+        excess = self.length(prompt) - self.token_budget
+        kept = self.count(fetched_text) if fetched_text else 0
+        full_fetched_text = fetched_text
+        while excess > 0:
+            if kept > 0:
+                # Trimming by the excess may not be enough when tokens merge
+                # differently, so every pass keeps at least one token less.
+                kept -= excess
+                fetched_text = self._trim(full_fetched_text, kept)
+            elif dropped < num_turns:
+                dropped += 1
+            else:
+                logging.warning(
+                    f"Prompt of {excess + self.token_budget} tokens exceeds the "
+                    f"budget of {self.token_budget} tokens without any history"
+                )
+                break
+            prompt = assemble(dropped, fetched_text)
+            excess = self.length(prompt) - self.token_budget
+        return prompt, dropped, fetched_text
+
+    def _trim_fetched(self, fetched_text, remaining, history_tokens):
+        # Fetched text may use whatever the history leaves over, and at least
+        # half of the remaining budget.
+        if not fetched_text:
+            return fetched_text
+        allowance = max(remaining - history_tokens, remaining // 2)
+        return self._trim(fetched_text, allowance)
+
+    def _build_by_rendering(self, system, question, chat_history, fetched_text):
+        remaining = self.token_budget - self.length(
+            _render(self.template, system, [], format_user_message(question, ""))
+        )
+        history_tokens = self.count(_render(self.template, "", chat_history, ""))
+        fetched_text = self._trim_fetched(fetched_text, remaining, history_tokens)
+
+        def assemble(dropped, fetched_text):
+            user_message = format_user_message(question, fetched_text)
+            return _render(self.template, system, chat_history[dropped:], user_message)
+
+        prompt, _, _ = self._fit(assemble, 0, len(chat_history), fetched_text)
+        return prompt, None
+
+
+def create_prompt_builder(tokenizer, model, model_config, max_new_tokens):
+    """
+    Creates the PromptBuilder for a model with a prompt template.
+
+    Parameters:
+    - tokenizer: The model's tokenizer.
+    - model: The loaded model, whose config gives the context window.
+    - model_config (dict): The model's configuration from model_list.py.
+    - max_new_tokens (int): Tokens reserved for the generated answer.
+
+    Returns:
+    - PromptBuilder: The builder, or None if the model has no template.
+    """
+
+    template_str = model_config.get("prompt_template")
+    if not template_str:
+        return None
+
+    token_budget = model_config.get("prompt_token_budget")
+    if token_budget is None:
+        context_window = getattr(model.config, "max_position_embeddings", 2048)
+        token_budget = context_window - (max_new_tokens or 0)
+    return PromptBuilder(tokenizer, template_str, token_budget)
@@ -0,0 +1,181 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from config import (
+    RESPONSE_CACHE_DIR,
+    RESPONSE_CACHE_DISK_MAX_ENTRIES,
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_TTL_SECONDS,
+)
+
+
+class ResponseCache:
+    """
+    Cache of generated answers keyed by a hash of the model, the rendered
+    prompt and the generation settings.
+
+    Entries live in an in-memory LRU with a time-to-live and, when `disk_dir`
+    is set, in a second tier of JSON files that survives restarts. The disk
+    tier is read and written in worker threads, off the event loop.
+    """
+
+    def __init__(
+        self,
+        max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+        ttl=RESPONSE_CACHE_TTL_SECONDS,
+        disk_dir=RESPONSE_CACHE_DIR,
+        disk_max_entries=RESPONSE_CACHE_DISK_MAX_ENTRIES,
+    ):
+        """
+        Parameters:
+        - max_entries (int): Number of answers kept in memory.
+        - ttl (float): Seconds an answer stays valid.
+        - disk_dir (str): Directory of the disk tier, or "" to disable it.
+        - disk_max_entries (int): Number of answers kept on disk.
+        """
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.disk_max_entries = disk_max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._disk_writes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def key(model_name, prompt, generation_settings, adapter_path=None):
+        """
+        Hashes everything that determines an answer.
+
+        Parameters:
+        - model_name (str): The model that generates the answer.
+        - prompt (str): The rendered prompt.
+        - generation_settings (dict): The generation config in use.
+        - adapter_path (str): Path of the LoRA adapter in use, if any, so that
+          an adapter registered again under its name gets new answers.
+
+        Returns:
+        - str: The cache key.
+        """
+
+        payload = json.dumps(
+            [model_name, adapter_path, prompt, generation_settings],
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def get(self, key):
+        """Returns the cached answer of a key, or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+        value = None
+        if self.disk_dir:
+            value = await asyncio.to_thread(self._read_disk, key, now)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self._set_memory(key, value, now + self.ttl)
+        return value
+
+    async def set(self, key, value):
+        expires_at = time.time() + self.ttl
+        self._set_memory(key, value, expires_at)
+        if self.disk_dir:
+            await asyncio.to_thread(self._write_disk, key, value, expires_at)
+
+    def _set_memory(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _read_disk(self, key, now):
+        if not self.disk_dir:
+            return None
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry["expires_at"] <= now:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return entry["value"]
+
+    def _write_disk(self, key, value, expires_at):
+        if not self.disk_dir:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"value": value, "expires_at": expires_at}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Unable to write response cache entry: {str(e)}")
+            return
+
+        with self._lock:
+            self._disk_writes += 1
+            prune = self._disk_writes % 100 == 0
+        if prune:
+            self._prune_disk()
+
+    def _prune_disk(self):
+        # Drops the oldest files once the disk tier holds too many answers.
+        try:
+            paths = [
+                os.path.join(self.disk_dir, name)
+                for name in os.listdir(self.disk_dir)
+                if name.endswith(".json")
+            ]
+            if len(paths) <= self.disk_max_entries:
+                return
+            paths.sort(key=os.path.getmtime)
+            for path in paths[: len(paths) - self.disk_max_entries]:
+                os.remove(path)
+        except OSError as e:
+            logging.warning(f"Unable to prune response cache: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "disk_dir": self.disk_dir or None,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+            }
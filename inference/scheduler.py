@@ -0,0 +1,506 @@
+import asyncio
+import logging
+import queue
+import time
+from concurrent.futures import Future
+from threading import Thread
+
+import torch
+import torch.nn.functional as F
+from transformers import (
+    LogitsProcessorList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from config import BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS
+from inference.cancellation import GenerationCancelled
+from inference.lora import use_adapters
+from tracing import phase
+
+
+class _Sequence:
+    def __init__(
+        self,
+        prompt_ids,
+        max_new_tokens,
+        future,
+        prefix_ids=None,
+        usage=None,
+        adapter=None,
+        cancellation=None,
+    ):
+        self.prompt_ids = prompt_ids
+        self.prefix_ids = prefix_ids
+        self.adapter = adapter
+        self.cancellation = cancellation
+        self.max_new_tokens = max_new_tokens
+        self.future = future
+        self.usage = usage
+        self.phases = None if usage is None else usage.setdefault("phases", {})
+        self.submitted_at = time.perf_counter()
+        self.generated = []
+
+
+class BatchScheduler:
+    """
+    Iteration-level (continuous) batching scheduler for one loaded model.
+
+    Waiting requests are collected into a left-padded batch. The batch runs
+    one decode step at a time with a shared KV cache; finished sequences leave
+    the batch and newly arrived ones are prefilled and merged into it between
+    steps, so a long answer never holds back a short one. Sequences of
+    different LoRA adapters share a batch. A cancelled sequence leaves the
+    queue or the batch before the next step.
+
+    The model must return `past_key_values` as a tuple of per-layer
+    (key, value) tensors shaped [batch, heads, seq_len, head_dim], which is
+    the format used by the Llama family in transformers.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_batch_size=BATCH_MAX_SIZE,
+        max_wait_time=BATCH_MAX_WAIT_MS / 1000,
+        do_sample=False,
+        temperature=1.0,
+        top_p=1.0,
+        top_k=0,
+        repetition_penalty=1.0,
+        prefix_cache=None,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait_time = max_wait_time
+        self.do_sample = do_sample
+        self.repetition_penalty = repetition_penalty
+        self.prefix_cache = prefix_cache
+        self.eos_token_id = tokenizer.eos_token_id
+        self.pad_token_id = (
+            tokenizer.pad_token_id
+            if tokenizer.pad_token_id is not None
+            else tokenizer.eos_token_id
+        )
+
+        self.logits_warpers = LogitsProcessorList()
+        if do_sample:
+            if temperature != 1.0:
+                self.logits_warpers.append(TemperatureLogitsWarper(temperature))
+            if top_k:
+                self.logits_warpers.append(TopKLogitsWarper(top_k))
+            if top_p < 1.0:
+                self.logits_warpers.append(TopPLogitsWarper(top_p))
+
+        self._queue = queue.Queue()
+        self._active = []
+        self._past_key_values = None
+        self._attention_mask = None
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(
+        self,
+        prompt,
+        max_new_tokens=300,
+        prefix=None,
+        usage=None,
+        adapter=None,
+        cancellation=None,
+    ):
+        """
+        Queues a prompt for generation.
+
+        Parameters:
+        - prompt (str): The text prompt to begin generation.
+        - max_new_tokens (int): The maximum number of tokens for the generated text.
+        - prefix (str): Leading part of the prompt shared with other requests,
+          whose state is taken from the prefix cache.
+        - usage (dict): If given, receives "prompt_tokens", "generated_tokens",
+          "generation_time" (seconds from submission to the last token),
+          "first_token_at" (time.perf_counter() of the first token) and the
+          time of each phase in "phases"; "batch_wait" is the time spent
+          waiting to join a batch.
+        - adapter (str): The LoRA adapter to generate with, if any; the
+          caller keeps it loaded until the future is done.
+        - cancellation (Cancellation): Stops the generation once cancelled.
+
+        Returns:
+        - concurrent.futures.Future: Resolves to the generated text, or
+          raises GenerationCancelled once `usage` is filled.
+        """
+
+        future = Future()
+        phases = None if usage is None else usage.setdefault("phases", {})
+        with phase(phases, "tokenize"):
+            prompt_ids = self.tokenizer(prompt)["input_ids"]
+            prefix_ids = None
+            if prefix and self.prefix_cache is not None:
+                prefix_ids = self.tokenizer(prefix)["input_ids"]
+        self._queue.put(
+            _Sequence(
+                prompt_ids,
+                max_new_tokens,
+                future,
+                prefix_ids,
+                usage,
+                adapter,
+                cancellation,
+            )
+        )
+        return future
+
+    async def generate(
+        self,
+        prompt,
+        max_new_tokens=300,
+        prefix=None,
+        usage=None,
+        adapter=None,
+        cancellation=None,
+    ):
+        future = self.submit(
+            prompt, max_new_tokens, prefix, usage, adapter, cancellation
+        )
+        if cancellation is None:
+            return await asyncio.wrap_future(future)
+        try:
+            # A sequence still waiting for the batch is dropped right away.
+            return await cancellation.guard(asyncio.wrap_future(future))
+        except GenerationCancelled:
+            if future.cancelled():
+                raise
+        # The sequence is in the batch and leaves it before the next step.
+        return await asyncio.wrap_future(future)
+
+    @property
+    def num_active(self):
+        return len(self._active)
+
+    @property
+    def num_waiting(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        while self._running:
+            new_sequences = self._collect()
+            if not self._running:
+                break
+            try:
+                with torch.inference_mode():
+                    if new_sequences:
+                        self._prefill(new_sequences)
+                    self._drop_cancelled()
+                    if self._active:
+                        self._decode_step()
+            except Exception as e:
+                logging.error(f"An error occurred in BatchScheduler: {str(e)}")
+                for seq in new_sequences + self._active:
+                    if not seq.future.done():
+                        seq.future.set_exception(e)
+                self._reset()
+
+        for seq in self._active:
+            seq.future.cancel()
+        self._reset()
+
+    def _collect(self):
+        free_slots = self.max_batch_size - len(self._active)
+        sequences = []
+
+        if not self._active:
+            # Idle: block for the first request, then wait up to max_wait_time
+            # for more to arrive so that they share a prefill.
+            item = self._queue.get()
+            if item is None:
+                return sequences
+            sequences.append(item)
+            deadline = time.monotonic() + self.max_wait_time
+            while len(sequences) < free_slots:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    break
+                sequences.append(item)
+        else:
+            # Busy: take whatever is waiting without delaying running sequences.
+            while len(sequences) < free_slots:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    break
+                sequences.append(item)
+
+        sequences = [
+            seq for seq in sequences if seq.future.set_running_or_notify_cancel()
+        ]
+        for seq in sequences:
+            if seq.cancellation is not None and seq.cancellation.cancelled:
+                seq.future.set_exception(GenerationCancelled(seq.cancellation.reason))
+        return [seq for seq in sequences if not seq.future.done()]
+
+    def _prefill(self, sequences):
+        uncached = []
+        for seq in sequences:
+            result = None
+            start = time.perf_counter()
+            if seq.prefix_ids is not None:
+                with use_adapters([seq.adapter]):
+                    result = self.prefix_cache.prefill(
+                        seq.prompt_ids, seq.prefix_ids, adapter=seq.adapter
+                    )
+            _record_prefill([seq], start)
+            if result is None:
+                uncached.append(seq)
+                continue
+            # Prefilled from the cached prefix state; joins the batch alone.
+            past_key_values, logits, _ = result
+            attention_mask = torch.ones(
+                (1, len(seq.prompt_ids)), dtype=torch.long, device=self.model.device
+            )
+            next_tokens = self._sample(logits[:, -1, :], [seq])
+            self._merge([seq], past_key_values, attention_mask)
+            self._advance([seq], next_tokens, offset=len(self._active) - 1)
+
+        if uncached:
+            self._prefill_batch(uncached)
+
+    def _prefill_batch(self, sequences):
+        max_len = max(len(seq.prompt_ids) for seq in sequences)
+        input_ids = torch.full(
+            (len(sequences), max_len), self.pad_token_id, dtype=torch.long
+        )
+        attention_mask = torch.zeros((len(sequences), max_len), dtype=torch.long)
+        for i, seq in enumerate(sequences):
+            length = len(seq.prompt_ids)
+            input_ids[i, max_len - length :] = torch.tensor(seq.prompt_ids)
+            attention_mask[i, max_len - length :] = 1
+
+        device = self.model.device
+        input_ids = input_ids.to(device)
+        attention_mask = attention_mask.to(device)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+        start = time.perf_counter()
+        with use_adapters([seq.adapter for seq in sequences]):
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                use_cache=True,
+            )
+        next_tokens = self._sample(outputs.logits[:, -1, :], sequences)
+        _record_prefill(sequences, start)
+
+        self._merge(sequences, outputs.past_key_values, attention_mask)
+        self._advance(sequences, next_tokens, offset=len(self._active) - len(sequences))
+
+    def _decode_step(self):
+        device = self.model.device
+        input_ids = torch.tensor(
+            [[seq.generated[-1]] for seq in self._active], device=device
+        )
+        position_ids = self._attention_mask.sum(-1, keepdim=True)
+        self._attention_mask = torch.cat(
+            [
+                self._attention_mask,
+                torch.ones((len(self._active), 1), dtype=torch.long, device=device),
+            ],
+            dim=-1,
+        )
+
+        with use_adapters([seq.adapter for seq in self._active]):
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=self._attention_mask,
+                position_ids=position_ids,
+                past_key_values=self._past_key_values,
+                use_cache=True,
+            )
+        self._past_key_values = outputs.past_key_values
+        next_tokens = self._sample(outputs.logits[:, -1, :], self._active)
+        self._advance(list(self._active), next_tokens, offset=0)
+
+    def _sample(self, logits, sequences):
+        if self.repetition_penalty != 1.0:
+            logits = self._penalize_repetitions(logits, sequences)
+        if not self.do_sample:
+            return torch.argmax(logits, dim=-1).tolist()
+        logits = self.logits_warpers(None, logits.float())
+        probs = torch.softmax(logits, dim=-1)
+        return torch.multinomial(probs, num_samples=1).squeeze(1).tolist()
+
+    def _penalize_repetitions(self, logits, sequences):
+        # Applies the repetition penalty as `generate` does, to every token of
+        # each row's own prompt and answer so far.
+        logits = logits.clone()
+        for row, seq in enumerate(sequences):
+            token_ids = torch.tensor(
+                seq.prompt_ids + seq.generated, device=logits.device
+            ).unique()
+            scores = logits[row, token_ids]
+            logits[row, token_ids] = torch.where(
+                scores < 0,
+                scores * self.repetition_penalty,
+                scores / self.repetition_penalty,
+            )
+        return logits
+
+    def _advance(self, sequences, next_tokens, offset):
+        finished = []
+        for i, (seq, token) in enumerate(zip(sequences, next_tokens)):
+            seq.generated.append(token)
+            if seq.usage is not None and len(seq.generated) == 1:
+                seq.usage["first_token_at"] = time.perf_counter()
+            if token == self.eos_token_id or len(seq.generated) >= seq.max_new_tokens:
+                finished.append(offset + i)
+                self._finish_usage(seq)
+                with phase(seq.phases, "detokenize"):
+                    text = self.tokenizer.decode(
+                        seq.generated, skip_special_tokens=True
+                    )
+                seq.future.set_result(text)
+        if finished:
+            self._remove(finished)
+
+    def _drop_cancelled(self):
+        cancelled = [
+            i
+            for i, seq in enumerate(self._active)
+            if seq.cancellation is not None and seq.cancellation.cancelled
+        ]
+        for i in cancelled:
+            seq = self._active[i]
+            self._finish_usage(seq)
+            seq.future.set_exception(GenerationCancelled(seq.cancellation.reason))
+        if cancelled:
+            self._remove(cancelled)
+
+    def _finish_usage(self, seq):
+        if seq.usage is None:
+            return
+        now = time.perf_counter()
+        seq.phases["decode"] = now - seq.usage["first_token_at"]
+        seq.usage["prompt_tokens"] = len(seq.prompt_ids)
+        seq.usage["generated_tokens"] = len(seq.generated)
+        seq.usage["generation_time"] = now - seq.submitted_at
+
+    def _merge(self, sequences, past_key_values, attention_mask):
+        if not self._active:
+            self._active = list(sequences)
+            self._past_key_values = past_key_values
+            self._attention_mask = attention_mask
+            return
+
+        current_len = self._attention_mask.shape[1]
+        new_len = attention_mask.shape[1]
+        target_len = max(current_len, new_len)
+
+        def left_pad(tensor, length):
+            pad = target_len - length
+            if pad == 0:
+                return tensor
+            if tensor.dim() == 2:
+                return F.pad(tensor, (pad, 0))
+            return F.pad(tensor, (0, 0, pad, 0))
+
+        self._past_key_values = tuple(
+            tuple(
+                torch.cat(
+                    [left_pad(current, current_len), left_pad(new, new_len)], dim=0
+                )
+                for current, new in zip(current_layer, new_layer)
+            )
+            for current_layer, new_layer in zip(self._past_key_values, past_key_values)
+        )
+        self._attention_mask = torch.cat(
+            [
+                left_pad(self._attention_mask, current_len),
+                left_pad(attention_mask, new_len),
+            ],
+            dim=0,
+        )
+        self._active.extend(sequences)
+
+    def _remove(self, indices):
+        removed = set(indices)
+        keep = [i for i in range(len(self._active)) if i not in removed]
+        if not keep:
+            self._reset()
+            return
+
+        device = self._attention_mask.device
+        index = torch.tensor(keep, device=device)
+        attention_mask = self._attention_mask.index_select(0, index)
+        # Drop the left padding columns that no remaining sequence uses.
+        start = int((attention_mask.sum(0) == 0).long().cumprod(0).sum())
+
+        self._attention_mask = attention_mask[:, start:]
+        self._past_key_values = tuple(
+            tuple(tensor.index_select(0, index)[:, :, start:, :] for tensor in layer)
+            for layer in self._past_key_values
+        )
+        self._active = [self._active[i] for i in keep]
+
+    def _reset(self):
+        self._active = []
+        self._past_key_values = None
+        self._attention_mask = None
+
+
+def _record_prefill(sequences, start):
+    # The time a sequence waited to join a batch ends when its prefill starts;
+    # prefill time accumulates over the prefix cache lookup and the forward pass.
+    now = time.perf_counter()
+    for seq in sequences:
+        if seq.phases is not None:
+            seq.phases.setdefault("batch_wait", start - seq.submitted_at)
+            seq.phases["prefill"] = seq.phases.get("prefill", 0.0) + now - start
+
+
+def create_scheduler(model, tokenizer, prefix_cache=None, **sampling):
+    """
+    Creates and starts a BatchScheduler for a loaded model.
+
+    Parameters:
+    - model: Preloaded model for text generation.
+    - tokenizer: Preloaded tokenizer for text generation.
+    - prefix_cache (PrefixCache): Cache of shared prompt prefix states.
+    - sampling: Sampling settings (do_sample, temperature, top_p, top_k,
+      repetition_penalty).
+
+    Returns:
+    - BatchScheduler: The running scheduler.
+    """
+
+    scheduler = BatchScheduler(model, tokenizer, prefix_cache=prefix_cache, **sampling)
+    scheduler.start()
+    logging.info(
+        f"Started batch scheduler (max_batch_size={scheduler.max_batch_size}, "
+        f"max_wait_time={scheduler.max_wait_time}s)"
+    )
+    return scheduler
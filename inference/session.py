@@ -0,0 +1,344 @@
+import copy
+import logging
+import time
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+from inference.cancellation import CancellationCriterion, GenerationCancelled
+from inference.lora import WithAdapter, use_adapters
+from inference.streaming import start_generation
+from tracing import phase
+
+# generation settings the batch scheduler honours besides the sampling ones:
+# answer length and token ids are passed per request or read from the
+# tokenizer
+SCHEDULER_SETTINGS = {
+    "max_new_tokens",
+    "pad_token_id",
+    "bos_token_id",
+    "eos_token_id",
+    "transformers_version",
+}
+
+
+class FirstTokenTimer(StoppingCriteria):
+    """
+    Stopping criterion that never stops generation; it records when the
+    first new token is produced, which separates prefill from decoding.
+    """
+
+    def __init__(self):
+        self.first_token_at = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        return False
+
+
+class GenerationSession:
+    """
+    Holds everything needed to generate text with one loaded model: the model
+    already placed on its device, its tokenizer and its generation config.
+
+    The session is built once when the model is loaded, so a request only
+    tokenizes its prompt and calls `generate` or `stream`.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        generation_config=None,
+        return_full_text=False,
+        return_attention_mask=True,
+        prefix_cache=None,
+        assisted=None,
+    ):
+        """
+        Parameters:
+        - model: The loaded model, already on its target device.
+        - tokenizer: The loaded tokenizer.
+        - generation_config (dict): Settings passed to `model.generate`.
+        - return_full_text (bool): Whether the returned text includes the prompt.
+        - return_attention_mask (bool): Whether to pass the attention mask to
+          the model.
+        - prefix_cache (PrefixCache): Cache of shared prompt prefix states.
+        - assisted (AssistedDecoder): Draft model to generate with assisted
+          decoding, if any.
+        """
+
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = model.device
+        self.return_full_text = return_full_text
+        self.return_attention_mask = return_attention_mask
+        self.prefix_cache = prefix_cache
+        self.assisted = assisted
+        # AssistedDecoder.generate takes the same arguments as model.generate
+        self._generator = assisted if assisted is not None else model
+
+        self.generation_config = copy.deepcopy(model.generation_config)
+        unused = self.generation_config.update(**(generation_config or {}))
+        if unused:
+            logging.warning(f"Ignored unknown generation settings: {unused}")
+        if self.generation_config.pad_token_id is None:
+            self.generation_config.pad_token_id = tokenizer.eos_token_id
+
+    def _encode(self, prompt):
+        inputs = self.tokenizer(
+            prompt,
+            return_tensors="pt",
+            return_attention_mask=self.return_attention_mask,
+        )
+        return inputs.to(self.device)
+
+    def _prefill_prefix(self, inputs, prefix, adapter=None):
+        # Returns the past_key_values for all but the last prompt token,
+        # starting from the cached prefix state, and the prefix hit.
+        if not prefix or self.prefix_cache is None:
+            return {}, None
+        input_ids = inputs["input_ids"][0].tolist()
+        prefix_ids = self.tokenizer(prefix)["input_ids"]
+        with use_adapters([adapter]):
+            result = self.prefix_cache.prefill(
+                input_ids, prefix_ids, keep_last=True, adapter=adapter
+            )
+        if result is None:
+            return {}, None
+        past_key_values, _, hit = result
+        return {"past_key_values": past_key_values}, hit
+
+    def generate(
+        self,
+        prompt,
+        prefix=None,
+        usage=None,
+        adapter=None,
+        cancellation=None,
+        **overrides,
+    ):
+        """
+        Generates text for a prompt.
+
+        Parameters:
+        - prompt (str): The text prompt to begin generation.
+        - prefix (str): Leading part of the prompt shared with other requests,
+          whose state is taken from the prefix cache.
+        - usage (dict): If given, receives "prompt_tokens", "generated_tokens",
+          "generation_time", "first_token_at" (time.perf_counter() of the
+          first token) and the time of each phase in "phases".
+        - adapter (str): The LoRA adapter to generate with, if any; the
+          caller keeps it loaded.
+        - cancellation (Cancellation): Stops the generation once cancelled.
+        - overrides: Generation settings that replace the session defaults.
+
+        Returns:
+        - str: The generated text.
+
+        Raises:
+        - GenerationCancelled: If `cancellation` stopped the generation;
+          `usage` is filled first.
+        """
+
+        start = time.perf_counter()
+        phases = None if usage is None else usage.setdefault("phases", {})
+        if phases is not None:
+            timer = FirstTokenTimer()
+            overrides.setdefault("stopping_criteria", StoppingCriteriaList())
+            overrides["stopping_criteria"].append(timer)
+        if cancellation is not None:
+            cancellation.check()
+            overrides.setdefault("stopping_criteria", StoppingCriteriaList())
+            overrides["stopping_criteria"].append(CancellationCriterion(cancellation))
+
+        with phase(phases, "tokenize"):
+            inputs = self._encode(prompt)
+        with torch.inference_mode():
+            with phase(phases, "prefill"):
+                cached, _ = self._prefill_prefix(inputs, prefix, adapter)
+            generate_start = time.perf_counter()
+            outputs = WithAdapter(self._generator, adapter).generate(
+                **inputs,
+                generation_config=self.generation_config,
+                **cached,
+                **overrides,
+            )
+            generate_end = time.perf_counter()
+        if phases is not None:
+            first_token_at = timer.first_token_at or generate_end
+            phases["prefill"] += first_token_at - generate_start
+            phases["decode"] = generate_end - first_token_at
+
+        prompt_len = inputs["input_ids"].shape[1]
+        tokens = outputs[0]
+        if not self.return_full_text:
+            tokens = tokens[prompt_len:]
+        with phase(phases, "detokenize"):
+            text = self.tokenizer.decode(tokens, skip_special_tokens=True)
+
+        if usage is not None:
+            usage["first_token_at"] = first_token_at
+            usage["prompt_tokens"] = prompt_len
+            usage["generated_tokens"] = outputs.shape[1] - prompt_len
+            usage["generation_time"] = time.perf_counter() - start
+        if cancellation is not None and cancellation.reason is not None:
+            raise GenerationCancelled(cancellation.reason)
+        return text
+
+    def generate_batch(
+        self, token_ids, usage=None, adapters=None, cancellation=None, **overrides
+    ):
+        """
+        Generates text for several tokenized prompts in one left-padded batch.
+        Assisted decoding and the prefix cache are not used, since both work
+        on one sequence at a time.
+
+        Parameters:
+        - token_ids (list): The token ids of each prompt.
+        - usage (dict): If given, receives "prompt_tokens", "generated_tokens"
+          and "generation_time" for the whole batch.
+        - adapters (list): The LoRA adapter of each prompt, None for the base
+          model; the caller keeps them loaded.
+        - cancellation (Cancellation): Stops the whole batch once cancelled.
+        - overrides: Generation settings that replace the session defaults.
+
+        Returns:
+        - list: The generated text of each prompt.
+
+        Raises:
+        - GenerationCancelled: If `cancellation` stopped the generation;
+          `usage` is filled first.
+        """
+
+        start = time.perf_counter()
+        if cancellation is not None:
+            cancellation.check()
+            overrides["stopping_criteria"] = StoppingCriteriaList(
+                [CancellationCriterion(cancellation)]
+            )
+        pad_token_id = self.generation_config.pad_token_id
+        max_len = max(len(ids) for ids in token_ids)
+        input_ids = torch.full((len(token_ids), max_len), pad_token_id)
+        attention_mask = torch.zeros((len(token_ids), max_len), dtype=torch.long)
+        for i, ids in enumerate(token_ids):
+            input_ids[i, max_len - len(ids) :] = torch.tensor(ids)
+            attention_mask[i, max_len - len(ids) :] = 1
+
+        with torch.inference_mode(), use_adapters(adapters):
+            outputs = self.model.generate(
+                input_ids=input_ids.to(self.device),
+                attention_mask=attention_mask.to(self.device),
+                generation_config=self.generation_config,
+                **overrides,
+            )
+
+        new_tokens = outputs[:, max_len:]
+        if self.return_full_text:
+            rows = [outputs[i, max_len - len(ids) :] for i, ids in enumerate(token_ids)]
+        else:
+            rows = new_tokens
+        texts = self.tokenizer.batch_decode(rows, skip_special_tokens=True)
+
+        if usage is not None:
+            usage["prompt_tokens"] = sum(len(ids) for ids in token_ids)
+            usage["generated_tokens"] = int((new_tokens != pad_token_id).sum())
+            usage["generation_time"] = time.perf_counter() - start
+        if cancellation is not None and cancellation.reason is not None:
+            raise GenerationCancelled(cancellation.reason)
+        return texts
+
+    def stream(
+        self,
+        prompt,
+        prefix=None,
+        on_finish=None,
+        usage=None,
+        adapter=None,
+        cancellation=None,
+        **overrides,
+    ):
+        """
+        Starts generating text for a prompt and streams it token by token.
+
+        Parameters:
+        - prompt (str): The text prompt to begin generation.
+        - prefix (str): Leading part of the prompt shared with other requests.
+        - on_finish (callable): Called once generation is done.
+        - usage (dict): If given, receives the time of the phases before
+          generation starts in "phases".
+        - adapter (str): The LoRA adapter to generate with, if any; the
+          caller keeps it loaded until `on_finish`.
+        - cancellation (Cancellation): Ends the stream once cancelled.
+        - overrides: Generation settings that replace the session defaults.
+
+        Returns:
+        - TokenCountingStreamer: Iterator over the generated text.
+        """
+
+        phases = None if usage is None else usage.setdefault("phases", {})
+        if cancellation is not None:
+            cancellation.check()
+            overrides["stopping_criteria"] = StoppingCriteriaList(
+                [CancellationCriterion(cancellation)]
+            )
+        with phase(phases, "tokenize"):
+            inputs = self._encode(prompt)
+        with torch.inference_mode(), phase(phases, "prefill"):
+            cached, hit = self._prefill_prefix(inputs, prefix, adapter)
+        streamer = start_generation(
+            WithAdapter(self._generator, adapter),
+            self.tokenizer,
+            inputs,
+            on_finish=on_finish,
+            generation_config=self.generation_config,
+            **cached,
+            **overrides,
+        )
+        streamer.prefix_hit = hit
+        streamer.cancellation = cancellation
+        streamer.prompt_tokens = inputs["input_ids"].shape[1]
+        return streamer
+
+    def calibrate(self, prompt, max_new_tokens):
+        """
+        Measures the plain decoding speed that assisted decoding is compared
+        with. Does nothing without a draft model.
+        """
+
+        if self.assisted is None:
+            return
+        self.assisted.calibrate(
+            self._encode(prompt),
+            max_new_tokens,
+            pad_token_id=self.generation_config.pad_token_id,
+        )
+
+    @property
+    def sampling(self):
+        """
+        The sampling settings understood by BatchScheduler. Other settings
+        are logged, since batched answers are generated without them.
+        """
+
+        config = self.generation_config
+        sampling = {
+            "do_sample": config.do_sample,
+            "temperature": config.temperature,
+            "top_p": config.top_p,
+            "top_k": config.top_k,
+            "repetition_penalty": config.repetition_penalty,
+        }
+        ignored = sorted(
+            name
+            for name in config.to_diff_dict()
+            if name not in sampling
+            and name not in SCHEDULER_SETTINGS
+            and not name.startswith("_")
+        )
+        if ignored:
+            logging.warning(
+                f"Batch scheduler ignores the generation settings {ignored}"
+            )
+        return sampling
@@ -0,0 +1,127 @@
+import json
+import logging
+import time
+from threading import Thread
+
+from starlette.concurrency import run_in_threadpool
+from transformers import TextIteratorStreamer
+
+from inference.cancellation import GenerationCancelled
+
+
+class TokenCountingStreamer(TextIteratorStreamer):
+    """
+    TextIteratorStreamer that also counts the tokens generated after the prompt
+    and keeps any error raised by the generation thread.
+    """
+
+    def __init__(self, tokenizer, **decode_kwargs):
+        super().__init__(
+            tokenizer, skip_prompt=True, skip_special_tokens=True, **decode_kwargs
+        )
+        self.num_tokens = 0
+        self.prompt_tokens = None
+        self.error = None
+        self.prefix_hit = None
+        self.cancellation = None
+
+    def put(self, value):
+        if not self.next_tokens_are_prompt:
+            self.num_tokens += value.numel()
+        super().put(value)
+
+
+def start_generation(model, tokenizer, inputs, on_finish=None, **generate_kwargs):
+    """
+    Starts `model.generate` in a background thread and returns a streamer that
+    yields the decoded text as soon as each token is produced.
+
+    Parameters:
+    - model: Preloaded model for text generation, or an AssistedDecoder.
+    - tokenizer: Preloaded tokenizer for text generation.
+    - inputs (dict): Tokenized prompt, already placed on the model's device.
+    - on_finish (callable): Called from the generation thread once it is done.
+    - generate_kwargs: Extra keyword arguments passed to `model.generate`.
+
+    Returns:
+    - TokenCountingStreamer: Iterator over the generated text chunks.
+    """
+
+    streamer = TokenCountingStreamer(tokenizer)
+
+    def run():
+        try:
+            model.generate(**inputs, streamer=streamer, **generate_kwargs)
+        except Exception as e:
+            logging.error(f"An error occurred in streamed generation: {str(e)}")
+            streamer.error = e
+            streamer.end()
+        finally:
+            if on_finish is not None:
+                on_finish()
+
+    Thread(target=run, daemon=True).start()
+    return streamer
+
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def sse_events(streamer, on_complete=None):
+    """
+    Turns a streamer into Server-Sent Events. Every text chunk is sent as a
+    `token` event; the closing `done` event reports the time to first token,
+    the number of generated tokens and the total generation time. A stream
+    whose generation failed or was cancelled ends with an `error` event.
+
+    The streamer blocks until its next chunk, so it is read in the threadpool
+    while the events are produced on the event loop.
+
+    Parameters:
+    - streamer (TokenCountingStreamer): Streamer returned by `start_generation`.
+    - on_complete (callable): Called on the event loop with the streamer, the
+      time to first token and the total time once the stream ends.
+
+    Yields:
+    - str: Encoded Server-Sent Events.
+    """
+
+    start = time.perf_counter()
+    time_to_first_token = None
+
+    while True:
+        text = await run_in_threadpool(next, streamer, None)
+        if text is None:
+            break
+        if not text:
+            continue
+        if time_to_first_token is None:
+            time_to_first_token = time.perf_counter() - start
+        yield format_sse("token", {"text": text})
+
+    total_time = time.perf_counter() - start
+    if on_complete is not None:
+        on_complete(streamer, time_to_first_token, total_time)
+
+    if streamer.error is not None:
+        yield format_sse("error", {"success": False, "error": str(streamer.error)})
+        return
+    cancellation = streamer.cancellation
+    if cancellation is not None and cancellation.reason is not None:
+        error = GenerationCancelled(cancellation.reason)
+        yield format_sse("error", {"success": False, "error": str(error)})
+        return
+
+    hit = streamer.prefix_hit
+    yield format_sse(
+        "done",
+        {
+            "success": True,
+            "time_to_first_token": time_to_first_token,
+            "num_tokens": streamer.num_tokens,
+            "total_time": total_time,
+            "prefix_tokens_reused": hit.length if hit else 0,
+            "prefill_time_saved": hit.prefill_time if hit else 0.0,
+        },
+    )
@@ -0,0 +1,219 @@
+import fcntl
+import glob
+import json
+import logging
+import mmap
+import os
+import resource
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import torch
+
+from config import MODEL_LOAD_WORKERS
+
+CACHE_INFO_FILE = "cache_info.json"
+CACHE_FORMAT = "safetensors"
+READ_CHUNK_SIZE = 16 * 1024 * 1024
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def read_cache_info(model_path):
+    """
+    Reads the description of a local model cache.
+
+    Parameters:
+    - model_path (str): Directory of the cached model.
+
+    Returns:
+    - dict: The cache description, or None if the directory is not a cache
+      written by write_cache_info (e.g. an older `.bin` cache).
+    """
+
+    try:
+        with open(os.path.join(model_path, CACHE_INFO_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_cache_info(model_path, **info):
+    with open(os.path.join(model_path, CACHE_INFO_FILE), "w") as f:
+        json.dump({"format": CACHE_FORMAT, **info}, f)
+
+
+def is_cache_valid(model_path, **expected):
+    """
+    Checks that a local cache holds safetensors weights matching `expected`,
+    e.g. is_cache_valid(path, dtype="torch.float16").
+    """
+
+    info = read_cache_info(model_path)
+    if info is None or info.get("format") != CACHE_FORMAT:
+        return False
+    return all(info.get(key) == value for key, value in expected.items())
+
+
+def shard_files(model_path):
+    return sorted(glob.glob(os.path.join(model_path, "*.safetensors")))
+
+
+def _read_file(path):
+    with open(path, "rb", buffering=0) as f:
+        while f.read(READ_CHUNK_SIZE):
+            pass
+
+
+def prefetch_shards(model_path, workers=MODEL_LOAD_WORKERS):
+    """
+    Reads all safetensors shards of a cached model in parallel so they are in
+    the page cache when they are memory-mapped, instead of being faulted in
+    one shard at a time.
+
+    Parameters:
+    - model_path (str): Directory of the cached model.
+    - workers (int): Number of shards read at the same time.
+    """
+
+    files = shard_files(model_path)
+    if len(files) < 2 or workers < 2:
+        return
+    with ThreadPoolExecutor(max_workers=min(workers, len(files))) as pool:
+        list(pool.map(_read_file, files))
+
+
+def mmap_state_dict(model_path):
+    """
+    Maps the safetensors shards of a cached model into memory and returns
+    tensors that view the mapping instead of copies of the weights.
+
+    The files are mapped copy-on-write: the pages come from the page cache,
+    so every process that maps the same files shares one copy of the
+    weights, and a process writing to a tensor only gets a private copy of
+    the pages it writes.
+
+    Parameters:
+    - model_path (str): Directory of the cached model.
+
+    Returns:
+    - dict: The tensors of all shards by name.
+    """
+
+    state_dict = {}
+    for path in shard_files(model_path):
+        with open(path, "rb") as f:
+            header_size = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(header_size))
+            # the mapping stays open as long as a tensor refers to it
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        data_start = 8 + header_size
+        for name, info in header.items():
+            if name == "__metadata__":
+                continue
+            dtype = SAFETENSORS_DTYPES[info["dtype"]]
+            begin, end = info["data_offsets"]
+            count = (end - begin) // dtype.itemsize
+            if count == 0:
+                tensor = torch.empty(0, dtype=dtype)
+            else:
+                tensor = torch.frombuffer(
+                    mapping, dtype=dtype, count=count, offset=data_start + begin
+                )
+            state_dict[name] = tensor.view(info["shape"])
+    return state_dict
+
+
+@contextmanager
+def cache_lock(model_path):
+    """
+    Holds an exclusive lock on a model's local cache, so that only one
+    process (e.g. one of several uvicorn workers) writes the cache while the
+    others wait and then read it.
+    """
+
+    os.makedirs(os.path.dirname(model_path) or ".", exist_ok=True)
+    with open(model_path.rstrip("/") + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _proc_status(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def current_rss():
+    """Returns the resident set size of this process in bytes."""
+    return _proc_status("VmRSS") or 0
+
+
+def memory_usage():
+    """
+    Returns the memory of this process in bytes: the resident set ("rss"),
+    split into private anonymous memory ("anonymous"), file-backed pages
+    such as memory-mapped weights, which other processes mapping the same
+    files share ("file"), and shared memory ("shmem"); and the proportional
+    set size ("pss"), which splits shared pages among the processes using
+    them. Values that cannot be read are None.
+    """
+
+    pss = None
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    pss = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+    return {
+        "rss": current_rss(),
+        "anonymous": _proc_status("RssAnon"),
+        "file": _proc_status("RssFile"),
+        "shmem": _proc_status("RssShmem"),
+        "pss": pss,
+    }
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process in bytes."""
+    peak = _proc_status("VmHWM")
+    if peak is None:
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return peak
+
+
+def reset_peak_rss():
+    """
+    Resets the peak RSS so that peak_rss() reports the peak of what follows.
+    Only supported on Linux; elsewhere the peak covers the process lifetime.
+    """
+
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        logging.debug("Unable to reset peak RSS")
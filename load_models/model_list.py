@@ -1,6 +1,13 @@
 # Temporary setup for testing purposes.
 # Currently supports model names "meta-llama/Llama-2-7b-chat-hf" and "microsoft/phi-1_5".
 # To extend functionality, add additional models of interest to the "models" dictionary below.
+# "quantization" applies when serving on CPU: "none" (float32), "dynamic-int8"
+# or "bf16".
+# "draft_model" enables assisted (speculative) decoding with a small model that shares
+# the tokenizer, e.g. "TinyLlama/TinyLlama-1.1B-Chat-v1.0" for Llama 2.
+# "lora_target_modules" lets the model serve LoRA adapters that change those layers;
+# "lora_adapters" maps adapter names to PEFT adapter directories or Hub ids, and a
+# request selects one with selectedModel "<model>@<adapter>".
 models = {
     "Llama-2-7b-chat-hf": {
         "name": "meta-llama/Llama-2-7b-chat-hf",
@@ -9,6 +16,34 @@ models = {
         "trust_remote_code": False,
         "additional_packages": [],
         "preload": False,
+        "pinned": False,
+        "quantization": "none",
+        "draft_model": None,
+        "lora_target_modules": [
+            "q_proj",
+            "k_proj",
+            "v_proj",
+            "o_proj",
+            "gate_proj",
+            "up_proj",
+            "down_proj",
+        ],
+        "lora_adapters": {},
+        "continuous_batching": True,
+        "max_concurrency": 8,
+        "generation_config": {
+            "max_new_tokens": 300,
+            "do_sample": True,
+            "temperature": 0.1,
+            "top_p": 0.95,
+            "top_k": 40,
+            "repetition_penalty": 1.1,
+        },
+        "return_full_text": False,
+        "return_attention_mask": True,
+        "prefix_cache": True,
+        # maximum prompt tokens; None uses the context window minus max_new_tokens
+        "prompt_token_budget": None,
         "prompt_template": """<s>[INST]<<SYS>>\n{{ system }}\n<</SYS>>\n\n[/INST]</s><s>{% for item in instructions %}[INST]{{ item.question }}[/INST]{{ item.answer }}</s>{% endfor %}<s>[INST]{{ question }}[/INST]""",
     },
     "phi-1_5": {
@@ -18,6 +53,17 @@ models = {
         "trust_remote_code": True,
         "additional_packages": ["einops"],
         "preload": True,
+        "pinned": True,
+        "quantization": "none",
+        "draft_model": None,
+        "lora_target_modules": None,
+        "lora_adapters": {},
+        "continuous_batching": False,
+        "max_concurrency": 1,
+        "generation_config": {"max_length": 50},
+        "return_full_text": True,
+        "return_attention_mask": False,
+        "prefix_cache": False,
         "prompt_template": [],
     },
 }
@@ -1,9 +1,90 @@
 import os
 import logging
+import time
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from accelerate import init_empty_weights
+from transformers import (
+    AutoConfig,
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    GenerationConfig,
+)
 
-from config import HUGGINGFACE_ACCESS_TOKEN, CACHE_DIR, DEVICE_TYPE
+from config import (
+    HUGGINGFACE_ACCESS_TOKEN,
+    CACHE_DIR,
+    DEVICE_TYPE,
+    MODEL_SHARD_SIZE,
+    SHARED_WEIGHTS,
+)
+from inference.assisted import AssistedDecoder
+from inference.lora import AdapterManager
+from inference.prefix_cache import PrefixCache
+from inference.prompt_builder import create_prompt_builder
+from inference.scheduler import create_scheduler
+from inference.session import GenerationSession
+from load_models.quantization import (
+    QUANTIZATION_MODES,
+    cpu_dtype,
+    has_dynamic_int8,
+    load_dynamic_int8,
+    quantize_dynamic_int8,
+    save_dynamic_int8,
+)
+from load_models.local_cache import (
+    cache_lock,
+    current_rss,
+    is_cache_valid,
+    mmap_state_dict,
+    peak_rss,
+    prefetch_shards,
+    read_cache_info,
+    reset_peak_rss,
+    write_cache_info,
+)
+
+
+def load_shared_model(model_path, dtype, trust_remote=False):
+    """
+    Builds a model whose weights are views of its memory-mapped safetensors
+    cache, so that processes serving the same model share one copy of the
+    weights in RAM.
+
+    Parameters:
+    - model_path (str): Directory of the cached model.
+    - dtype (torch.dtype): The dtype the cache was written in.
+    - trust_remote (bool): Whether to trust remote code.
+
+    Returns:
+    - The model, in eval mode, on the CPU.
+    """
+
+    config = AutoConfig.from_pretrained(model_path, trust_remote_code=trust_remote)
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(
+            config, torch_dtype=dtype, trust_remote_code=trust_remote
+        )
+
+    for name, tensor in mmap_state_dict(model_path).items():
+        module_name, _, tensor_name = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        if tensor_name in module._parameters:
+            module._parameters[tensor_name] = torch.nn.Parameter(
+                tensor, requires_grad=False
+            )
+        elif tensor_name in module._buffers:
+            module._buffers[tensor_name] = tensor
+    # tied weights, like lm_head, are saved once
+    model.tie_weights()
+    missing = [name for name, param in model.named_parameters() if param.is_meta]
+    if missing:
+        raise ValueError(f"Weights missing from {model_path}: {missing[:5]}")
+
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(model_path)
+    except OSError:
+        pass
+    return model.eval()
 
 
 def load_model(
@@ -11,6 +92,7 @@ def load_model(
     require_auth: bool = False,
     trust_remote: bool = False,
     cache_dir: str = CACHE_DIR,
+    quantization: str = "none",
 ):
     """
     Loads a given model from Hugging Face or a local cache.
@@ -20,86 +102,191 @@ def load_model(
     - require_auth (bool): Whether authentication is required. Default is False.
     - trust_remote (bool): Whether to trust remote code. Default is False.
     - cache_dir (str): Directory to store cached models. Default is "./load_models/models".
+    - quantization (str): CPU quantization mode, one of "none", "dynamic-int8"
+      and "bf16". Ignored on the GPU. Default is "none".
 
     Returns:
     - tuple: Loaded model and its tokenizer.
+
+    Raises:
+    - ValueError: If `quantization` is not a known mode.
     """
 
+    if quantization not in QUANTIZATION_MODES:
+        raise ValueError(
+            f"Unknown quantization {quantization!r} for {model_name}; use one of "
+            f"{', '.join(QUANTIZATION_MODES)}"
+        )
     hf_auth = HUGGINGFACE_ACCESS_TOKEN if require_auth else None
     model_path = os.path.join(cache_dir, model_name)
 
     try:
         device = "cuda" if DEVICE_TYPE == "gpu" and torch.cuda.is_available() else "cpu"
-        dtype = torch.float16 if device == "cuda" else torch.float32
-
-        if not os.path.exists(model_path):
-            model = AutoModelForCausalLM.from_pretrained(
-                model_name,
-                torch_dtype=dtype,
-                token=hf_auth,
-                trust_remote_code=trust_remote,
-            ).to(device)
-            tokenizer = AutoTokenizer.from_pretrained(
-                model_name,
-                use_fast=True,
-                token=hf_auth,
-                trust_remote_code=trust_remote,
-            )
+        dtype = torch.float16 if device == "cuda" else cpu_dtype(quantization)
+        quantize_int8 = device == "cpu" and quantization == "dynamic-int8"
+        if device == "cuda" and quantization != "none":
+            logging.info(f"Quantization {quantization} only applies on CPU")
+        # load shards straight onto the GPU instead of staging them in RAM
+        device_map = {"": device} if device == "cuda" else None
+        # int8 weights are repacked in memory, so they cannot be mapped
+        shared = SHARED_WEIGHTS and device == "cpu" and not quantize_int8
+
+        reset_peak_rss()
+        start = time.perf_counter()
 
-            if require_auth:
-                tokenizer.pad_token = tokenizer.eos_token
+        # Several workers may load the same model at once; the first one
+        # writes the local cache and the others wait to read it.
+        with cache_lock(model_path):
+            if (
+                quantize_int8
+                and is_cache_valid(model_path, dtype=str(dtype))
+                and has_dynamic_int8(model_path)
+            ):
+                tokenizer = AutoTokenizer.from_pretrained(
+                    model_path, trust_remote_code=trust_remote
+                )
+                model = load_dynamic_int8(model_path, trust_remote)
+                quantize_int8 = False
+                logging.info(f"Model {model_name} loaded from local int8 weights")
+            elif not is_cache_valid(model_path, dtype=str(dtype)):
+                # Older caches hold `.bin` weights; convert them instead of
+                # downloading again. A cache in another dtype is not reused, so
+                # that weights are never upcast from a lower precision.
+                is_legacy_cache = (
+                    os.path.exists(model_path) and read_cache_info(model_path) is None
+                )
+                source = model_path if is_legacy_cache else model_name
+                model = AutoModelForCausalLM.from_pretrained(
+                    source,
+                    torch_dtype=dtype,
+                    token=hf_auth,
+                    trust_remote_code=trust_remote,
+                    low_cpu_mem_usage=True,
+                )
+                tokenizer = AutoTokenizer.from_pretrained(
+                    source,
+                    use_fast=True,
+                    token=hf_auth,
+                    trust_remote_code=trust_remote,
+                )
 
-            logging.info(f"Model {model_name} loaded from Hugging Face")
+                if require_auth:
+                    tokenizer.pad_token = tokenizer.eos_token
 
-            tokenizer.save_pretrained(model_path)
-            model.save_pretrained(model_path)
-            logging.info(f"Model {model_name} saved locally for future use")
-        else:
-            tokenizer = AutoTokenizer.from_pretrained(
-                model_path, trust_remote_code=trust_remote
-            )
-            model = AutoModelForCausalLM.from_pretrained(
-                model_path, torch_dtype=dtype, trust_remote_code=trust_remote
-            ).to(device)
-            logging.info(f"Model {model_name} loaded from local")
+                logging.info(f"Model {model_name} loaded from {source}")
+
+                tokenizer.save_pretrained(model_path)
+                model.save_pretrained(
+                    model_path, safe_serialization=True, max_shard_size=MODEL_SHARD_SIZE
+                )
+                write_cache_info(model_path, dtype=str(dtype))
+                logging.info(f"Model {model_name} saved locally as {dtype} safetensors")
+                if shared:
+                    # serve from the cache like the other workers will
+                    model = load_shared_model(model_path, dtype, trust_remote)
+                model = model.to(device)
+            else:
+                prefetch_shards(model_path)
+                tokenizer = AutoTokenizer.from_pretrained(
+                    model_path, trust_remote_code=trust_remote
+                )
+                if shared:
+                    model = load_shared_model(model_path, dtype, trust_remote)
+                    logging.info(f"Model {model_name} mapped from local shared weights")
+                else:
+                    model = AutoModelForCausalLM.from_pretrained(
+                        model_path,
+                        torch_dtype=dtype,
+                        trust_remote_code=trust_remote,
+                        use_safetensors=True,
+                        low_cpu_mem_usage=True,
+                        device_map=device_map,
+                    )
+                    if device_map is None:
+                        model = model.to(device)
+                    logging.info(f"Model {model_name} loaded from local")
+
+            if quantize_int8:
+                model = quantize_dynamic_int8(model)
+                save_dynamic_int8(model, model_path)
+                logging.info(f"Model {model_name} quantized to dynamic int8")
+
+        logging.info(
+            f"Model {model_name} load time: {time.perf_counter() - start:.1f}s, "
+            f"peak RSS: {peak_rss() / 1024**2:.0f} MB, "
+            f"RSS: {current_rss() / 1024**2:.0f} MB"
+        )
     except Exception as e:
         logging.error(f"An error occurred while loading the model: {str(e)}")
         return None, None
     return model, tokenizer
 
 
-def load_models(models):
+def build_model_entry(
+    model, tokenizer, model_config, draft_model=None, adapter_sources=None
+):
     """
-    Preloads models based on a given dictionary of model configurations.
+    Builds the `loaded_models` entry for a loaded model.
 
     Parameters:
-    - models (dict): A dictionary containing model configurations.
+    - model: The loaded model.
+    - tokenizer: The loaded tokenizer.
+    - model_config (dict): The model's configuration from model_list.py.
+    - draft_model: The loaded draft model for assisted decoding, if any.
+    - adapter_sources (dict): Paths of the model's LoRA adapters, by name.
 
     Returns:
-    - dict: A dictionary containing the loaded models and tokenizers.
+    - dict: The model, its tokenizer, its GenerationSession, its PromptBuilder
+      and, when enabled, its PrefixCache, its AssistedDecoder, its
+      AdapterManager and running BatchScheduler.
     """
 
-    loaded_models = {}
+    adapters = None
+    if model_config.get("lora_target_modules"):
+        adapters = AdapterManager(
+            model,
+            model_config["lora_target_modules"],
+            adapter_sources if adapter_sources is not None else {},
+        )
 
-    for key, value in models.items():
-        preload = value["preload"]
-        if preload:
-            model_name = value["name"]
-            require_auth = value["require_auth"]
-            trust_remote_code = value["trust_remote_code"]
+    prefix_cache = None
+    if model_config.get("prefix_cache", False):
+        prefix_cache = PrefixCache(model)
 
-            try:
-                model, tokenizer = load_model(
-                    model_name, require_auth, trust_remote_code
-                )
-
-                if model is not None and tokenizer is not None:
-                    loaded_models[model_name] = {"model": model, "tokenizer": tokenizer}
-                else:
-                    logging.warning(f"Skipped loading model: {model_name}")
-            except Exception as e:
-                logging.error(
-                    f"An error occurred while loading the model {model_name}: {str(e)}"
-                )
+    assisted = None
+    if draft_model is not None:
+        assisted = AssistedDecoder(
+            model, draft_model, draft_name=model_config.get("draft_model")
+        )
 
-    return loaded_models
+    session = GenerationSession(
+        model,
+        tokenizer,
+        generation_config=model_config.get("generation_config"),
+        return_full_text=model_config.get("return_full_text", False),
+        return_attention_mask=model_config.get("return_attention_mask", True),
+        prefix_cache=prefix_cache,
+        assisted=assisted,
+    )
+    prompt_builder = create_prompt_builder(
+        tokenizer, model, model_config, session.generation_config.max_new_tokens
+    )
+    entry = {
+        "model": model,
+        "tokenizer": tokenizer,
+        "session": session,
+        "prompt_builder": prompt_builder,
+        "prefix_cache": prefix_cache,
+        "assisted": assisted,
+        "adapters": adapters,
+    }
+    if assisted is not None:
+        # Assisted decoding works on one sequence at a time, so requests go
+        # through the session instead of the batch scheduler.
+        if model_config.get("continuous_batching", False):
+            logging.info("Continuous batching is disabled for assisted decoding")
+    elif model_config.get("continuous_batching", False):
+        entry["scheduler"] = create_scheduler(
+            model, tokenizer, prefix_cache=prefix_cache, **session.sampling
+        )
+    return entry
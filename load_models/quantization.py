@@ -0,0 +1,108 @@
+import logging
+import os
+
+import torch
+from accelerate import init_empty_weights
+from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+from transformers import AutoConfig, AutoModelForCausalLM, GenerationConfig
+
+QUANTIZATION_MODES = ("none", "dynamic-int8", "bf16")
+DYNAMIC_INT8_WEIGHTS_FILE = "dynamic-int8.pt"
+
+
+def cpu_dtype(quantization):
+    """Returns the dtype weights are loaded in for a CPU quantization mode."""
+    return torch.bfloat16 if quantization == "bf16" else torch.float32
+
+
+def quantize_dynamic_int8(model):
+    """
+    Converts every nn.Linear of a float32 model to a dynamically quantized
+    int8 Linear: weights are stored as int8 and activations are quantized on
+    the fly, which shrinks the weights to a quarter and speeds up CPU matmuls.
+
+    Parameters:
+    - model: A float32 model on the CPU.
+
+    Returns:
+    - The quantized model.
+    """
+
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+    )
+
+
+def apply_quantization(model, quantization):
+    """
+    Applies a quantization mode from model_list.py to a loaded CPU model.
+
+    Parameters:
+    - model: The loaded model, in cpu_dtype(quantization).
+    - quantization (str): One of QUANTIZATION_MODES.
+
+    Returns:
+    - The quantized model.
+    """
+
+    if quantization == "dynamic-int8":
+        return quantize_dynamic_int8(model)
+    return model
+
+
+def save_dynamic_int8(model, model_path):
+    torch.save(model.state_dict(), os.path.join(model_path, DYNAMIC_INT8_WEIGHTS_FILE))
+    logging.info(f"Saved int8 weights to {model_path}")
+
+
+def has_dynamic_int8(model_path):
+    return os.path.exists(os.path.join(model_path, DYNAMIC_INT8_WEIGHTS_FILE))
+
+
+def load_dynamic_int8(model_path, trust_remote=False):
+    """
+    Loads a model saved by save_dynamic_int8 without materializing the
+    float32 weights: the model is built on the meta device, its Linear layers
+    are replaced by empty int8 ones and the saved state dict is loaded in.
+
+    Parameters:
+    - model_path (str): Directory of the cached model.
+    - trust_remote (bool): Whether to trust remote code.
+
+    Returns:
+    - The quantized model.
+    """
+
+    config = AutoConfig.from_pretrained(model_path, trust_remote_code=trust_remote)
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(
+            config, torch_dtype=torch.float32, trust_remote_code=trust_remote
+        )
+
+    for name, module in list(model.named_modules()):
+        if isinstance(module, torch.nn.Linear):
+            parent_name, _, child_name = name.rpartition(".")
+            parent = model.get_submodule(parent_name) if parent_name else model
+            setattr(
+                parent,
+                child_name,
+                DynamicQuantizedLinear(
+                    module.in_features,
+                    module.out_features,
+                    bias_=module.bias is not None,
+                    dtype=torch.qint8,
+                ),
+            )
+
+    state_dict = torch.load(
+        os.path.join(model_path, DYNAMIC_INT8_WEIGHTS_FILE), map_location="cpu"
+    )
+    # assign=True puts the loaded tensors in place of the meta parameters;
+    # buffers were created on the CPU by from_config and are kept.
+    model.load_state_dict(state_dict, assign=True)
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(model_path)
+    except OSError:
+        pass
+    model.eval()
+    return model
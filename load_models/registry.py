@@ -0,0 +1,466 @@
+import asyncio
+import gc
+import logging
+import os
+import time
+from collections import OrderedDict, defaultdict, deque
+from itertools import chain
+
+import torch
+
+import metrics
+from config import (
+    MODEL_RAM_BUDGET_GB,
+    MODEL_VRAM_BUDGET_GB,
+    WARMUP_MAX_NEW_TOKENS,
+    WARMUP_PROMPT,
+)
+from load_models.local_cache import memory_usage
+from load_models.model_loader import build_model_entry, load_model
+
+GB = 1024**3
+
+
+def add_footprints(*footprints):
+    total = defaultdict(int)
+    for footprint in footprints:
+        for device_type, size in footprint.items():
+            total[device_type] += size
+    return dict(total)
+
+
+def model_footprint(model):
+    """
+    Measures the memory held by a model's parameters and buffers, including
+    the packed weights of quantized layers.
+
+    Parameters:
+    - model: The loaded model.
+
+    Returns:
+    - dict: Bytes used per device type, e.g. {"cpu": 0, "cuda": 2843770880}.
+    """
+
+    footprint = defaultdict(int)
+    seen = set()
+
+    def add(tensor):
+        if isinstance(tensor, (tuple, list)):
+            for item in tensor:
+                add(item)
+        elif isinstance(tensor, torch.Tensor) and id(tensor) not in seen:
+            seen.add(id(tensor))
+            footprint[tensor.device.type] += tensor.numel() * tensor.element_size()
+
+    for tensor in chain(model.parameters(), model.buffers()):
+        add(tensor)
+    for tensor in model.state_dict(keep_vars=True).values():
+        add(tensor)
+    return dict(footprint)
+
+
+class ModelRegistry:
+    """
+    Keeps track of the models resident in memory.
+
+    Models are loaded on first use and kept in least-recently-used order.
+    When the RAM (cpu) or VRAM (cuda) budget is exceeded, the least recently
+    used model that is neither pinned nor in use is unloaded. A model is in
+    use while a request holds a lease on it, from `acquire` to `release`, or
+    while it has requests running or waiting for an inference slot.
+    Concurrent requests for a model that is still loading share the same
+    load. The teardown of an evicted model runs in a worker thread.
+
+    Each model goes through the states "loading" and "warming" (a short
+    synthetic generation) before it is "ready"; a load that fails leaves it
+    "failed". Models that are not resident are "unloaded".
+    """
+
+    def __init__(
+        self,
+        models,
+        ram_budget=MODEL_RAM_BUDGET_GB * GB,
+        vram_budget=MODEL_VRAM_BUDGET_GB * GB,
+        is_busy=None,
+        max_events=100,
+    ):
+        """
+        Parameters:
+        - models (dict): Model configurations from model_list.py.
+        - ram_budget (float): Bytes of RAM models may use, 0 for no limit.
+        - vram_budget (float): Bytes of VRAM models may use, 0 for no limit.
+        - is_busy (callable): Returns True while a model still has requests
+          running or waiting; busy models are never evicted.
+        - max_events (int): Number of load/evict events to keep.
+        """
+
+        self.configs = {value["name"]: value for value in models.values()}
+        self.budgets = {"cpu": ram_budget, "cuda": vram_budget}
+        self.is_busy = is_busy or (lambda model_name: False)
+        self.events = deque(maxlen=max_events)
+        self.states = {model_name: "unloaded" for model_name in self.configs}
+        # Registered LoRA adapters outlive the base model's entry, so that
+        # they are served again when it is reloaded.
+        self.adapter_sources = {
+            model_name: dict(config.get("lora_adapters") or {})
+            for model_name, config in self.configs.items()
+        }
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._footprints = {}
+        self._leases = defaultdict(int)
+
+    def __contains__(self, model_name):
+        return model_name in self._entries
+
+    def __getitem__(self, model_name):
+        return self._entries[model_name]
+
+    def keys(self):
+        return self._entries.keys()
+
+    def items(self):
+        return self._entries.items()
+
+    def is_pinned(self, model_name):
+        return self.configs[model_name].get("pinned", False)
+
+    def in_use(self, model_name):
+        return self._leases[model_name] > 0 or self.is_busy(model_name)
+
+    async def preload(self):
+        """
+        Loads and warms up every model marked `preload`, one at a time.
+        """
+
+        for model_name, config in self.configs.items():
+            if config["preload"]:
+                await self.get(model_name)
+
+    def is_ready(self):
+        """Whether every preloaded model is ready to serve."""
+        return all(
+            self.states[model_name] == "ready"
+            for model_name, config in self.configs.items()
+            if config["preload"]
+        )
+
+    async def get(self, model_name):
+        """
+        Returns a model's entry, loading it in a worker thread if needed.
+
+        Parameters:
+        - model_name (str): Full name of the model, e.g. "microsoft/phi-1_5".
+
+        Returns:
+        - dict: The model's entry, or None if it could not be loaded.
+        """
+
+        if model_name in self._entries:
+            self._entries.move_to_end(model_name)
+            self._entries[model_name]["last_used"] = time.time()
+            return self._entries[model_name]
+
+        if model_name not in self._loading:
+            self._loading[model_name] = asyncio.ensure_future(
+                self._load_async(model_name)
+            )
+        # Shielded so that a caller going away does not cancel a load that
+        # other requests are waiting for.
+        return await asyncio.shield(self._loading[model_name])
+
+    async def acquire(self, model_name):
+        """
+        Returns a model's entry like `get`, and keeps the model from being
+        evicted until `release` is called. The lease is taken before the
+        model is loaded, so that no other load can evict it in between.
+
+        Returns:
+        - dict: The model's entry, or None, without a lease, if it could not
+          be loaded.
+        """
+
+        self._leases[model_name] += 1
+        try:
+            entry = await self.get(model_name)
+        except BaseException:
+            self.release(model_name)
+            raise
+        if entry is None:
+            self.release(model_name)
+        return entry
+
+    def release(self, model_name):
+        self._leases[model_name] -= 1
+
+    async def _load_async(self, model_name):
+        try:
+            self._make_room(model_name)
+            loop = asyncio.get_running_loop()
+            entry = await loop.run_in_executor(None, self._load_entry, model_name)
+            if entry is not None:
+                self._insert(model_name, entry)
+            return entry
+        finally:
+            self._loading.pop(model_name, None)
+
+    def _load_entry(self, model_name):
+        config = self.configs[model_name]
+        self.states[model_name] = "loading"
+        start = time.perf_counter()
+        try:
+            model, tokenizer = load_model(
+                model_name,
+                config["require_auth"],
+                config["trust_remote_code"],
+                quantization=config.get("quantization", "none"),
+            )
+        except ValueError as e:
+            # a configuration error, such as an unknown quantization mode
+            logging.error(f"Unable to load model {model_name}: {str(e)}")
+            model, tokenizer = None, None
+        if model is None or tokenizer is None:
+            self.states[model_name] = "failed"
+            self._record("load_failed", model_name)
+            metrics.MODEL_LOADS.inc(model=model_name, result="failed")
+            logging.warning(f"Skipped loading model: {model_name}")
+            return None
+
+        draft_model = self._load_draft(model_name, config, tokenizer)
+        entry = build_model_entry(
+            model,
+            tokenizer,
+            config,
+            draft_model=draft_model,
+            adapter_sources=self.adapter_sources[model_name],
+        )
+        self.states[model_name] = "warming"
+        entry["warmup_time"] = self._warm_up(model_name, entry)
+        entry["footprint"] = model_footprint(model)
+        if draft_model is not None:
+            entry["footprint"] = add_footprints(
+                entry["footprint"], model_footprint(draft_model)
+            )
+        entry["load_time"] = time.perf_counter() - start
+        entry["last_used"] = time.time()
+        self._footprints[model_name] = entry["footprint"]
+        metrics.MODEL_LOADS.inc(model=model_name, result="loaded")
+        metrics.MODEL_LOAD_SECONDS.observe(entry["load_time"], model=model_name)
+        self._record(
+            "load",
+            model_name,
+            load_time=entry["load_time"],
+            footprint=entry["footprint"],
+        )
+        return entry
+
+    def _load_draft(self, model_name, config, tokenizer):
+        # The draft model lives and dies with its target, and counts towards
+        # the target's footprint. Without it the target still serves, with
+        # plain decoding.
+        draft_name = config.get("draft_model")
+        if not draft_name:
+            return None
+        draft_model, draft_tokenizer = load_model(
+            draft_name,
+            config["require_auth"],
+            config["trust_remote_code"],
+            quantization=config.get("quantization", "none"),
+        )
+        if draft_model is None or draft_tokenizer is None:
+            logging.warning(f"Skipped loading draft model: {draft_name}")
+            return None
+        if draft_tokenizer.get_vocab() != tokenizer.get_vocab():
+            logging.warning(
+                f"Draft model {draft_name} does not share the tokenizer of "
+                f"{model_name}; assisted decoding is disabled"
+            )
+            return None
+        logging.info(f"Loaded draft model {draft_name} for {model_name}")
+        return draft_model
+
+    def serves_adapters(self, model_name):
+        return bool(self.configs[model_name].get("lora_target_modules"))
+
+    def register_adapter(self, model_name, name, path):
+        """
+        Registers a LoRA adapter for a model; it is loaded on first use.
+        Registering an existing name again replaces its path.
+
+        Parameters:
+        - model_name (str): Full name of the base model.
+        - name (str): Name of the adapter, selected with "<model>@<name>".
+        - path (str): PEFT adapter directory or Hugging Face Hub id.
+        """
+
+        self.adapter_sources[model_name][name] = path
+        entry = self._entries.get(model_name)
+        if entry is not None:
+            # A replaced adapter is read again on its next use.
+            entry["adapters"].unload(name)
+        self._record("adapter_registered", model_name, adapter=name, path=path)
+
+    def unregister_adapter(self, model_name, name):
+        """
+        Removes a LoRA adapter. Requests using it finish first.
+
+        Returns:
+        - bool: Whether the adapter was registered.
+        """
+
+        if self.adapter_sources[model_name].pop(name, None) is None:
+            return False
+        entry = self._entries.get(model_name)
+        if entry is not None:
+            entry["adapters"].unload(name)
+        self._record("adapter_unregistered", model_name, adapter=name)
+        return True
+
+    def _warm_up(self, model_name, entry):
+        # A short generation so that kernel selection and allocator growth
+        # happen before the first real request.
+        if WARMUP_MAX_NEW_TOKENS <= 0:
+            return 0.0
+        start = time.perf_counter()
+        try:
+            entry["session"].generate(
+                WARMUP_PROMPT, max_new_tokens=WARMUP_MAX_NEW_TOKENS
+            )
+            entry["session"].calibrate(WARMUP_PROMPT, WARMUP_MAX_NEW_TOKENS)
+        except Exception as e:
+            logging.warning(f"Warm-up of model {model_name} failed: {str(e)}")
+        warmup_time = time.perf_counter() - start
+        logging.info(f"Model {model_name} warmed up in {warmup_time:.2f}s")
+        return warmup_time
+
+    def _insert(self, model_name, entry):
+        self._entries[model_name] = entry
+        self.states[model_name] = "ready"
+        self._evict_to_budget(exclude=model_name)
+
+    def _make_room(self, model_name):
+        # Use the footprint from an earlier load, if any, to free memory
+        # before loading instead of after.
+        expected = self._footprints.get(model_name)
+        if expected:
+            self._evict_to_budget(exclude=model_name, extra=expected)
+
+    def used(self, device_type):
+        return sum(
+            entry["footprint"].get(device_type, 0) for entry in self._entries.values()
+        )
+
+    def _evict_to_budget(self, exclude, extra=None):
+        extra = extra or {}
+        for device_type, budget in self.budgets.items():
+            if not budget:
+                continue
+            while self.used(device_type) + extra.get(device_type, 0) > budget:
+                victim = next(
+                    (
+                        name
+                        for name, entry in self._entries.items()
+                        if name != exclude
+                        and entry["footprint"].get(device_type, 0) > 0
+                        and not self.is_pinned(name)
+                        and not self.in_use(name)
+                    ),
+                    None,
+                )
+                if victim is None:
+                    logging.warning(
+                        f"Model {device_type} memory budget exceeded and no model "
+                        "can be evicted"
+                    )
+                    break
+                self.evict(victim)
+
+    def evict(self, model_name):
+        """
+        Unloads a model. Its memory is freed in a worker thread, since
+        stopping its scheduler waits for the current decode step and garbage
+        collection takes a while.
+
+        Parameters:
+        - model_name (str): Full name of the model to unload.
+        """
+
+        entry = self._entries.pop(model_name, None)
+        if entry is None:
+            return
+        self.states[model_name] = "unloaded"
+        self._record("evict", model_name, footprint=entry["footprint"])
+        logging.info(f"Model {model_name} evicted")
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._tear_down(model_name, entry)
+            return
+        loop.run_in_executor(None, self._tear_down, model_name, entry)
+
+    @staticmethod
+    def _tear_down(model_name, entry):
+        try:
+            scheduler = entry.get("scheduler")
+            if scheduler is not None:
+                scheduler.stop()
+            if entry["assisted"] is not None:
+                entry["assisted"].remove()
+            # The caller still holds the dict, so drop what it references.
+            entry.clear()
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except Exception as e:
+            logging.error(f"Unable to free the memory of model {model_name}: {e}")
+
+    def _record(self, event, model_name, **details):
+        self.events.append(
+            {"event": event, "model": model_name, "time": time.time(), **details}
+        )
+
+    def status(self):
+        """
+        Describes the resident models, memory budgets, recent events and the
+        memory of this process (of this worker, with several workers).
+
+        Returns:
+        - dict: JSON-serializable registry status.
+        """
+
+        return {
+            "budgets": self.budgets,
+            "used": {
+                device_type: self.used(device_type) for device_type in self.budgets
+            },
+            "resident": [
+                {
+                    "model": model_name,
+                    "pinned": self.is_pinned(model_name),
+                    "busy": self.in_use(model_name),
+                    "footprint": entry["footprint"],
+                    "load_time": entry["load_time"],
+                    "warmup_time": entry["warmup_time"],
+                    "last_used": entry["last_used"],
+                    "prefix_cache": (
+                        entry["prefix_cache"].stats() if entry["prefix_cache"] else None
+                    ),
+                    "assisted_decoding": (
+                        entry["assisted"].stats() if entry["assisted"] else None
+                    ),
+                    "adapters": (
+                        entry["adapters"].stats() if entry["adapters"] else None
+                    ),
+                }
+                for model_name, entry in self._entries.items()
+            ],
+            "adapters": {
+                model_name: sorted(sources)
+                for model_name, sources in self.adapter_sources.items()
+                if sources
+            },
+            "loading": list(self._loading.keys()),
+            "states": self.states,
+            "process": {"pid": os.getpid(), "memory": memory_usage()},
+            "events": list(self.events),
+        }
@@ -1,8 +1,13 @@
+import asyncio
 import json
 import logging
+import math
+import time
+import uuid
+from contextlib import contextmanager
 from datetime import timedelta
+from functools import partial
 from typing import Annotated, Optional
-import openai
 from fastapi import (
     FastAPI,
     HTTPException,
@@ -12,36 +17,57 @@ from fastapi import (
     Depends,
     Form,
     File,
+    Request,
+    Response,
 )
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import ValidationError
+from starlette.background import BackgroundTask
 
 from config import (
     ACCESS_TOKEN_EXPIRE_MINUTES,
+    API_KEYS,
     API_SECRET_KEY,
-    OPENAI_API_KEY,
+    BULK_MAX_ITEMS,
     YOUR_CLIENT_SITE_ADDRESS,
     DEVICE_TYPE,
+    PROFILING_ENABLED,
 )
+import metrics
+import tracing
 from database import fake_users_db
-from finetuning.openai import fine_tune_openai_model, upload_training_file
-from finetuning.validation import validate_data_format, validate_messages
+from finetuning.jobs import FineTuningJobManager, save_upload
+from finetuning.local_jobs import LocalFineTuningJobManager
+from finetuning.validation import validate_upload
+from load_models.local_cache import current_rss, memory_usage
 from load_models.model_list import models
-from load_models.model_loader import load_model, load_models
-from inference.text_generator import (
-    create_prompt,
-    generate_text_phi1_5,
-    generate_text_pipeline,
+from load_models.registry import ModelRegistry
+from inference.admission import (
+    AdmissionController,
+    AdmissionRejected,
+    estimate_cost,
+    parse_api_keys,
+)
+from inference.bulk import bulk_generate
+from inference.cancellation import Cancellation, GenerationCancelled, watch_disconnect
+from inference.executor import InferenceExecutor, InferenceQueueFull
+from inference.lora import read_adapter_config, split_adapter
+from inference.response_cache import ResponseCache
+from inference.streaming import sse_events
+from models import (
+    AdapterRegistration,
+    BulkChatMessages,
+    ChatMessages,
+    FineTuningSpecs,
+    Token,
+    User,
 )
-from models import ChatMessages, FineTuningSpecs, Token, User
 from user_auth import authenticate_user, create_access_token, get_current_active_user
 
 
-logging.basicConfig(
-    filename="application.log",
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
+log_listener = tracing.setup_logging()
 logging.info(
     f"Starting a new instance of Smartchat FastAPI application in { DEVICE_TYPE }..."
 )
@@ -50,19 +76,92 @@ if not API_SECRET_KEY:
     logging.error("Unable to Fetch API Secert Key")
     raise Exception("Unable to Fetch API Secert Key")
 
+# Clients are told apart by their API key; each key, and each user a client
+# sends requests for, spends its own token budget.
+api_clients, key_budgets = parse_api_keys(API_KEYS, API_SECRET_KEY)
+admission_control = AdmissionController(key_budgets)
+
 app = FastAPI()
 
-loaded_models = load_models(models)
+# HTTP status of a request whose generation was cancelled; 499 is the status
+# commonly logged for a client that closed the connection
+CANCELLED_STATUS = {"disconnected": 499, "deadline": 504}
+
+inference_executor = InferenceExecutor()
+for value in models.values():
+    inference_executor.set_limit(value["name"], value.get("max_concurrency", 1))
+
+response_cache = ResponseCache()
+
+finetuning_jobs = FineTuningJobManager()
+
+# Adapters trained locally are served by their base model once done.
+peft_jobs = LocalFineTuningJobManager(
+    on_success=lambda job: loaded_models.register_adapter(
+        job["model"], job["adapter_name"], job["adapter_path"]
+    )
+)
+
+loaded_models = ModelRegistry(
+    models, is_busy=lambda model_name: inference_executor.pending_for(model_name) > 0
+)
+
+metrics.QUEUE_DEPTH.set_function(
+    lambda: {
+        (model_name,): inference_executor.pending_for(model_name)
+        for model_name in loaded_models.configs
+    }
+)
+metrics.INFLIGHT_TOKENS.set_function(lambda: {(): admission_control.inflight_tokens})
+metrics.TOKEN_BUDGET_AVAILABLE.set_function(
+    lambda: {(name,): tokens for name, tokens in admission_control.available().items()}
+)
+metrics.MODEL_RESIDENT_BYTES.set_function(
+    lambda: {
+        (model_name, device_type): size
+        for model_name, entry in list(loaded_models.items())
+        for device_type, size in entry["footprint"].items()
+    }
+)
+metrics.PROCESS_RESIDENT_BYTES.set_function(lambda: {(): current_rss()})
+metrics.PROCESS_MEMORY_BYTES.set_function(
+    lambda: {
+        (kind,): size
+        for kind, size in memory_usage().items()
+        if kind != "rss" and size is not None
+    }
+)
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000", YOUR_CLIENT_SITE_ADDRESS],
     allow_credentials=True,
     allow_methods=["*"],
-    allow_headers=["Authorization", "Content-Type"],
+    allow_headers=["Authorization", "Content-Type", "X-Profile", "X-User-ID"],
+    expose_headers=["Server-Timing", "X-Request-ID", "Retry-After"],
 )
 
 
+@app.on_event("startup")
+async def start_preloading():
+    # Preload in the background so the server accepts connections right away;
+    # /health/ready reports when the preloaded models can serve.
+    app.state.preload_task = asyncio.create_task(loaded_models.preload())
+    finetuning_jobs.start()
+    peft_jobs.start()
+
+
+@app.on_event("shutdown")
+async def stop_finetuning_jobs():
+    await finetuning_jobs.shutdown()
+    await peft_jobs.shutdown()
+
+
+@app.on_event("shutdown")
+async def flush_logs():
+    log_listener.stop()
+
+
 async def get_api_secret_key(authorization: str = Header(...)):
     prefix = "Bearer "
     if not authorization.startswith(prefix):
@@ -71,16 +170,320 @@ async def get_api_secret_key(authorization: str = Header(...)):
         )
     api_secret_key = authorization[len(prefix) :]
 
-    if api_secret_key != API_SECRET_KEY:
+    if api_secret_key not in api_clients:
         raise HTTPException(
             status_code=401, detail="Unauthorized: Invalid API Secret Key"
         )
     return api_secret_key
 
 
+async def stream_response(
+    model_name,
+    session,
+    prompt,
+    prefix,
+    usage,
+    adapter=None,
+    release_adapter=None,
+    cancellation=None,
+):
+    """
+    Starts a streamed generation that holds an inference slot, and its LoRA
+    adapter if any, until the generation thread finishes. The request's
+    metrics are recorded when the stream ends, or when its client
+    disconnects, which stops the generation; the Server-Timing header covers
+    the phases before it.
+    """
+
+    def on_finish():
+        inference_executor.release_threadsafe(model_name)
+        if release_adapter is not None:
+            release_adapter()
+
+    await inference_executor.acquire(model_name, usage["phases"], cancellation)
+    try:
+        streamer = await inference_executor.call(
+            session.stream,
+            prompt,
+            prefix=prefix,
+            on_finish=on_finish,
+            usage=usage,
+            adapter=adapter,
+            cancellation=cancellation,
+        )
+    except Exception:
+        inference_executor.release(model_name)
+        raise
+
+    async def on_close():
+        # Runs once the response is over; a client that left before the end
+        # of the stream no longer needs the rest of the answer.
+        if usage.get("stream_ended"):
+            return
+        if cancellation is not None:
+            cancellation.cancel("disconnected")
+        usage["cancelled"] = "disconnected"
+        usage["status"] = str(CANCELLED_STATUS["disconnected"])
+        usage["prompt_tokens"] = streamer.prompt_tokens
+        usage["generated_tokens"] = streamer.num_tokens
+        observe_request(usage)
+
+    usage["streamed"] = True
+    return StreamingResponse(
+        sse_events(streamer, stream_observer(usage)),
+        media_type="text/event-stream",
+        headers=timing_headers(usage),
+        background=BackgroundTask(on_close),
+    )
+
+
+async def generate_answer(
+    model_name,
+    session,
+    prompt,
+    prefix,
+    usage,
+    profile=False,
+    adapter=None,
+    cancellation=None,
+):
+    """
+    Generates an answer on the inference pool once the model has a free slot.
+    A profiled generation also stores its profile report in `usage`.
+    """
+
+    async with inference_executor.slot(model_name, usage["phases"], cancellation):
+        if not profile:
+            return await inference_executor.call(
+                session.generate,
+                prompt,
+                prefix=prefix,
+                usage=usage,
+                adapter=adapter,
+                cancellation=cancellation,
+            )
+        generated_text, usage["profile"] = await inference_executor.call(
+            tracing.profile_call,
+            session.generate,
+            prompt,
+            prefix=prefix,
+            usage=usage,
+            adapter=adapter,
+            cancellation=cancellation,
+        )
+        return generated_text
+
+
+async def acquire_adapter(entry, adapter, phases):
+    """
+    Loads a LoRA adapter of a loaded model if needed and keeps it loaded
+    until the returned function is called. Returns None without an adapter.
+    """
+
+    if adapter is None:
+        return None
+    loop = asyncio.get_running_loop()
+    with tracing.phase(phases, "adapter_load"):
+        await loop.run_in_executor(None, entry["adapters"].acquire, adapter)
+    return partial(entry["adapters"].release, adapter)
+
+
+def stream_observer(usage):
+    # Fills `usage` from a finished stream and records the request.
+    def on_complete(streamer, time_to_first_token, total_time):
+        usage["stream_ended"] = True
+        usage["prompt_tokens"] = streamer.prompt_tokens
+        usage["generated_tokens"] = streamer.num_tokens
+        usage["generation_time"] = total_time
+        if time_to_first_token is not None:
+            usage["first_token_at"] = (
+                time.perf_counter() - total_time + time_to_first_token
+            )
+            phases = usage["phases"]
+            phases["prefill"] = phases.get("prefill", 0.0) + time_to_first_token
+            phases["decode"] = total_time - time_to_first_token
+        if streamer.error is not None:
+            usage["error"] = type(streamer.error).__name__
+        elif streamer.cancellation is not None and streamer.cancellation.reason:
+            usage["cancelled"] = streamer.cancellation.reason
+        observe_request(usage)
+
+    return on_complete
+
+
+def observe_request(usage):
+    # Records a finished chat request; `usage` is filled by track_request, the
+    # endpoint and the generation.
+    total = time.perf_counter() - usage["start"]
+    labels = {"endpoint": usage["endpoint"], "model": usage["model"]}
+    admission = usage.pop("admission", None)
+    if admission is not None:
+        # Charges the tokens the request used instead of its estimate; an
+        # answer from the response cache used none.
+        admission_control.settle(
+            admission,
+            (usage.get("prompt_tokens") or 0) + (usage.get("generated_tokens") or 0),
+        )
+    metrics.REQUESTS.inc(status=usage["status"], **labels)
+    metrics.REQUEST_LATENCY.observe(total, **labels)
+    if "error" in usage:
+        metrics.REQUEST_ERRORS.inc(type=usage["error"], **labels)
+    if "cancelled" in usage:
+        # the tokens generated for an answer that was not delivered in full
+        wasted_tokens = usage.get("generated_tokens") or 0
+        metrics.CANCELLED_REQUESTS.inc(reason=usage["cancelled"], **labels)
+        metrics.CANCELLED_TOKENS.inc(
+            value=wasted_tokens, reason=usage["cancelled"], **labels
+        )
+        logging.info(
+            f"Request {usage['request_id']} cancelled ({usage['cancelled']}) "
+            f"after {wasted_tokens} generated tokens"
+        )
+    if "first_token_at" in usage:
+        metrics.TIME_TO_FIRST_TOKEN.observe(
+            usage["first_token_at"] - usage["start"], **labels
+        )
+    if usage.get("prompt_tokens") is not None:
+        metrics.PROMPT_TOKENS.observe(usage["prompt_tokens"], **labels)
+    generated_tokens = usage.get("generated_tokens")
+    if generated_tokens is not None:
+        metrics.GENERATED_TOKENS.observe(generated_tokens, **labels)
+        if usage.get("generation_time"):
+            metrics.TOKENS_PER_SECOND.observe(
+                generated_tokens / usage["generation_time"], **labels
+            )
+    tracing.record_trace(usage, total, usage.get("profile"))
+
+
+def timing_headers(usage):
+    total = time.perf_counter() - usage["start"]
+    return {
+        "Server-Timing": tracing.server_timing(usage["phases"], total),
+        "X-Request-ID": usage["request_id"],
+    }
+
+
+def request_cost(chat_messages, model_key, bare_question=False):
+    # Estimated tokens of a chat request: the texts of its prompt, only the
+    # question for models sent the bare question, and its answer.
+    texts = [chat_messages.question]
+    if not bare_question:
+        texts += [chat_messages.base_prompt, chat_messages.fetched_text]
+        for item in chat_messages.chat_history:
+            texts += [item.question, item.answer]
+    generation_config = models[model_key].get("generation_config", {})
+    return estimate_cost(texts, generation_config.get("max_new_tokens"))
+
+
+def too_many_tokens(rejection):
+    # The 429 of a request that admission control rejected.
+    return HTTPException(
+        status_code=429,
+        detail=str(rejection),
+        headers={"Retry-After": str(math.ceil(rejection.retry_after))},
+    )
+
+
+def admit_request(usage, api_secret_key, user, cost):
+    """
+    Charges a chat request to the token budgets of its API key and user, or
+    rejects it with a 429 and the seconds after which it may be let in. The
+    charge is settled when the request is recorded.
+    """
+
+    try:
+        usage["admission"] = admission_control.admit(
+            api_clients[api_secret_key], user, cost
+        )
+    except AdmissionRejected as e:
+        usage["error"] = "rejected"
+        metrics.REJECTED_REQUESTS.inc(
+            endpoint=usage["endpoint"], model=usage["model"], reason=e.reason
+        )
+        raise too_many_tokens(e)
+
+
+@contextmanager
+def track_request(endpoint, model_name, response):
+    """
+    Records the metrics, phase timings and trace of a chat request. Yields a
+    dict that the endpoint and the generation fill with token usage, phase
+    times and errors; a streamed request is recorded when its stream ends
+    instead. The phase timings are returned in the Server-Timing header.
+    """
+
+    usage = {
+        "request_id": uuid.uuid4().hex,
+        "endpoint": endpoint,
+        "model": model_name,
+        "start": time.perf_counter(),
+        "status": "200",
+        "streamed": False,
+        "phases": {},
+    }
+    try:
+        yield usage
+    except HTTPException as e:
+        usage["status"] = str(e.status_code)
+        usage["streamed"] = False
+        raise
+    finally:
+        if not usage["streamed"]:
+            response.headers.update(timing_headers(usage))
+            observe_request(usage)
+
+
+def wants_profile(x_profile):
+    # A request asks to be profiled with "X-Profile: 1" when profiling is
+    # enabled; profiled requests run alone, without streaming or caches.
+    return PROFILING_ENABLED and x_profile in ("1", "true")
+
+
+def model_label(model_name):
+    # Keeps the metric labels to the configured models, whatever is requested.
+    model_key = model_name.split("/").pop()
+    return models[model_key]["name"] if model_key in models else "invalid"
+
+
+@app.get("/health/live")
+async def liveness():
+    return {"status": "alive"}
+
+
+@app.get("/health/ready")
+async def readiness():
+    ready = loaded_models.is_ready()
+    content = {"ready": ready, "models": loaded_models.states}
+    status_code = status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE
+    return JSONResponse(content=content, status_code=status_code)
+
+
+def response_cache_key(model_name, adapter, session, prompt, chat_messages):
+    """
+    Returns the response cache key for a request, or None if the request
+    must not be answered from the cache: the client opted out, or the model
+    samples its output and the client did not accept cached answers.
+    """
+
+    if not chat_messages.use_cache:
+        return None
+    if session.generation_config.do_sample and not chat_messages.allow_cached:
+        return None
+    selected_model = model_name
+    adapter_path = None
+    if adapter is not None:
+        selected_model = f"{model_name}@{adapter}"
+        adapter_path = loaded_models.adapter_sources.get(model_name, {}).get(adapter)
+    return response_cache.key(
+        selected_model, prompt, session.generation_config.to_dict(), adapter_path
+    )
+
+
 @app.post("/token", response_model=Token)
 async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
-    user = authenticate_user(fake_users_db, form_data.username, form_data.password)
+    user = await authenticate_user(
+        fake_users_db, form_data.username, form_data.password
+    )
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -110,116 +513,499 @@ async def root(current_user: User = Depends(get_current_active_user)):
 
 @app.post("/api/chat_cpu")
 async def chat_cpu(
-    chat_messages: ChatMessages, api_secret_key: str = Depends(get_api_secret_key)
+    chat_messages: ChatMessages,
+    request: Request,
+    response: Response,
+    api_secret_key: str = Depends(get_api_secret_key),
+    x_profile: Optional[str] = Header(None),
+    x_user_id: Optional[str] = Header(None),
 ):
-    model_name = chat_messages.selected_model
+    model_name, adapter = split_adapter(chat_messages.selected_model)
     question = chat_messages.question
+    profile = wants_profile(x_profile)
 
-    # Ensure that 'model_name' is a valid key in 'loaded_models'
-    model_key = model_name.split("/").pop()
-    if model_key not in models.keys():
-        raise HTTPException(status_code=400, detail="Invalid model name")
-
-    if model_name not in loaded_models.keys():
-        current_model = models[model_key]
-        require_auth = current_model["require_auth"]
-        trust_remote_code = current_model["trust_remote_code"]
+    with track_request("chat_cpu", model_label(model_name), response) as usage:
+        phases = usage["phases"]
+        usage["adapter"] = adapter
+        # Ensure that 'model_name' is a valid key in 'loaded_models'
+        model_key = model_name.split("/").pop()
+        if model_key not in models.keys():
+            usage["error"] = "invalid_model"
+            raise HTTPException(status_code=400, detail="Invalid model name")
+        # the configured name, however the client spelled the model's path
+        model_name = models[model_key]["name"]
+        if adapter is not None and adapter not in loaded_models.adapter_sources.get(
+            model_name, {}
+        ):
+            usage["error"] = "invalid_adapter"
+            raise HTTPException(status_code=400, detail="Unknown adapter")
+        admit_request(
+            usage,
+            api_secret_key,
+            x_user_id,
+            request_cost(chat_messages, model_key, bare_question=True),
+        )
 
-        model, tokenizer = load_model(model_name, require_auth, trust_remote_code)
+        # The model is not evicted until the request has its inference slot
+        # and the lease is released.
+        with tracing.phase(phases, "model_load"):
+            try:
+                entry = await loaded_models.acquire(model_name)
+            except Exception as e:
+                logging.error(f"Unable to load model {model_name}: {str(e)}")
+                usage["error"] = type(e).__name__
+                raise HTTPException(status_code=500, detail="Unable to load model")
+        if entry is None:
+            usage["error"] = "model_load_failed"
+            raise HTTPException(status_code=500, detail="Unable to load model")
+        session = entry["session"]
 
-        loaded_models[model_name] = {"model": model, "tokenizer": tokenizer}
+        # Stops the generation when the client disconnects or the deadline
+        # passes; a stream is watched by its response instead.
+        cancellation = Cancellation()
+        watcher = asyncio.create_task(watch_disconnect(request, cancellation))
+        release_adapter = None
+        try:
+            release_adapter = await acquire_adapter(entry, adapter, phases)
+            if chat_messages.stream and not profile:
+                return await stream_response(
+                    model_name,
+                    session,
+                    question,
+                    None,
+                    usage,
+                    adapter,
+                    release_adapter,
+                    cancellation,
+                )
 
-    model = loaded_models[model_name]["model"]
-    tokenizer = loaded_models[model_name]["tokenizer"]
+            cache_key = None
+            if not profile:
+                cache_key = response_cache_key(
+                    model_name, adapter, session, question, chat_messages
+                )
+            if cache_key is not None:
+                cached_text = await response_cache.get(cache_key)
+                if cached_text is not None:
+                    metrics.RESPONSE_CACHE_HITS.inc(
+                        endpoint="chat_cpu", model=usage["model"]
+                    )
+                    return {"success": True, "message": cached_text, "cached": True}
 
-    try:
-        generated_text = generate_text_phi1_5(model, tokenizer, question)
+            generated_text = await generate_answer(
+                model_name,
+                session,
+                question,
+                None,
+                usage,
+                profile,
+                adapter,
+                cancellation,
+            )
 
-        return {"success": True, "message": generated_text}
-    except Exception as e:
-        logging.error(f"Error in chat endpoint: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+            if cache_key is not None and generated_text is not None:
+                await response_cache.set(cache_key, generated_text)
+            if profile:
+                return {
+                    "success": True,
+                    "message": generated_text,
+                    "profile": usage["profile"],
+                }
+            return {"success": True, "message": generated_text}
+        except InferenceQueueFull as e:
+            usage["error"] = "queue_full"
+            raise HTTPException(
+                status_code=503, detail=str(e), headers={"Retry-After": "1"}
+            )
+        except GenerationCancelled as e:
+            usage["cancelled"] = e.reason
+            raise HTTPException(status_code=CANCELLED_STATUS[e.reason], detail=str(e))
+        except Exception as e:
+            logging.error(f"Error in chat endpoint: {str(e)}")
+            usage["error"] = type(e).__name__
+            raise HTTPException(status_code=500, detail=str(e))
+        finally:
+            watcher.cancel()
+            loaded_models.release(model_name)
+            # A stream releases its adapter when its generation ends.
+            if release_adapter is not None and not usage["streamed"]:
+                release_adapter()
 
 
 @app.post("/api/chat_gpu")
 async def chat_gpu(
-    chat_messages: ChatMessages, api_secret_key: str = Depends(get_api_secret_key)
+    chat_messages: ChatMessages,
+    request: Request,
+    response: Response,
+    api_secret_key: str = Depends(get_api_secret_key),
+    x_profile: Optional[str] = Header(None),
+    x_user_id: Optional[str] = Header(None),
 ):
-    model_name = chat_messages.selected_model
+    model_name, adapter = split_adapter(chat_messages.selected_model)
     question = chat_messages.question
+    profile = wants_profile(x_profile)
 
-    # Ensure that 'model_name' is a valid key in 'loaded_models'
-    model_key = model_name.split("/").pop()
-    if model_key not in models.keys():
-        raise HTTPException(status_code=400, detail="Invalid model name")
+    with track_request("chat_gpu", model_label(model_name), response) as usage:
+        phases = usage["phases"]
+        usage["adapter"] = adapter
+        # Ensure that 'model_name' is a valid key in 'loaded_models'
+        model_key = model_name.split("/").pop()
+        if model_key not in models.keys():
+            usage["error"] = "invalid_model"
+            raise HTTPException(status_code=400, detail="Invalid model name")
+        # the configured name, however the client spelled the model's path
+        model_name = models[model_key]["name"]
+        if adapter is not None and adapter not in loaded_models.adapter_sources.get(
+            model_name, {}
+        ):
+            usage["error"] = "invalid_adapter"
+            raise HTTPException(status_code=400, detail="Unknown adapter")
+        admit_request(
+            usage,
+            api_secret_key,
+            x_user_id,
+            request_cost(
+                chat_messages,
+                model_key,
+                bare_question=not models[model_key].get("prompt_template"),
+            ),
+        )
+
+        # The model is not evicted until the request has its inference slot
+        # and the lease is released.
+        with tracing.phase(phases, "model_load"):
+            try:
+                entry = await loaded_models.acquire(model_name)
+            except Exception as e:
+                logging.error(f"Unable to load model {model_name}: {str(e)}")
+                usage["error"] = type(e).__name__
+                raise HTTPException(status_code=500, detail="Unable to load model")
+        if entry is None:
+            usage["error"] = "model_load_failed"
+            raise HTTPException(status_code=500, detail="Unable to load model")
+        session = entry["session"]
 
-    if model_name not in loaded_models.keys():
-        current_model = models[model_key]
-        require_auth = current_model["require_auth"]
-        trust_remote_code = current_model["trust_remote_code"]
+        # Stops the generation when the client disconnects or the deadline
+        # passes; a stream is watched by its response instead.
+        cancellation = Cancellation()
+        watcher = asyncio.create_task(watch_disconnect(request, cancellation))
+        release_adapter = None
+        try:
+            release_adapter = await acquire_adapter(entry, adapter, phases)
+            chat_history = chat_messages.chat_history
+            base_prompt = chat_messages.base_prompt
+            fetched_text = chat_messages.fetched_text
+            with tracing.phase(phases, "prompt"):
+                # Models without a prompt template are sent the bare
+                # question, as /api/chat_cpu does.
+                prompt, prefix = question, None
+                if entry["prompt_builder"] is not None:
+                    prompt, prefix = entry["prompt_builder"].build(
+                        base_prompt, question, chat_history, fetched_text
+                    )
+            if chat_messages.stream and not profile:
+                return await stream_response(
+                    model_name,
+                    session,
+                    prompt,
+                    prefix,
+                    usage,
+                    adapter,
+                    release_adapter,
+                    cancellation,
+                )
+
+            cache_key = None
+            if not profile:
+                cache_key = response_cache_key(
+                    model_name, adapter, session, prompt, chat_messages
+                )
+            if cache_key is not None:
+                cached_text = await response_cache.get(cache_key)
+                if cached_text is not None:
+                    metrics.RESPONSE_CACHE_HITS.inc(
+                        endpoint="chat_gpu", model=usage["model"]
+                    )
+                    return {"success": True, "message": cached_text, "cached": True}
+
+            scheduler = entry.get("scheduler")
+            if scheduler is not None and not profile:
+                max_new_tokens = session.generation_config.max_new_tokens
+                async with inference_executor.slot(model_name, phases, cancellation):
+                    generated_text = await scheduler.generate(
+                        prompt,
+                        max_new_tokens,
+                        prefix,
+                        usage=usage,
+                        adapter=adapter,
+                        cancellation=cancellation,
+                    )
+            else:
+                generated_text = await generate_answer(
+                    model_name,
+                    session,
+                    prompt,
+                    prefix,
+                    usage,
+                    profile,
+                    adapter,
+                    cancellation,
+                )
+
+            if cache_key is not None and generated_text is not None:
+                await response_cache.set(cache_key, generated_text)
+            if profile:
+                return {
+                    "success": True,
+                    "message": generated_text,
+                    "profile": usage["profile"],
+                }
+            return {"success": True, "message": generated_text}
+        except InferenceQueueFull as e:
+            usage["error"] = "queue_full"
+            raise HTTPException(
+                status_code=503, detail=str(e), headers={"Retry-After": "1"}
+            )
+        except GenerationCancelled as e:
+            usage["cancelled"] = e.reason
+            raise HTTPException(status_code=CANCELLED_STATUS[e.reason], detail=str(e))
+        except Exception as e:
+            logging.error(f"Error in chat endpoint: {str(e)}")
+            usage["error"] = type(e).__name__
+            raise HTTPException(status_code=500, detail=str(e))
+        finally:
+            watcher.cancel()
+            loaded_models.release(model_name)
+            # A stream releases its adapter when its generation ends.
+            if release_adapter is not None and not usage["streamed"]:
+                release_adapter()
 
-        model, tokenizer = load_model(model_name, require_auth, trust_remote_code)
-        loaded_models[model_name] = {"model": model, "tokenizer": tokenizer}
 
-    model = loaded_models[model_name]["model"]
-    tokenizer = loaded_models[model_name]["tokenizer"]
+def bulk_cost(item):
+    # Estimated tokens of a bulk item; items that cannot be answered cost none.
+    if isinstance(item, str):
+        return 0
+    model_key = split_adapter(item.selected_model)[0].split("/").pop()
+    if model_key not in models:
+        return 0
+    return request_cost(
+        item, model_key, bare_question=not models[model_key].get("prompt_template")
+    )
+
+
+def bulk_response(items, api_secret_key, user):
+    # Streams the results of a bulk request as NDJSON, in completion order.
+    if len(items) > BULK_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413, detail=f"At most {BULK_MAX_ITEMS} items per request"
+        )
 
+    # The whole request is charged to the budgets up front. It is left out of
+    # the in-flight cap: its batches wait for room in the inference queue
+    # instead of failing, so they never crowd out chat requests.
+    costs = [bulk_cost(item) for item in items]
     try:
-        chat_history = chat_messages.chat_history
-        base_prompt = chat_messages.base_prompt
-        fetched_text = chat_messages.fetched_text
-        success, prompt = create_prompt(
-            models, model_name, base_prompt, question, chat_history, fetched_text
+        admission = admission_control.admit(
+            api_clients[api_secret_key], user, sum(costs), inflight=False
+        )
+    except AdmissionRejected as e:
+        metrics.REJECTED_REQUESTS.inc(endpoint="chat_batch", model="", reason=e.reason)
+        raise too_many_tokens(e)
+
+    # Bulk requests have no deadline, but stop when the client disconnects.
+    cancellation = Cancellation(timeout=None)
+    answered = []
+
+    async def lines():
+        async for result in bulk_generate(
+            items, loaded_models, inference_executor, models, cancellation
+        ):
+            answered.append(costs[result["index"]])
+            yield json.dumps(result) + "\n"
+
+    async def on_close():
+        # Runs once the response is over, after the last result or when the
+        # client disconnected; the items left unanswered are not charged.
+        cancellation.cancel("disconnected")
+        admission_control.settle(admission, sum(answered))
+
+    return StreamingResponse(
+        lines(), media_type="application/x-ndjson", background=BackgroundTask(on_close)
+    )
+
+
+@app.post("/api/chat_batch")
+async def chat_batch(
+    bulk: BulkChatMessages,
+    api_secret_key: str = Depends(get_api_secret_key),
+    x_user_id: Optional[str] = Header(None),
+):
+    return bulk_response(bulk.items, api_secret_key, x_user_id)
+
+
+@app.post("/api/chat_batch/upload")
+async def chat_batch_upload(
+    file: UploadFile = File(...),
+    api_secret_key: str = Depends(get_api_secret_key),
+    x_user_id: Optional[str] = Header(None),
+):
+    # One ChatMessages object per line; a line that does not parse gets an
+    # error result at its index.
+    items = []
+    for line in (await file.read()).splitlines():
+        if not line.strip():
+            continue
+        try:
+            items.append(ChatMessages.parse_raw(line))
+        except ValidationError as e:
+            items.append(f"Invalid item: {e.errors()}")
+    return bulk_response(items, api_secret_key, x_user_id)
+
+
+@app.get("/metrics")
+async def metrics_endpoint(api_secret_key: str = Depends(get_api_secret_key)):
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/admin/models")
+async def model_registry_status(api_secret_key: str = Depends(get_api_secret_key)):
+    return loaded_models.status()
+
+
+def adapter_base_model(model_key):
+    # The configured model that LoRA adapters are registered against.
+    if model_key not in models:
+        raise HTTPException(status_code=404, detail="Model not found")
+    model_name = models[model_key]["name"]
+    if not loaded_models.serves_adapters(model_name):
+        raise HTTPException(
+            status_code=400, detail="Model does not serve LoRA adapters"
         )
-        generated_text = generate_text_pipeline(model, tokenizer, prompt)
+    return model_name
+
 
-        return {"success": True, "message": generated_text}
+@app.post("/admin/models/{model_key}/adapters")
+async def register_adapter(
+    model_key: str,
+    registration: AdapterRegistration,
+    api_secret_key: str = Depends(get_api_secret_key),
+):
+    model_name = adapter_base_model(model_key)
+    if not registration.name or "@" in registration.name:
+        raise HTTPException(status_code=400, detail="Invalid adapter name")
+    try:
+        loop = asyncio.get_running_loop()
+        adapter_config = await loop.run_in_executor(
+            None, read_adapter_config, registration.path
+        )
     except Exception as e:
-        logging.error(f"Error in chat endpoint: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise HTTPException(status_code=400, detail=f"Invalid adapter: {str(e)}")
+    loaded_models.register_adapter(model_name, registration.name, registration.path)
+    return {
+        "success": True,
+        "selected_model": f"{model_name}@{registration.name}",
+        "r": adapter_config.get("r"),
+        "target_modules": adapter_config.get("target_modules"),
+    }
+
+
+@app.delete("/admin/models/{model_key}/adapters/{name}")
+async def unregister_adapter(
+    model_key: str, name: str, api_secret_key: str = Depends(get_api_secret_key)
+):
+    model_name = adapter_base_model(model_key)
+    if not loaded_models.unregister_adapter(model_name, name):
+        raise HTTPException(status_code=404, detail="Adapter not found")
+    return {"success": True}
+
+
+@app.get("/admin/rate_limits")
+async def rate_limit_status(api_secret_key: str = Depends(get_api_secret_key)):
+    return admission_control.stats()
+
+
+@app.get("/admin/response_cache")
+async def response_cache_status(api_secret_key: str = Depends(get_api_secret_key)):
+    return response_cache.stats()
+
+
+def validation_failure(report):
+    # The response to a training file with format or message errors.
+    errors = {
+        "data_format": report["format_errors"],
+        "messages": report["messages_errors"],
+        "lines": report["line_errors"],
+        "lines_truncated": report["line_errors_truncated"],
+    }
+    return {
+        "success": False,
+        "id": None,
+        "error": errors,
+        "examples": report["examples"],
+        "valid_examples": report["valid_examples"],
+        "tokens": report["tokens"],
+    }
 
 
 @app.post("/api/finetuning/openai")
 async def finetune(
     file: UploadFile = File(...),
     fine_tuning_model: str = Form(..., alias="finetuning"),
-    suffix: str = Optional[str],
+    suffix: str = Form(""),
     n_epochs: int = Form(..., alias="epochs"),
     api_secret_key: str = Depends(get_api_secret_key),
 ):
-    file_content = await file.read()
-    file_str = file_content.decode("utf-8")
-    file_list = [json.loads(line) for line in file_str.splitlines() if line]
-
-    data_format_errors = validate_data_format(file_list)
-    messages_errors = validate_messages(file_list)
+    report = await validate_upload(file, n_epochs=n_epochs)
 
-    if not messages_errors and not data_format_errors:
+    if not report["format_errors"] and not report["messages_errors"]:
         try:
-            openai.api_key = OPENAI_API_KEY
-
-            file_submit_result = await upload_training_file(file_content)
-            file_id = file_submit_result["id"]
-
-            res = await fine_tune_openai_model(
-                file_id, fine_tuning_model, suffix, n_epochs
+            # The upload is copied to its own file, since FastAPI closes the
+            # spooled one when the request ends; the job is then sent to
+            # OpenAI in the background.
+            path = await save_upload(file.file)
+            job = finetuning_jobs.submit(
+                path,
+                fine_tuning_model,
+                suffix,
+                n_epochs,
+                tokens=report["tokens"],
+                filename=file.filename,
             )
-            fine_tuning_job_id = res["id"]
 
             return {
                 "success": True,
-                "id": fine_tuning_job_id,
-                "message": "Your request has been successfully sent to OpenAI",
+                "id": job["id"],
+                "status": job["status"],
+                "message": "Your request is being sent to OpenAI",
+                "tokens": report["tokens"],
             }
         except Exception as e:
-            raise HTTPException(detail=str(e))
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+            )
     else:
-        errors = {"data_format": validate_data_format, "messages": validate_messages}
-        return {"success": False, "id": fine_tuning_job_id, "error": errors}
+        return validation_failure(report)
+
+
+@app.get("/api/finetuning/openai/jobs")
+async def list_finetuning_jobs(api_secret_key: str = Depends(get_api_secret_key)):
+    return {"jobs": finetuning_jobs.list()}
+
+
+@app.get("/api/finetuning/openai/jobs/{job_id}")
+async def finetuning_job_status(
+    job_id: str, api_secret_key: str = Depends(get_api_secret_key)
+):
+    job = finetuning_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Fine-tuning job not found"
+        )
+    return job
 
 
 @app.post("/api/finetuning/peft")
-async def finetune(
+async def finetune_peft(
     file: UploadFile = File(...),
     fine_tuning_model: str = Form(..., alias="finetuning"),
     epochs: int = Form(...),
@@ -230,14 +1016,61 @@ async def finetune(
     prompt_loss_weight: Optional[float] = Form(None, alias="promptLossWeight"),
     api_secret_key: str = Depends(get_api_secret_key),
 ):
-    content = await file.read()
+    model_key = fine_tuning_model.split("/").pop()
+    if model_key not in models:
+        raise HTTPException(status_code=400, detail="Invalid model name")
+    model_config = models[model_key]
+    if not model_config.get("lora_target_modules"):
+        raise HTTPException(
+            status_code=400, detail="Model does not support LoRA fine-tuning"
+        )
     specs = FineTuningSpecs(
-        fine_tuning_model=fine_tuning_model,
+        fine_tuning_model=model_config["name"],
         epochs=epochs,
         batch_size=batch_size,
         learning_rate_multiplier=learning_rate_multiplier,
         prompt_loss_weight=prompt_loss_weight,
     )
-    # process and validate the uploaded file/data
-    # run fine-tuning work (DeepSpeed ZeRO, LoRA, Flash Attention)
-    # pass
+
+    report = await validate_upload(file, n_epochs=epochs)
+    if report["format_errors"] or report["messages_errors"]:
+        return validation_failure(report)
+
+    try:
+        path = await save_upload(file.file)
+        job = peft_jobs.submit(
+            path,
+            specs.fine_tuning_model,
+            model_config["lora_target_modules"],
+            specs,
+            tokens=report["tokens"],
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+    return {
+        "success": True,
+        "id": job["id"],
+        "status": job["status"],
+        "adapter": f"{specs.fine_tuning_model}@{job['adapter_name']}",
+        "message": "Your fine-tuning job is queued",
+        "tokens": report["tokens"],
+    }
+
+
+@app.get("/api/finetuning/peft/jobs")
+async def list_peft_jobs(api_secret_key: str = Depends(get_api_secret_key)):
+    return {"jobs": peft_jobs.list()}
+
+
+@app.get("/api/finetuning/peft/jobs/{job_id}")
+async def peft_job_status(
+    job_id: str, api_secret_key: str = Depends(get_api_secret_key)
+):
+    job = peft_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Fine-tuning job not found"
+        )
+    return job
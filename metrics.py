@@ -0,0 +1,246 @@
+"""
+Minimal Prometheus-style metrics, rendered in the text exposition format by
+`/metrics`.
+
+Recording a value only takes the metric's own lock for the increment, so it
+is cheap to do from the event loop or a generation thread, and no lock is
+ever held while a model runs. Values that are already tracked elsewhere
+(queue depth, resident models) are gauges whose function is called when the
+metrics are scraped, so they cost nothing on the request path.
+"""
+
+import math
+from bisect import bisect_left
+from threading import Lock
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+registry = []
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = Lock()
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}"]
+        lines.append(f"# TYPE {self.name} {self.type}")
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def _samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            labels = _format_labels(self.labels, key)
+            yield f"{self.name}{labels} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # per-bucket counts, then the sum of observed values
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def _samples(self):
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(
+                    self.labels, key, [("le", _format_value(bound))]
+                )
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labels, key)
+            yield f"{self.name}_sum{labels} {_format_value(counts[-1])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Gauge(_Metric):
+    """
+    Gauge read from a function at scrape time. The function returns a dict
+    from label values (a tuple in the order of `labels`) to the value.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def set_function(self, function):
+        self.function = function
+
+    def _samples(self):
+        if self.function is None:
+            return
+        for key, value in self.function().items():
+            labels = _format_labels(self.labels, key)
+            yield f"{self.name}{labels} {_format_value(value)}"
+
+
+def render():
+    """Returns every metric in the Prometheus text exposition format."""
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+REQUESTS = Counter(
+    "smartchat_requests_total",
+    "Chat requests by endpoint, model and HTTP status.",
+    ["endpoint", "model", "status"],
+)
+REQUEST_ERRORS = Counter(
+    "smartchat_request_errors_total",
+    "Failed chat requests by endpoint, model and error type.",
+    ["endpoint", "model", "type"],
+)
+CANCELLED_REQUESTS = Counter(
+    "smartchat_cancelled_requests_total",
+    "Chat requests whose generation was cancelled, by endpoint, model and "
+    "reason (disconnected or deadline).",
+    ["endpoint", "model", "reason"],
+)
+CANCELLED_TOKENS = Counter(
+    "smartchat_cancelled_generated_tokens_total",
+    "Tokens generated for answers that were cancelled before they were done.",
+    ["endpoint", "model", "reason"],
+)
+REJECTED_REQUESTS = Counter(
+    "smartchat_rejected_requests_total",
+    "Chat requests rejected by admission control, by endpoint, model and "
+    "reason (key_budget, user_budget or capacity).",
+    ["endpoint", "model", "reason"],
+)
+REQUEST_LATENCY = Histogram(
+    "smartchat_request_latency_seconds",
+    "Time from receiving a chat request to the end of its answer.",
+    ["endpoint", "model"],
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "smartchat_time_to_first_token_seconds",
+    "Time from receiving a chat request to its first generated token.",
+    ["endpoint", "model"],
+)
+PROMPT_TOKENS = Histogram(
+    "smartchat_prompt_tokens",
+    "Prompt tokens per generated answer.",
+    ["endpoint", "model"],
+    buckets=TOKEN_BUCKETS,
+)
+GENERATED_TOKENS = Histogram(
+    "smartchat_generated_tokens",
+    "Generated tokens per answer.",
+    ["endpoint", "model"],
+    buckets=TOKEN_BUCKETS,
+)
+TOKENS_PER_SECOND = Histogram(
+    "smartchat_tokens_per_second",
+    "Generated tokens per second of generation, per answer.",
+    ["endpoint", "model"],
+    buckets=RATE_BUCKETS,
+)
+RESPONSE_CACHE_HITS = Counter(
+    "smartchat_response_cache_hits_total",
+    "Chat requests answered from the response cache.",
+    ["endpoint", "model"],
+)
+QUEUE_DEPTH = Gauge(
+    "smartchat_queue_depth",
+    "Requests running or waiting for an inference slot, per model.",
+    ["model"],
+)
+INFLIGHT_TOKENS = Gauge(
+    "smartchat_inflight_tokens",
+    "Estimated tokens held by running chat requests.",
+)
+TOKEN_BUDGET_AVAILABLE = Gauge(
+    "smartchat_token_budget_available",
+    "Tokens left in the budget of each API key that has one.",
+    ["key"],
+)
+MODEL_LOADS = Counter(
+    "smartchat_model_loads_total",
+    "Model loads by model and result.",
+    ["model", "result"],
+)
+MODEL_LOAD_SECONDS = Histogram(
+    "smartchat_model_load_seconds",
+    "Time to load and warm up a model.",
+    ["model"],
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1200),
+)
+MODEL_RESIDENT_BYTES = Gauge(
+    "smartchat_model_resident_bytes",
+    "Memory held by the weights of each resident model, per device type.",
+    ["model", "device"],
+)
+PROCESS_RESIDENT_BYTES = Gauge(
+    "smartchat_process_resident_bytes",
+    "Resident set size of the server process.",
+)
+PROCESS_MEMORY_BYTES = Gauge(
+    "smartchat_process_memory_bytes",
+    "Memory of the server process by kind: private anonymous memory, "
+    "file-backed pages shared with other processes (such as mapped weights), "
+    "shared memory and proportional set size.",
+    ["kind"],
+)
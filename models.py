@@ -33,11 +33,26 @@ class ChatMessages(BaseModel):
     chat_history: List[ChatMessage] = Field(alias="chatHistory")
     selected_model: str = Field(alias="selectedModel")
     fetched_text: str = Field(alias="fetchedText")
+    stream: Optional[bool] = False
+    # set useCache to false to skip the response cache; set allowCached to
+    # accept a cached answer even when the model samples its output
+    use_cache: Optional[bool] = Field(True, alias="useCache")
+    allow_cached: Optional[bool] = Field(False, alias="allowCached")
+
+
+class BulkChatMessages(BaseModel):
+    items: List[ChatMessages]
+
+
+class AdapterRegistration(BaseModel):
+    name: str
+    # PEFT LoRA adapter directory or Hugging Face Hub id
+    path: str
 
 
 class FineTuningSpecs(BaseModel):
-    finetuning: str
-    epochs: Optional[int]
-    batchsize: Optional[int]
+    fine_tuning_model: str
+    epochs: int
+    batch_size: Optional[int]
     learning_rate_multiplier: Optional[float]
     prompt_loss_weight: Optional[float]
@@ -0,0 +1,175 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from finetuning import local_jobs
+from finetuning.job_files import (
+    claim,
+    read_status,
+    release,
+    update_status,
+    write_json,
+)
+from finetuning.local_jobs import LocalFineTuningJobManager
+
+SPECS = SimpleNamespace(
+    epochs=1, batch_size=None, learning_rate_multiplier=None, prompt_loss_weight=None
+)
+
+
+def fake_run_job(job_dir, num_threads):
+    # Stands in for the training process.
+    if read_status(job_dir)["model"] == "crashes":
+        os._exit(3)
+    update_status(job_dir, status="running")
+    update_status(
+        job_dir,
+        status="succeeded",
+        adapter_path=os.path.join(job_dir, "adapter"),
+        finished_at=time.time(),
+    )
+
+
+@pytest.fixture(autouse=True)
+def fake_training(monkeypatch):
+    monkeypatch.setattr(local_jobs, "run_job", fake_run_job)
+    monkeypatch.setattr(local_jobs, "PROCESS_POLL_SECONDS", 0.01)
+    # fork runs the fake in the child without importing this module there
+    monkeypatch.setattr(
+        local_jobs,
+        "multiprocessing",
+        SimpleNamespace(get_context=lambda _: multiprocessing.get_context("fork")),
+    )
+
+
+def training_file(tmp_path):
+    path = tmp_path / "upload.jsonl"
+    path.write_text("{}\n")
+    return str(path)
+
+
+async def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def write_job(jobs_dir, job_id, status, created_at):
+    job_dir = os.path.join(jobs_dir, job_id)
+    os.makedirs(job_dir)
+    write_json(os.path.join(job_dir, "spec.json"), {"id": job_id})
+    write_json(
+        os.path.join(job_dir, "status.json"),
+        {
+            "id": job_id,
+            "model": "model",
+            "adapter_name": f"ft-{job_id[:8]}",
+            "adapter_path": os.path.join(job_dir, "adapter"),
+            "status": status,
+            "created_at": created_at,
+        },
+    )
+
+
+def test_job_runs_through_its_states(tmp_path):
+    jobs_dir = str(tmp_path / "jobs")
+    succeeded = []
+
+    async def run():
+        manager = LocalFineTuningJobManager(jobs_dir, on_success=succeeded.append)
+        manager.start()
+        job = manager.submit(training_file(tmp_path), "model", ["q_proj"], SPECS)
+        assert job["status"] == "queued"
+        assert os.path.exists(os.path.join(jobs_dir, job["id"], "train.jsonl"))
+        await wait_for(lambda: succeeded)
+        await manager.shutdown()
+        return manager.get(job["id"])
+
+    job = asyncio.run(run())
+    assert job["status"] == "succeeded"
+    assert job["target_modules"] == ["q_proj"]
+    assert job["epochs"] == 1
+    assert [job["id"] for job in succeeded] == [job["id"]]
+
+
+def test_job_whose_process_dies_fails(tmp_path):
+    jobs_dir = str(tmp_path / "jobs")
+
+    async def run():
+        manager = LocalFineTuningJobManager(jobs_dir)
+        manager.start()
+        job = manager.submit(training_file(tmp_path), "crashes", ["q_proj"], SPECS)
+        await wait_for(lambda: manager.get(job["id"])["status"] == "failed")
+        await manager.shutdown()
+        return manager.get(job["id"])
+
+    job = asyncio.run(run())
+    assert job["error"] == "Training process exited with code 3"
+
+
+def test_unfinished_jobs_resume_on_start(tmp_path):
+    jobs_dir = str(tmp_path / "jobs")
+    write_job(jobs_dir, "a" * 32, "succeeded", 1.0)
+    write_job(jobs_dir, "b" * 32, "running", 2.0)
+    write_job(jobs_dir, "c" * 32, "failed", 3.0)
+    succeeded = []
+
+    async def run():
+        manager = LocalFineTuningJobManager(jobs_dir, on_success=succeeded.append)
+        manager.start()
+        assert manager.get("b" * 32)["status"] == "queued"
+        await wait_for(lambda: len(succeeded) == 2)
+        await manager.shutdown()
+        return manager
+
+    manager = asyncio.run(run())
+    assert [job["id"] for job in succeeded] == ["a" * 32, "b" * 32]
+    assert manager.get("b" * 32)["status"] == "succeeded"
+    assert manager.get("c" * 32)["status"] == "failed"
+    assert [job["id"] for job in manager.list()] == ["c" * 32, "b" * 32, "a" * 32]
+
+
+def test_job_held_by_another_worker_is_left_to_it(tmp_path):
+    jobs_dir = str(tmp_path / "jobs")
+    write_job(jobs_dir, "b" * 32, "running", 1.0)
+    lock = claim(os.path.join(jobs_dir, "b" * 32, "lock"))
+
+    async def run():
+        manager = LocalFineTuningJobManager(jobs_dir)
+        manager.start()
+        await asyncio.sleep(0.1)
+        await manager.shutdown()
+        return manager.get("b" * 32)
+
+    try:
+        assert asyncio.run(run())["status"] == "running"
+    finally:
+        release(lock)
+
+
+def test_adapters_trained_by_another_worker_are_registered(tmp_path):
+    jobs_dir = str(tmp_path / "jobs")
+    succeeded = []
+
+    async def run():
+        manager = LocalFineTuningJobManager(
+            jobs_dir, on_success=succeeded.append, discovery_interval=0.01
+        )
+        manager.start()
+        write_job(jobs_dir, "d" * 32, "succeeded", 1.0)
+        await wait_for(lambda: succeeded)
+        await asyncio.sleep(0.05)
+        await manager.shutdown()
+
+    asyncio.run(run())
+    assert [job["id"] for job in succeeded] == ["d" * 32]
+
+
+@pytest.mark.parametrize("job_id", ["..", "../jobs", "A" * 32, "runner.lock"])
+def test_invalid_job_ids_are_not_found(tmp_path, job_id):
+    assert LocalFineTuningJobManager(str(tmp_path)).get(job_id) is None
@@ -0,0 +1,211 @@
+import asyncio
+import json
+import socket
+from contextlib import asynccontextmanager
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from finetuning import openai
+from finetuning.openai import OpenAIClient, OpenAIError
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(openai, "RETRY_BASE_SECONDS", 0.0)
+
+
+class FakeAPI:
+    """
+    Answers each request with the next response queued for its route, and
+    records the requests it received.
+    """
+
+    def __init__(self):
+        self.responses = {}
+        self.requests = []
+        self.jobs = []
+
+    def queue(self, method, path, *responses):
+        self.responses.setdefault((method, path), []).extend(responses)
+
+    async def handle(self, request):
+        body = await request.read()
+        self.requests.append((request.method, request.path))
+        if request.method == "POST" and request.path == "/fine_tuning/jobs":
+            # The job is created even when the response says otherwise.
+            training_file = json.loads(body)["training_file"]
+            self.jobs.append(
+                {"id": f"ftjob-{len(self.jobs)}", "training_file": training_file}
+            )
+        responses = self.responses.get((request.method, request.path), [])
+        if responses:
+            return responses.pop(0)
+        if request.path == "/fine_tuning/jobs" and request.method == "GET":
+            return web.json_response({"data": self.jobs[::-1]})
+        if request.path == "/fine_tuning/jobs":
+            return web.json_response(self.jobs[-1])
+        return web.json_response({"id": "file-1"})
+
+    def count(self, method, path):
+        return self.requests.count((method, path))
+
+
+@asynccontextmanager
+async def serve(api, max_retries=3):
+    app = web.Application()
+    app.router.add_route("*", "/{path:.*}", api.handle)
+    server = TestServer(app)
+    await server.start_server()
+    client = OpenAIClient(
+        api_key="key", base_url=str(server.make_url("")), max_retries=max_retries
+    )
+    try:
+        yield client
+    finally:
+        await client.close()
+        await server.close()
+
+
+def status(code, **headers):
+    return web.Response(status=code, text="error", headers=headers)
+
+
+def test_get_is_retried_on_server_errors():
+    api = FakeAPI()
+    api.queue("GET", "/fine_tuning/jobs/ftjob-0", status(503), status(500))
+
+    async def run():
+        async with serve(api) as client:
+            return await client.retrieve_fine_tuning_job("ftjob-0")
+
+    assert asyncio.run(run()) == {"id": "file-1"}
+    assert api.count("GET", "/fine_tuning/jobs/ftjob-0") == 3
+
+
+def test_retries_run_out():
+    api = FakeAPI()
+    api.queue("GET", "/fine_tuning/jobs/ftjob-0", *[status(502) for _ in range(3)])
+
+    async def run():
+        async with serve(api, max_retries=2) as client:
+            await client.retrieve_fine_tuning_job("ftjob-0")
+
+    with pytest.raises(OpenAIError) as error:
+        asyncio.run(run())
+    assert error.value.status == 502
+    assert api.count("GET", "/fine_tuning/jobs/ftjob-0") == 3
+
+
+def test_client_errors_are_not_retried():
+    api = FakeAPI()
+    api.queue("GET", "/fine_tuning/jobs/ftjob-0", status(404))
+
+    async def run():
+        async with serve(api) as client:
+            await client.retrieve_fine_tuning_job("ftjob-0")
+
+    with pytest.raises(OpenAIError) as error:
+        asyncio.run(run())
+    assert error.value.status == 404
+    assert api.count("GET", "/fine_tuning/jobs/ftjob-0") == 1
+
+
+def test_upload_is_not_sent_again_after_a_server_error(tmp_path):
+    api = FakeAPI()
+    api.queue("POST", "/files", status(500))
+    path = tmp_path / "train.jsonl"
+    path.write_text("{}\n")
+
+    async def run():
+        async with serve(api) as client:
+            await client.upload_file(str(path))
+
+    with pytest.raises(OpenAIError) as error:
+        asyncio.run(run())
+    assert error.value.ambiguous
+    assert api.count("POST", "/files") == 1
+
+
+def test_rate_limited_upload_is_retried_after_retry_after(tmp_path, monkeypatch):
+    api = FakeAPI()
+    api.queue("POST", "/files", status(429, **{"Retry-After": "0.01"}))
+    path = tmp_path / "train.jsonl"
+    path.write_text("{}\n")
+    delays = []
+    retry_delay = OpenAIClient._retry_delay
+
+    def record_delay(self, attempt, retry_after=None):
+        delays.append(retry_delay(self, attempt, retry_after))
+        return delays[-1]
+
+    monkeypatch.setattr(OpenAIClient, "_retry_delay", record_delay)
+
+    async def run():
+        async with serve(api) as client:
+            return await client.upload_file(str(path))
+
+    assert asyncio.run(run()) == "file-1"
+    assert api.count("POST", "/files") == 2
+    assert delays == [0.01]
+
+
+def test_post_is_retried_when_the_connection_fails(tmp_path):
+    # A port nothing listens on
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    path = tmp_path / "train.jsonl"
+    path.write_text("{}\n")
+
+    async def run():
+        client = OpenAIClient(
+            api_key="key", base_url=f"http://127.0.0.1:{port}", max_retries=2
+        )
+        try:
+            await client.upload_file(str(path))
+        finally:
+            await client.close()
+
+    with pytest.raises(OpenAIError) as error:
+        asyncio.run(run())
+    assert not error.value.ambiguous
+
+
+def test_job_created_despite_an_error_is_found_instead_of_created_again():
+    api = FakeAPI()
+    api.queue("POST", "/fine_tuning/jobs", status(504))
+
+    async def run():
+        async with serve(api) as client:
+            return await client.create_fine_tuning_job("file-1", "gpt-3.5-turbo")
+
+    assert asyncio.run(run())["id"] == "ftjob-0"
+    assert api.count("POST", "/fine_tuning/jobs") == 1
+    assert api.count("GET", "/fine_tuning/jobs") == 1
+
+
+def test_job_creation_is_retried_when_no_job_was_created():
+    api = FakeAPI()
+    api.queue("POST", "/fine_tuning/jobs", status(504))
+    api.queue("GET", "/fine_tuning/jobs", web.json_response({"data": []}))
+
+    async def run():
+        async with serve(api) as client:
+            return await client.create_fine_tuning_job("file-1", "gpt-3.5-turbo")
+
+    assert asyncio.run(run())["id"] == "ftjob-1"
+    assert api.count("POST", "/fine_tuning/jobs") == 2
+
+
+@pytest.mark.parametrize(
+    "attempt, retry_after, low, high",
+    [(0, None, 0.5, 1.0), (3, None, 4.0, 8.0), (20, None, 30.0, 60.0), (0, "7", 7, 7)],
+)
+def test_retry_delay_backs_off_exponentially(
+    monkeypatch, attempt, retry_after, low, high
+):
+    monkeypatch.setattr(openai, "RETRY_BASE_SECONDS", 1.0)
+    delay = OpenAIClient()._retry_delay(attempt, retry_after)
+    assert low <= delay <= high
@@ -0,0 +1,79 @@
+import time
+
+import pytest
+
+from inference.scheduler import BatchScheduler
+from inference.session import GenerationSession
+
+PROMPTS = [
+    "hello world what is",
+    "a b c d e f",
+    "the answer is hello world hello world",
+    "k",
+]
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+@pytest.fixture
+def scheduler_for(tiny_model):
+    schedulers = []
+
+    def create(session):
+        model, tokenizer = tiny_model
+        scheduler = BatchScheduler(
+            model, tokenizer, max_wait_time=0.001, **session.sampling
+        )
+        scheduler.start()
+        schedulers.append(scheduler)
+        return scheduler
+
+    yield create
+    for scheduler in schedulers:
+        scheduler.stop()
+
+
+@pytest.mark.parametrize("repetition_penalty", [1.0, 1.5])
+def test_batched_answers_match_generate(tiny_model, scheduler_for, repetition_penalty):
+    model, tokenizer = tiny_model
+    session = GenerationSession(
+        model,
+        tokenizer,
+        {
+            "max_new_tokens": 12,
+            "do_sample": False,
+            "repetition_penalty": repetition_penalty,
+        },
+    )
+    scheduler = scheduler_for(session)
+
+    futures = [scheduler.submit(prompt, 12) for prompt in PROMPTS]
+    answers = [future.result(timeout=60) for future in futures]
+
+    assert answers == [session.generate(prompt) for prompt in PROMPTS]
+
+
+def test_sequences_join_and_leave_a_running_batch(tiny_model, scheduler_for):
+    model, tokenizer = tiny_model
+    session = GenerationSession(model, tokenizer, {"do_sample": False})
+    scheduler = scheduler_for(session)
+
+    long = scheduler.submit(PROMPTS[0], 40)
+    wait_for(lambda: scheduler.num_active == 1)
+    # Both join the batch while the first sequence decodes, and leave it
+    # before it ends.
+    short = [scheduler.submit(prompt, 3) for prompt in PROMPTS[1:]]
+    short_answers = [future.result(timeout=60) for future in short]
+    assert not long.done()
+    long_answer = long.result(timeout=60)
+    wait_for(lambda: scheduler.num_active == 0)
+
+    assert long_answer == session.generate(PROMPTS[0], max_new_tokens=40)
+    assert short_answers == [
+        session.generate(prompt, max_new_tokens=3) for prompt in PROMPTS[1:]
+    ]
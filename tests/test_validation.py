@@ -0,0 +1,88 @@
+import io
+import json
+
+import pytest
+
+from finetuning.validation import StreamingValidator, validate_file
+
+
+def example(*roles):
+    return {"messages": [{"role": role, "content": "hello"} for role in roles]}
+
+
+def dataset(*lines):
+    return b"\n".join(
+        line if isinstance(line, bytes) else json.dumps(line).encode() for line in lines
+    )
+
+
+# Small chunks split lines across chunk boundaries.
+@pytest.mark.parametrize("chunk_size", [7, 1024 * 1024])
+def test_errors_are_reported_with_their_line(chunk_size):
+    data = dataset(
+        example("system", "user", "assistant"),
+        b"{not json",
+        b"",
+        {"prompt": "hello"},
+        example("user", "assistant"),
+        b"\xff\xfe",
+        example("system", "user"),
+        example("system", "user", "assistant"),
+    )
+
+    report = validate_file(io.BytesIO(data), chunk_size=chunk_size)
+
+    assert report["lines"] == 8
+    assert report["examples"] == 5
+    assert report["valid_examples"] == 2
+    assert report["line_errors"] == [
+        {"line": 2, "errors": ["invalid_json"]},
+        {"line": 4, "errors": ["missing_messages_list"]},
+        {"line": 5, "errors": ["n_missing_system"]},
+        {"line": 6, "errors": ["invalid_utf8"]},
+        {"line": 7, "errors": ["example_missing_assistant_message"]},
+    ]
+    assert report["format_errors"] == {
+        "invalid_json": 1,
+        "missing_messages_list": 1,
+        "invalid_utf8": 1,
+        "example_missing_assistant_message": 1,
+    }
+    assert report["messages_errors"] == {"n_missing_system": 1}
+    assert not report["line_errors_truncated"]
+
+
+def test_line_errors_are_truncated_but_counted():
+    validator = StreamingValidator(max_line_errors=2)
+    validator.feed(dataset(*[b"{"] * 5, example("system", "user", "assistant")))
+
+    report = validator.close()
+
+    assert [item["line"] for item in report["line_errors"]] == [1, 2]
+    assert report["line_errors_truncated"]
+    assert report["format_errors"] == {"invalid_json": 5}
+
+
+def test_values_that_are_not_strings_are_format_errors():
+    named = example("system", "user", "assistant")
+    named["messages"][1]["name"] = 7
+    listed = example("system", "user", "assistant")
+    listed["messages"][2]["content"] = ["hello"]
+
+    report = validate_file(
+        io.BytesIO(dataset(named, listed, example("system", "user", "assistant")))
+    )
+
+    assert report["line_errors"] == [
+        {"line": 1, "errors": ["message_value_type"]},
+        {"line": 2, "errors": ["message_value_type", "missing_content"]},
+    ]
+    assert report["format_errors"] == {"message_value_type": 2, "missing_content": 1}
+    assert report["valid_examples"] == 1
+
+
+def test_empty_dataset_has_no_examples():
+    report = validate_file(io.BytesIO(b"\n\n"))
+
+    assert report["format_errors"] == {"no_examples": 1}
+    assert report["line_errors"] == []
@@ -0,0 +1,153 @@
+"""
+Per-request phase timing, sampled trace records and on-demand profiling.
+
+A chat request keeps the seconds spent in each phase (model load, queue,
+prompt building, tokenization, prefill, decode, detokenization) in the
+`phases` dict of its usage record. They are returned in the `Server-Timing`
+header, and a sample of requests, plus every slow or profiled one, is
+written as a JSON trace record.
+
+Log records, including traces, go through a queue to a background thread
+that writes the files, so logging never blocks a request on disk I/O.
+"""
+
+import cProfile
+import io
+import json
+import logging
+import pstats
+import queue
+import random
+import time
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+
+from config import (
+    LOG_FILE,
+    TRACE_LOG_FILE,
+    TRACE_SAMPLE_RATE,
+    TRACE_SLOW_REQUEST_SECONDS,
+)
+
+TRACE_LOGGER = "smartchat.trace"
+PROFILE_TOP_FUNCTIONS = 30
+
+trace_logger = logging.getLogger(TRACE_LOGGER)
+_listener = None
+
+
+def setup_logging(level=logging.INFO):
+    """
+    Sends log records through a queue to a background thread that writes the
+    application log, and trace records to the trace log, as JSON lines.
+
+    Returns:
+    - QueueListener: The thread writing the files; stop it to flush them.
+    """
+
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    file_handler = logging.FileHandler(LOG_FILE)
+    file_handler.setFormatter(
+        logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    )
+    file_handler.addFilter(lambda record: record.name != TRACE_LOGGER)
+    trace_handler = logging.FileHandler(TRACE_LOG_FILE)
+    trace_handler.setFormatter(logging.Formatter("%(message)s"))
+    trace_handler.addFilter(lambda record: record.name == TRACE_LOGGER)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(QueueHandler(log_queue))
+    _listener = QueueListener(log_queue, file_handler, trace_handler)
+    _listener.start()
+    return _listener
+
+
+@contextmanager
+def phase(phases, name):
+    """
+    Adds the time spent in the block to `phases[name]`. Does nothing if
+    `phases` is None.
+    """
+
+    if phases is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = phases.get(name, 0.0) + time.perf_counter() - start
+
+
+def server_timing(phases, total=None):
+    """
+    Formats phase durations as a Server-Timing header value, in milliseconds.
+    """
+
+    timings = list(phases.items())
+    if total is not None:
+        timings.append(("total", total))
+    return ", ".join(f"{name};dur={1000 * seconds:.1f}" for name, seconds in timings)
+
+
+def record_trace(usage, total, profile=None):
+    """
+    Writes a trace record of a finished request if it is sampled, slower than
+    TRACE_SLOW_REQUEST_SECONDS or profiled.
+
+    Parameters:
+    - usage (dict): The request's usage record.
+    - total (float): Seconds from receiving the request to its end.
+    - profile (str): Profile report of the request, if it was profiled.
+    """
+
+    if profile is not None:
+        reason = "profile"
+    elif TRACE_SLOW_REQUEST_SECONDS and total >= TRACE_SLOW_REQUEST_SECONDS:
+        reason = "slow"
+    elif random.random() < TRACE_SAMPLE_RATE:
+        reason = "sample"
+    else:
+        return
+
+    record = {
+        "request_id": usage["request_id"],
+        "time": time.time(),
+        "reason": reason,
+        "endpoint": usage["endpoint"],
+        "model": usage["model"],
+        "adapter": usage.get("adapter"),
+        "status": usage["status"],
+        "error": usage.get("error"),
+        "cancelled": usage.get("cancelled"),
+        "streamed": usage["streamed"],
+        "total": total,
+        "phases": usage["phases"],
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "generated_tokens": usage.get("generated_tokens"),
+    }
+    if profile is not None:
+        record["profile"] = profile
+    trace_logger.info(json.dumps(record))
+
+
+def profile_call(fn, *args, **kwargs):
+    """
+    Runs `fn(*args, **kwargs)` under cProfile, in the calling thread.
+
+    Returns:
+    - tuple: The return value of `fn` and a report of the functions with the
+      most cumulative time.
+    """
+
+    profiler = cProfile.Profile()
+    result = profiler.runcall(fn, *args, **kwargs)
+    report = io.StringIO()
+    stats = pstats.Stats(profiler, stream=report)
+    stats.sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+    return result, report.getvalue()
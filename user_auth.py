@@ -1,3 +1,8 @@
+import asyncio
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
@@ -6,29 +11,83 @@ from datetime import datetime, timedelta
 from typing import Annotated, Union
 from fastapi import Depends, HTTPException, status
 
-from config import ALGORITHM, SECRET_KEY
+from config import ALGORITHM, AUTH_HASH_WORKERS, AUTH_TOKEN_CACHE_SIZE, SECRET_KEY
 from database import fake_users_db
 from models import User, UserInDB, TokenData
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# bcrypt takes hundreds of milliseconds per check; a small pool keeps it off
+# the event loop and caps how much CPU a burst of logins can take.
+password_executor = ThreadPoolExecutor(
+    max_workers=AUTH_HASH_WORKERS, thread_name_prefix="password"
+)
+
+
+class VerifiedTokenCache:
+    """
+    LRU of access tokens whose signature was already verified, mapped to
+    their user's public fields (never the password hash), so repeated
+    requests with the same token skip `jwt.decode`.
+
+    An entry is only used until the token's `exp`. The caller re-reads the
+    user on every hit, so that removing or disabling a user applies to the
+    tokens already cached.
+    """
+
+    def __init__(self, max_entries=AUTH_TOKEN_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, token):
+        """Returns (user, expires_at) for a cached, unexpired token, or None."""
+        entry = self._entries.get(token)
+        if entry is None:
+            return None
+        if entry[1] <= time.time():
+            del self._entries[token]
+            return None
+        self._entries.move_to_end(token)
+        return entry
+
+    def set(self, token, user, expires_at):
+        if self.max_entries <= 0 or expires_at is None:
+            return
+        self._entries[token] = (user, expires_at)
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def pop(self, token):
+        self._entries.pop(token, None)
+
+
+token_cache = VerifiedTokenCache()
+
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 
+async def verify_password_async(plain_password, hashed_password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        password_executor, verify_password, plain_password, hashed_password
+    )
+
+
 def get_user(db, username: str):
     if username in db:
         user_dict = db[username]
         return UserInDB(**user_dict)
 
 
-def authenticate_user(fake_db, username: str, password: str):
+async def authenticate_user(fake_db, username: str, password: str):
     user = get_user(fake_db, username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await verify_password_async(password, user.hashed_password):
         return False
     return user
 
@@ -44,12 +103,27 @@ def create_access_token(data: dict, expires_delta: Union[timedelta, None] = None
     return encoded_jwt
 
 
-def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+    cached = token_cache.get(token)
+    if cached is not None:
+        user, expires_at = cached
+        # Read the user's current state, so that disabling or removing a
+        # user applies to tokens that are already cached.
+        user_dict = fake_users_db.get(user.username)
+        if user_dict is None:
+            token_cache.pop(token)
+            raise credentials_exception
+        if user_dict.get("disabled") != user.disabled:
+            user = User(**user_dict)
+            token_cache.set(token, user, expires_at)
+        return user
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
@@ -61,6 +135,9 @@ def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
     user = get_user(fake_users_db, username=token_data.username)
     if user is None:
         raise credentials_exception
+    # Only the fields the dependency returns are kept.
+    user = User(**user.dict(exclude={"hashed_password"}))
+    token_cache.set(token, user, payload.get("exp"))
     return user
 
 